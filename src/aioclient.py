@@ -0,0 +1,173 @@
+import asyncio
+import contextlib
+from ftplib import FTP, error_proto, _GLOBAL_DEFAULT_TIMEOUT
+from concurrent.futures import ThreadPoolExecutor
+from client import MyFTPClient
+
+
+class AsyncFTPClient(object):
+    """
+    An asyncio API for the encrypted FTP client, for running many uploads, downloads and listings at once.
+    Operations run on MyFTPClient sessions of the logged in user, taken from a pool of up to pool_size sessions
+    which are opened on demand with a session ticket (see MyFTPClient.open_session), so no keys are derived.
+    Every operation runs in a worker thread: the network I/O and the encryption of a transfer overlap with those
+    of the others, while the event loop stays free.
+    The pool sessions start in the home directory, so paths are relative to it.
+    Uploads don't update the metadata tag: it is updated once after a batch (see upload_files, exchange_meta_tag).
+    """
+
+    def __init__(self, host='', port=21, pool_size=8, timeout=_GLOBAL_DEFAULT_TIMEOUT):
+        """
+        :param host: (str) server address
+        :param port: (int) server port
+        :param pool_size: (int) maximal number of sessions used at once
+        :param timeout: (float) timeout of the control and data connections
+        """
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # the session logged in with the password, which verifies and updates the metadata tag
+        self._ftp = None
+        self._ticket = None
+        self._sessions = []
+        # number of sessions opened or being opened
+        self._opened = 0
+        self._idle = asyncio.Queue()
+        self._meta_lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(pool_size + 1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _run(self, fun, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fun, *args)
+
+    async def login(self, user, passwd):
+        """
+        Log in (see MyFTPClient.login, which also verifies the file metadata) and get a ticket for the pool sessions.
+        :param user: (str) username
+        :param passwd: (str) secret
+        :return: (str) server response
+        """
+        self._ftp = MyFTPClient(timeout=self.timeout)
+        await self._run(self._ftp.connect, self.host, self.port)
+        resp = await self._run(self._ftp.login, user, passwd)
+        self._ticket = (await self._run(self._ftp.voidcmd, 'TCKT'))[4:].split()[0]
+        return resp
+
+    @contextlib.asynccontextmanager
+    async def _session(self):
+        """
+        Take a session from the pool (opening one if none is idle and the pool isn't full) and put it back when done,
+        also after an error reply. Sessions whose connection failed (or whose operation was cancelled while it may
+        still run in its worker thread) are closed instead.
+        """
+        # None in the idle queue wakes a waiter up to open a session in place of a discarded one
+        session = None if self._idle.empty() and self._opened < self.pool_size else await self._idle.get()
+        if session is None:
+            self._opened += 1
+            try:
+                session = await self._run(self._ftp.open_session, self._ticket)
+            except BaseException:
+                self._release()
+                raise
+            self._sessions.append(session)
+        try:
+            yield session
+        except (EOFError, OSError, error_proto):
+            self._discard(session)
+            raise
+        except Exception:
+            self._idle.put_nowait(session)
+            raise
+        except BaseException:
+            self._discard(session)
+            raise
+        self._idle.put_nowait(session)
+
+    def _release(self):
+        self._opened -= 1
+        self._idle.put_nowait(None)
+
+    def _discard(self, session):
+        self._sessions.remove(session)
+        session.close()
+        self._release()
+
+    async def _run_in_session(self, fun, *args):
+        """
+        Run a blocking operation on a pool session in a worker thread.
+        :param fun: (Callable) called with the session followed by the given arguments
+        :return: the result of fun
+        """
+        async with self._session() as session:
+            return await self._run(fun, session, *args)
+
+    @staticmethod
+    def _upload(session, filename, path):
+        with open(filename, 'rb') as fp:
+            return session.store_tagged(path, fp)
+
+    async def upload_file(self, filename, path=None):
+        """
+        Upload a file (see MyFTPClient.store_tagged), without updating the metadata tag.
+        :param filename: (str) filename of the local file to upload
+        :param path: (str) path of the file on the server (defaults to the filename)
+        :return: (str) server response
+        """
+        return await self._run_in_session(self._upload, filename, path or filename)
+
+    async def upload_files(self, *filenames):
+        """
+        Upload files concurrently, then update the metadata tag once for all of them.
+        :param filenames: (str) filenames of the local files to upload
+        :return: (str) server response
+        """
+        await asyncio.gather(*[self.upload_file(filename) for filename in filenames])
+        return await self.exchange_meta_tag()
+
+    async def download_file(self, filename):
+        """
+        Download a file into a local file (see MyFTPClient.download_file).
+        :param filename: (str) filename (or path) of the requested file to download
+        :return: (str) server response, None if the verification failed
+        """
+        return await self._run_in_session(MyFTPClient.download_file, filename)
+
+    async def download_files(self, *filenames):
+        """
+        Download files concurrently.
+        :param filenames: (str) filenames (or paths) of the requested files to download
+        :return: (List(str)) server responses, None for the files whose verification failed
+        """
+        return await asyncio.gather(*[self.download_file(filename) for filename in filenames])
+
+    async def nlst(self, path=''):
+        """
+        :param path: (str) the listed directory (defaults to the home directory)
+        :return: (List(str)) decrypted names of the directory's entries
+        """
+        return await self._run_in_session(FTP.nlst, *((path,) if path else ()))
+
+    async def exchange_meta_tag(self):
+        """
+        Update the metadata tag for all the changes made by the sessions (see MyFTPClient.exchange_meta_tag).
+        :return: (str) server response
+        """
+        async with self._meta_lock:
+            return await self._run(self._ftp.exchange_meta_tag)
+
+    async def close(self):
+        """
+        Close all sessions.
+        """
+        for session in self._sessions + ([self._ftp] if self._ftp else []):
+            session.close()
+        self._sessions = []
+        self._opened = 0
+        self._ftp = None
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,375 @@
+import io
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import shutil
+import tempfile
+import logging
+import argparse
+import threading
+import multiprocessing
+import db
+import client
+import server
+from mycrypto import MyCipher, apply_tree_updates
+from pyftpdlib.log import config_logging
+from pyftpdlib.servers import FTPServer
+
+
+def _timeit(fun, repeat):
+    """
+    Run a function repeatedly and return its mean latency.
+    :param fun: (Callable) function to run (no arguments)
+    :param repeat: (int) number of runs
+    :return: (float) mean latency in milliseconds
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench_db(files=1000, repeat=200):
+    """
+    Measure the database work done by the server per FTP command (without any network or file I/O).
+    :param files: (int) number of files in the listed directory
+    :param repeat: (int) number of runs per command
+    :return: (dict) command name -> mean latency in milliseconds
+    """
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        db.users_db = os.path.realpath('users.db')
+        db.create_user_metadata()
+        db.add_user_metadata('user', os.path.realpath('1'), 'elradfmwMT', '', 'hi', 'bye', b'salt', b'pass')
+        os.mkdir('1')
+        meta = db.FileMetaHandler('1')
+        meta.create_file_metadata()
+        for i in range(files):
+            numpath = meta.get_numpath('/file%d' % i)
+            filenum = numpath.split(os.sep)[-1]
+            meta.add_file_meta(filenum, '00' * 32, 1024)
+            with open(numpath, 'wb') as fo:
+                fo.truncate(1024)
+
+        counter = iter(range(files, files + repeat * 10))
+
+        def login():
+            db.has_user('user')
+            db.fetch_user_pass('user')
+            db.fetch_user_metadata('user')
+            db.fetch_operms('user')
+
+        def login_check():
+            for _ in meta.find_anomalies():
+                pass
+
+        def stor():
+            filenum = meta.get_numpath('/file%d' % next(counter)).split(os.sep)[-1]
+            if not meta.fetch_tag(filenum):
+                meta.add_file_meta(filenum, '00' * 32, 1024)
+
+        def stor_meta():
+            stor()
+            seq, updates = meta.fetch_tree_updates()
+            apply_tree_updates(updates)
+            meta.clear_tree_journal(seq)
+
+        def retr():
+            filenum = meta.get_numpath('/file0').split(os.sep)[-1]
+            meta.fetch_size(filenum)
+            meta.fetch_tag(filenum)
+
+        def nlst():
+            # as MyDBFS.listdir: the names and sizes of all entries with a single query
+            meta.fetch_dir_entries(meta.root_filenum)
+
+        meta.clear_tree_journal()
+        results = {
+            'login': _timeit(login, repeat),
+            'login check (%d files)' % files: _timeit(login_check, max(1, repeat // 20)),
+            'STOR + META': _timeit(stor_meta, repeat),
+            'STOR': _timeit(stor, repeat),
+            'RETR': _timeit(retr, repeat),
+            'NLST (%d files)' % files: _timeit(nlst, max(1, repeat // 20)),
+        }
+        meta.close()
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_names(names=100000, workers=1):
+    """
+    Measure the filename encryption throughput of the client, one name at a time and in batches
+    (MyCipher.encrypt_many / decrypt_many), and the decryption of a listing of all the names.
+    :param names: (int) number of filenames
+    :param workers: (int) number of threads for the batches
+    :return: (dict) operation -> names per second
+    """
+    cipher = MyCipher('secret')
+    filenames = [('file%07d.txt' % i).encode() for i in range(names)]
+    msgs = cipher.encrypt_many(filenames, is_filename=True, workers=workers)
+    ftp = client.MyFTPClient()
+    ftp._set_cipher(cipher)
+    listing = [msg.hex() for msg in msgs]
+
+    def rate(fun):
+        start = time.perf_counter()
+        fun()
+        return names / (time.perf_counter() - start)
+
+    return {
+        'encrypt': rate(lambda: [cipher.encrypt(filename, is_filename=True) for filename in filenames]),
+        'encrypt_many': rate(lambda: cipher.encrypt_many(filenames, is_filename=True, workers=workers)),
+        'decrypt': rate(lambda: [cipher.decrypt(msg) for msg in msgs]),
+        'decrypt_many': rate(lambda: cipher.decrypt_many(msgs, workers=workers)),
+        'NLST listing': rate(lambda: ftp._decrypt_listing(listing)),
+    }
+
+
+def _peak_rss():
+    """
+    :return: (Union(int, None)) peak resident set size of this process in bytes (None where unknown)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _run_server(sock, root, peak_rss):
+    """
+    Run the server's handler stack (as server.main sets it up) on a listening socket, in a child process.
+    Its peak RSS is stored in peak_rss when it's terminated.
+    :param sock: (socket.socket) the listening socket
+    :param root: (str) directory for the users db and the users' files
+    :param peak_rss: (multiprocessing.Value) where to store the peak RSS
+    """
+    # serve_forever returns on SystemExit, after closing the sessions
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    # leave out the per-session log lines
+    config_logging(level=logging.WARNING)
+    os.chdir(root)
+    db.users_db = os.path.realpath('users.db')
+    handler = server.MyFTPHandler
+    handler.authorizer = server.MySmartyAuthorizer()
+    handler.abstracted_fs = server.MyDBFS
+    ftp_server = FTPServer(sock, handler)
+    # all sessions come from the same address
+    ftp_server.max_cons_per_ip = 0
+    ftp_server.serve_forever()
+    # the password pool's processes would otherwise outlive the server, keeping its stdout open
+    handler.authorizer.close()
+    peak_rss.value = _peak_rss() or 0
+
+
+def _percentile(latencies, fraction):
+    """
+    :param latencies: (List(float)) sorted latencies
+    :param fraction: (float) percentile, as a fraction
+    :return: (float) the latency below which the given fraction of them are (nearest rank)
+    """
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def bench_load(sessions=4, files=200, size=8, logins=5, timeout=60):
+    """
+    Measure the whole encrypted FTP stack under load: the server runs in a child process on a loopback port
+    with a temporary root, and concurrent client sessions (one user each, in threads) go through every phase
+    together. Each phase starts once all sessions finished the previous one.
+    :param sessions: (int) number of concurrent sessions
+    :param files: (int) number of small files uploaded by every session (into one directory, which is then listed,
+                  and whose files are renamed and deleted)
+    :param size: (int) size of the large file uploaded and downloaded by every session, in MiB
+    :param logins: (int) number of logins with a session ticket per session
+    :param timeout: (float) timeout of the connections
+    :return: (dict) phase -> ops, ops/s and p50/p99 latency (ms); 'peak_rss' -> server and client peak RSS (bytes);
+             'params' -> the parameters
+    """
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    sock = socket.create_server(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    context = multiprocessing.get_context('fork')
+    server_rss = context.Value('q', 0)
+    server_process = context.Process(target=_run_server, args=(sock, workdir, server_rss))
+    server_process.start()
+    sock.close()
+    clients = [None] * sessions
+    users = ['load%d' % session for session in range(sessions)]
+    small = b'x' * 1024
+    large = os.urandom(size << 20)
+
+    def connect():
+        ftp = client.MyFTPClient(timeout=timeout)
+        ftp.connect('127.0.0.1', port)
+        return ftp
+
+    def register(session, _):
+        ftp = connect()
+        ftp.register(users[session], 'password')
+        ftp.quit()
+
+    def login(session, _):
+        clients[session] = connect()
+        clients[session].login(users[session], 'password')
+        clients[session].voidcmd('TYPE I')
+
+    def login_ticket(session, _):
+        # the ticket received on the previous login is presented (see MyFTPClient.login)
+        clients[session].quit()
+        login(session, _)
+
+    def sink(data):
+        pass
+
+    # phase name, the operation (called with the session's index and every argument) and its arguments
+    phases = [
+        ('register', register, [None]),
+        ('login', login, [None]),
+        ('login (ticket)', login_ticket, [None] * logins),
+        ('mkd', lambda session, path: clients[session].mkd(path), ['small']),
+        ('upload small', lambda session, i: clients[session].store_tagged('small/file%d' % i, io.BytesIO(small)),
+         range(files)),
+        ('tag', lambda session, _: clients[session].exchange_meta_tag(), [None]),
+        ('list', lambda session, path: clients[session].retrlines('NLST ' + path, sink), ['small'] * 5),
+        ('rename', lambda session, i: clients[session].rename('small/file%d' % i, 'small/renamed%d' % i),
+         range(files)),
+        ('delete', lambda session, i: clients[session].delete('small/renamed%d' % i), range(files)),
+        ('upload large', lambda session, path: clients[session].store_tagged(path, io.BytesIO(large)), ['large']),
+        ('download large', lambda session, path: clients[session].retrbinary('RETR ' + path, sink), ['large']),
+    ]
+
+    def run_phase(fun, args):
+        latencies = [[] for _ in range(sessions)]
+        errors = []
+
+        def run(session):
+            try:
+                for arg in args:
+                    start = time.perf_counter()
+                    fun(session, arg)
+                    latencies[session].append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(session,)) for session in range(sessions)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+        return sorted(sum(latencies, [])), elapsed
+
+    try:
+        os.chdir(workdir)
+        results = {}
+        for name, fun, args in phases:
+            latencies, elapsed = run_phase(fun, args)
+            results[name] = {
+                'ops': len(latencies),
+                'ops_per_s': len(latencies) / elapsed,
+                'p50_ms': _percentile(latencies, 0.5) * 1000,
+                'p99_ms': _percentile(latencies, 0.99) * 1000,
+            }
+        for ftp in clients:
+            ftp.quit()
+    finally:
+        for ftp in clients:
+            if ftp is not None:
+                ftp.close()
+        server_process.terminate()
+        server_process.join()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    results['peak_rss'] = {'server': server_rss.value or None, 'client': _peak_rss()}
+    results['params'] = {'sessions': sessions, 'files': files, 'size': size, 'logins': logins}
+    return results
+
+
+def compare_load(results, baseline, tolerance=0.2):
+    """
+    :param results: (dict) results of bench_load
+    :param baseline: (dict) results of an earlier run
+    :param tolerance: (float) fraction of the baseline's ops/s a phase may lose (or of its peak RSS it may gain)
+    :return: (List(str)) a description of every regression
+    """
+    if baseline.get('params') != results.get('params'):
+        raise ValueError('the baseline was measured with other parameters: %s' % baseline.get('params'))
+    regressions = []
+    for name, result in results.items():
+        if name in ('peak_rss', 'params') or name not in baseline:
+            continue
+        if result['ops_per_s'] < baseline[name]['ops_per_s'] * (1 - tolerance):
+            regressions.append('%s: %.1f ops/s (baseline %.1f)' % (name, result['ops_per_s'],
+                                                                   baseline[name]['ops_per_s']))
+    for process, rss in results['peak_rss'].items():
+        baseline_rss = baseline.get('peak_rss', {}).get(process)
+        if rss and baseline_rss and rss > baseline_rss * (1 + tolerance):
+            regressions.append('%s peak RSS: %d MiB (baseline %d MiB)' % (process, rss >> 20, baseline_rss >> 20))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the encrypted FTP server and client.')
+    subparsers = parser.add_subparsers(dest='bench')
+    db_parser = subparsers.add_parser('db', help='per-command database latency')
+    db_parser.add_argument('--files', type=int, default=1000)
+    db_parser.add_argument('--repeat', type=int, default=200)
+    names_parser = subparsers.add_parser('names', help='filename encryption throughput')
+    names_parser.add_argument('--names', type=int, default=100000)
+    names_parser.add_argument('--workers', type=int, default=1)
+    load_parser = subparsers.add_parser('load', help='concurrent sessions against a local server')
+    load_parser.add_argument('--sessions', type=int, default=4)
+    load_parser.add_argument('--files', type=int, default=200)
+    load_parser.add_argument('--size', type=int, default=8, help='size of the large files (MiB)')
+    load_parser.add_argument('--logins', type=int, default=5)
+    load_parser.add_argument('--output', help='write the results to this file (JSON)')
+    load_parser.add_argument('--baseline', help='compare with the results in this file (JSON), '
+                                                'exiting with status 2 on a regression')
+    load_parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.bench == 'db':
+        for cmd, latency in bench_db(args.files, args.repeat).items():
+            print('%-26s %10.3f ms' % (cmd, latency))
+    elif args.bench == 'names':
+        for op, rate in bench_names(args.names, args.workers).items():
+            print('%-26s %10.0f names/s' % (op, rate))
+    elif args.bench == 'load':
+        results = bench_load(args.sessions, args.files, args.size, args.logins)
+        print('%-26s %8s %10s %10s %10s' % ('', 'ops', 'ops/s', 'p50 ms', 'p99 ms'))
+        for name, result in results.items():
+            if name not in ('peak_rss', 'params'):
+                print('%-26s %8d %10.1f %10.3f %10.3f' % (name, result['ops'], result['ops_per_s'],
+                                                          result['p50_ms'], result['p99_ms']))
+        for process, rss in results['peak_rss'].items():
+            print('%-26s %10s MiB' % ('peak RSS (%s)' % process, rss >> 20 if rss else '?'))
+        if args.output:
+            with open(args.output, 'w') as fo:
+                json.dump(results, fo, indent=2)
+        if args.baseline:
+            with open(args.baseline) as fo:
+                regressions = compare_load(results, json.load(fo), args.tolerance)
+            for regression in regressions:
+                print('REGRESSION ' + regression, file=sys.stderr)
+            if regressions:
+                sys.exit(2)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
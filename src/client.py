@@ -1,12 +1,156 @@
 import io
 import sys
 import os
+import json
+import time
+import queue
+import socket
+import sqlite3
+import tempfile
+import hashlib
+import calendar
+import threading
+import posixpath
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from ftplib import FTP, error_perm, error_reply, _GLOBAL_DEFAULT_TIMEOUT
-from mycrypto import MyCipher
+from mycrypto import MyCipher, RECORD_LAYOUTS, STREAM_HEADER, STREAM_MAGIC, TAG_SIZE, TREE_TAG, TREE_TAG_MAGIC, \
+    record_count, record_offset, stream_chunk_count, stream_size, merkle_root, apply_tree_updates, tree_tag, \
+    tree_tag_data
 from cryptography.exceptions import InvalidSignature
 
 ip = 'localhost'
 
+# session tickets of users who logged in, for resuming on later connections (see MyFTPClient.login):
+# (host, port, username, password hash) -> (MyCipher, ticket, expiry time)
+_sessions = {}
+
+# maximal number of filenames remembered by a FilenameCache, in each direction
+FILENAME_CACHE_SIZE = 4096
+
+# bytes of a STOT upload sent before the server's preliminary reply, the rest waits for it
+# (the server doesn't read the data of an upload it refused)
+STOT_EAGER_SIZE = 1 << 16
+
+
+def _legacy_tree_rows(db_data):
+    """
+    Read the file metadata entries of a db file tagged as a whole (by an older client, of any schema version)
+    as they are hashed into the Merkle tree once migrated (see db.FileMetaHandler._fetch_tree_rows).
+    :param db_data: (bytes) the db file
+    :return: (List(List)) the entries: filenum, parent, name, tag and size (None for directories)
+    """
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(db_data)
+        dbcon = sqlite3.connect(path)
+        try:
+            columns = [column[1] for column in dbcon.execute("""PRAGMA table_info(Filenums)""")]
+            if 'name' in columns:
+                entries = dbcon.execute("""SELECT filenum, parent, name FROM Filenums""").fetchall()
+            else:
+                # schema versions 0 and 1 store full paths: parents are taken from the numpaths where missing
+                cursor = dbcon.execute("""SELECT filenum, %s, numpath, ftppath FROM Filenums"""
+                                       % ('parent' if 'parent' in columns else 'NULL'))
+                entries = [(filenum, None if ftppath == '/' else
+                            parent if parent is not None else int(numpath.replace('\\', '/').split('/')[-2]),
+                            ftppath.split('/')[-1]) for filenum, parent, numpath, ftppath in cursor]
+            # the newest metadata of each entry (older versions could leave duplicates)
+            metadata = {filenum: (tag, size) for filenum, tag, size in
+                        dbcon.execute("""SELECT filenum, tag, size FROM FileMetadata ORDER BY rowid""")}
+        finally:
+            dbcon.close()
+    finally:
+        os.remove(path)
+    return [[filenum, parent, name, *metadata.get(filenum, (None, None))] for filenum, parent, name in entries]
+
+
+class FilenameCache(object):
+    """
+    A bounded LRU cache of the filename encryptions of one cipher, in both directions
+    (name -> encrypted name and encrypted name -> name), so paths and listings of hot directories
+    are translated without running the cipher. Filenames are encrypted deterministically, so the cached
+    encryptions are the ones the server stores.
+    Sessions of the same user share it (see MyFTPClient.open_session), from several threads.
+    """
+
+    def __init__(self, max_size=FILENAME_CACHE_SIZE):
+        """
+        :param max_size: (int) maximal number of filenames remembered in each direction
+        """
+        self.max_size = max_size
+        self._encrypted = OrderedDict()
+        self._decrypted = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, names, key):
+        with self._lock:
+            value = names.get(key)
+            if value is not None:
+                names.move_to_end(key)
+            return value
+
+    def _put(self, names, key, value):
+        names[key] = value
+        names.move_to_end(key)
+        if len(names) > self.max_size:
+            names.popitem(last=False)
+
+    def encrypted(self, name):
+        """
+        :param name: (str) filename
+        :return: (str) the cached encrypted filename (hex), None if not cached
+        """
+        return self._get(self._encrypted, name)
+
+    def decrypted(self, encrypted_name):
+        """
+        :param encrypted_name: (str) encrypted filename (hex)
+        :return: (str) the cached filename, None if not cached
+        """
+        return self._get(self._decrypted, encrypted_name)
+
+    def add(self, name, encrypted_name):
+        """
+        Remember an encryption of a filename, in both directions.
+        :param name: (str) filename
+        :param encrypted_name: (str) its encryption (hex)
+        """
+        with self._lock:
+            self._put(self._encrypted, name, encrypted_name)
+            self._put(self._decrypted, encrypted_name, name)
+
+    def decrypted_many(self, encrypted_names):
+        """
+        :param encrypted_names: (Iterable(str)) encrypted filenames (hex)
+        :return: (Dict(str, str)) the cached filenames of those of the given encrypted filenames which are cached
+        """
+        with self._lock:
+            names = {}
+            for encrypted_name in encrypted_names:
+                name = self._decrypted.get(encrypted_name)
+                if name is not None:
+                    self._decrypted.move_to_end(encrypted_name)
+                    names[encrypted_name] = name
+            return names
+
+    def add_decrypted(self, names):
+        """
+        Remember decryptions of filenames. The names aren't mapped back to the given encryptions,
+        which may differ from the server's (e.g. in the case of their hex digits).
+        :param names: (Dict(str, str)) decrypted filenames, by encrypted filename (hex)
+        """
+        with self._lock:
+            # only the last max_size decryptions would remain
+            for encrypted_name, name in list(names.items())[-self.max_size:]:
+                self._put(self._decrypted, encrypted_name, name)
+
+    def clear(self):
+        with self._lock:
+            self._encrypted.clear()
+            self._decrypted.clear()
+
 
 class MyFTPClient(FTP):
     """
@@ -18,17 +162,60 @@ class MyFTPClient(FTP):
 
     def __init__(self, host='', user='', passwd='', acct='', timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None):
         self._cipher = None
+        # filename encryptions of the cipher (see _encrypt_filename)
+        self._names = FilenameCache()
+        # encrypted username, for opening more sessions (see open_session)
+        self._user = None
+        # root of the file metadata tree, as last verified or tagged in this session
+        self._tree_root = None
         super().__init__(host, user, passwd, acct, timeout, source_address)
 
+    def _set_cipher(self, cipher, names=None):
+        """
+        Use the given cipher from now on, with an empty filename cache (unless a cache of the same cipher is given).
+        """
+        self._cipher = cipher
+        self._names = names or FilenameCache()
+
     def _encrypt_filename(self, filename):
-        return self._cipher.encrypt(filename.encode(), is_filename=True).hex()
+        encrypted = self._names.encrypted(filename)
+        if encrypted is None:
+            encrypted = self._cipher.encrypt(filename.encode(), is_filename=True).hex()
+            self._names.add(filename, encrypted)
+        return encrypted
 
     def _decrypt_filename(self, filename):
+        name = self._names.decrypted(filename)
+        if name is not None:
+            return name
         try:
-            return self._cipher.decrypt(bytes.fromhex(filename)).decode()
+            name = self._cipher.decrypt(bytes.fromhex(filename)).decode()
         except InvalidSignature:
             print('The filename has been altered!', file=sys.stderr)
             return filename
+        self._names.add_decrypted({filename: name})
+        return name
+
+    def _decrypt_filenames(self, filenames):
+        """
+        Decrypt a batch of encrypted filenames (see _decrypt_filename), decrypting the distinct filenames
+        which aren't cached all at once (see MyCipher.decrypt_many).
+        :param filenames: (Iterable(str)) encrypted filenames (hex)
+        :return: (List(str)) the decrypted filenames, in the same order
+        """
+        filenames = list(filenames)
+        names = self._names.decrypted_many(set(filenames))
+        missing = list({filename for filename in filenames if filename not in names})
+        decrypted = {}
+        for filename, name in zip(missing, self._cipher.decrypt_many([bytes.fromhex(f) for f in missing])):
+            if name is None:
+                print('The filename has been altered!', file=sys.stderr)
+                names[filename] = filename
+            else:
+                decrypted[filename] = name.decode()
+        self._names.add_decrypted(decrypted)
+        names.update(decrypted)
+        return [names[filename] for filename in filenames]
 
     @staticmethod
     def _is_regular_filename(filename):
@@ -38,41 +225,93 @@ class MyFTPClient(FTP):
         return '/'.join([self._encrypt_filename(dirname) if self._is_regular_filename(dirname) else dirname
                          for dirname in path.split('/')])
 
-    def _decrypt_path(self, path):
+    def _decrypt_path(self, path, names=None):
         if path.startswith('"'):
-            return '"%s"' % self._decrypt_path(path[1:-1])
+            return '"%s"' % self._decrypt_path(path[1:-1], names)
         if path.endswith(',') or path.endswith('.'):
-            return "%s%s" % (self._decrypt_path(path[:-1]), path[-1])
-        return '/'.join([self._decrypt_filename(dirname) if self._is_regular_filename(dirname) and len(dirname) >= 160
+            return "%s%s" % (self._decrypt_path(path[:-1], names), path[-1])
+        return '/'.join([(names[dirname] if names and dirname in names else self._decrypt_filename(dirname))
+                         if self._is_regular_filename(dirname) and len(dirname) >= 160
                          else dirname for dirname in path.split('/')])
 
-    def decrypt_server_message(self, line):
+    def decrypt_server_message(self, line, names=None):
         """
         Decrypt encrypted strings within a server response.
         :param line: (str) server response
+        :param names: (Dict(str, str)) already decrypted filenames, by encrypted filename
         :return: (str) the same message but with encrypted strings decrypted
         """
-        return ' '.join([self._decrypt_path(word) if len(word) >= 160 else word for word in line.split(' ')])
+        if '\n' in line:
+            # multi-line response
+            return '\n'.join([self.decrypt_server_message(row, names) for row in line.split('\n')])
+        return ' '.join([self._decrypt_path(word, names) if len(word) >= 160 else word for word in line.split(' ')])
+
+    def _decrypt_listing(self, lines):
+        """
+        Decrypt the encrypted names within the lines of a listing (see decrypt_server_message), as a batch:
+        the distinct names are decrypted at once (see _decrypt_filenames) before the lines are translated.
+        :param lines: (List(str)) lines received from a LIST, NLST or MLSD command
+        :return: (List(str)) the lines, decrypted
+        """
+        filenames = list({name for line in lines for word in line.split(' ') if len(word) >= 160
+                          for name in word.strip('",.').split('/') if len(name) >= 160})
+        names = dict(zip(filenames, self._decrypt_filenames(filenames)))
+        # NLST lines are bare names
+        return [names[line] if line in names else self.decrypt_server_message(line, names) for line in lines]
 
     def login(self, user='', passwd='', acct=''):
         """
         Initialize a MyCipher object, encrypt the given username and derive the server password
         from the given password, then call the super-method with the results.
+        If this user logged in to the server before (in this process), the cached MyCipher object is used
+        and the session ticket received then is presented instead, which saves deriving the keys
+        on both sides (see resume). A new ticket is requested after logging in with the password.
         Prints a security error message if such a message was received from the server.
         On no errors, call login_tag_verify (detailed below).
         """
-        self._cipher = MyCipher(passwd)
-        user = self._encrypt_filename(user)
-        server_key = self._cipher.derive_server_key()
-        resp = super().login(user, server_key, acct)
+        session_key = (self.host, self.port, user, hashlib.sha256(passwd.encode()).digest())
+        session = _sessions.pop(session_key, None)
+        if session is not None and session[2] > time.monotonic():
+            try:
+                self._set_cipher(session[0])
+                self._user = self._encrypt_filename(user)
+                resp = self.resume(self._user, session[1])
+            except error_perm:
+                session = None
+        else:
+            session = None
+        if session is None:
+            self._set_cipher(MyCipher(passwd))
+            self._user = self._encrypt_filename(user)
+            server_key = self._cipher.derive_server_key()
+            resp = super().login(self._user, server_key, acct)
         try:
             resp = self.getresp()
         except error_perm as e:
             print('SECURITY ALERT -- ' + self.decrypt_server_message(str(e)[4:]), file=sys.stderr)
             return resp
+        if session is None:
+            ticket, lifetime = self.voidcmd('TCKT')[4:].split()
+            # leave a margin for the clocks and the round trip
+            session = (self._cipher, ticket, time.monotonic() + int(lifetime) * 0.9)
+        _sessions[session_key] = session
         self.login_tag_verify()
         return resp
 
+    def resume(self, user, ticket):
+        """
+        Log in with a session ticket instead of a password (USER, then RSME).
+        :param user: (str) encrypted username
+        :param ticket: (str) session ticket, as received from the server by a previous login
+        :return: (str) server response
+        """
+        resp = self.sendcmd('USER ' + user)
+        if resp[0] == '3':
+            resp = self.sendcmd('RSME ' + ticket)
+        if resp[0] != '2':
+            raise error_reply(resp)
+        return resp
+
     def register(self, user, passwd, acct=''):
         """
         Register a new user. This works similarly to login but starts with an RGTR call instead of USER.
@@ -82,7 +321,7 @@ class MyFTPClient(FTP):
         :param acct: [unused]
         :return: (str) server response
         """
-        self._cipher = MyCipher(passwd)
+        self._set_cipher(MyCipher(passwd))
         user = self._encrypt_filename(user)
         resp = self.sendcmd('RGTR ' + user)
         if resp[0] == '3':
@@ -96,23 +335,42 @@ class MyFTPClient(FTP):
 
     def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
         """
-        Encrypt the filename, then receive all data from the super-method (file download) and decrypt it.
-        Then call callback on the decrypted data in blocks (callback should write to local file).
+        Encrypt the filename, then receive the file data from the super-method (file download),
+        verifying and decrypting it chunk by chunk as it arrives.
+        callback is called on the decrypted data (callback should write to local file).
+        rest is a position in the decrypted file: the download restarts at the chunk holding it, so only the
+        remaining chunks are received and verified (see _restart_decryptor).
         Prints a security error message if the file data verification failed.
         """
         retrcmd, path = cmd.split()
         enc_path = self._encrypt_path(path)
+        skip = 0
+        errors = []
+
+        def emit(pt):
+            nonlocal skip
+            if skip:
+                pt, skip = pt[skip:], max(0, skip - len(pt))
+            if pt:
+                callback(pt)
+
+        def on_data(data):
+            # keep draining the data connection after a failure, so the control connection stays in sync
+            if errors:
+                return
+            try:
+                emit(decryptor.update(data))
+            except InvalidSignature as e:
+                errors.append(e)
+
         try:
-            with io.BytesIO() as buf:
-                resp = super().retrbinary(' '.join((retrcmd, enc_path)), buf.write, blocksize, rest)
-                buf.flush()
-                dec_bytes = self._cipher.decrypt(buf.getvalue())
-            with io.BytesIO(dec_bytes) as buf:
-                while True:
-                    b = buf.read(blocksize)
-                    if not b:
-                        break
-                    callback(b)
+            decryptor = self._cipher.stream_decryptor()
+            if rest:
+                decryptor, rest, skip = self._restart_decryptor(enc_path, rest)
+            resp = super().retrbinary(' '.join((retrcmd, enc_path)), on_data, blocksize, rest)
+            if errors:
+                raise errors[0]
+            emit(decryptor.finalize())
             return resp
         except (error_perm, InvalidSignature) as e:
             if not (isinstance(e, InvalidSignature) or str(e).startswith('555')):
@@ -120,66 +378,514 @@ class MyFTPClient(FTP):
             print('SECURITY ALERT -- The file %s has been altered! Download aborted' % path, file=sys.stderr)
             return None
 
+    def _restart_decryptor(self, enc_path, rest):
+        """
+        Find where to restart a download: the header is retrieved (RANG) and the download restarts at the record
+        of the chunk holding the byte before the given position (so the final record is always received).
+        Files in the old format are downloaded from the start.
+        :param enc_path: (str) encrypted path of the file on the server
+        :param rest: (int) position in the decrypted file
+        :return: (Tuple(StreamDecryptor, int, int)) decryptor for the remaining records, REST position to send,
+                 and number of decrypted bytes to skip
+        """
+        self.voidcmd('TYPE I')
+        header = self._retrieve_header(enc_path)
+        if not header.startswith(STREAM_MAGIC):
+            return self._cipher.stream_decryptor(), None, rest
+        decryptor = self._cipher.stream_decryptor(header, (rest - 1) // STREAM_HEADER.unpack(header)[2])
+        return (decryptor, record_offset(decryptor.index, decryptor.chunk_size, decryptor.version),
+                rest - decryptor.index * decryptor.chunk_size)
+
     def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
         """
-        Encrypt the filename and file contents, then call the super-method with them (file upload).
-        After the upload is done, send its MAC tag to the server and call exchange_meta_tag (detailed below).
+        Encrypt the filename, then encrypt the file contents chunk by chunk while sending them (file upload),
+        followed by the file's MAC tag (see store_tagged). Then call exchange_meta_tag (detailed below).
+        With rest (any position, the server tells where to resume), an interrupted upload is resumed
+        (see store_resumed).
+        """
+        path = cmd.split(' ', 1)[1]
+        self.voidcmd('TYPE I')
+        if rest is None:
+            self.store_tagged(path, fp, callback)
+        else:
+            self.store_resumed(path, fp, callback)
+        return self.exchange_meta_tag()
+
+    def store_tagged(self, path, fp, callback=None):
+        """
+        Upload a file with STOT: the encrypted contents are followed by the file's MAC tag on the data connection,
+        so no separate TAG command is needed. The command and the start of the data (up to STOT_EAGER_SIZE bytes)
+        are sent without waiting for the server's preliminary reply, so uploading a small file costs two round trips
+        (PASV and STOT). The metadata tag is not updated.
+        :param path: (str) path of the file on the server
+        :param fp: (file) file object to read the contents from
+        :param callback: (Callable) called with every encrypted record sent
+        :return: (str) server response
+        """
+        encryptor = self._cipher.stream_encryptor()
+        conn = socket.create_connection(self.makepasv(), self.timeout, source_address=self.source_address)
+        resp = None
+        refused = None
+        try:
+            self.putcmd('STOT ' + self._encrypt_path(path))
+            sent = 0
+            for record in encryptor.iter_records(fp):
+                if resp is None and sent + len(record) > STOT_EAGER_SIZE:
+                    resp = self.getresp()
+                    if resp[0] != '1':
+                        raise error_reply(resp)
+                conn.sendall(record)
+                sent += len(record)
+                if callback:
+                    callback(record)
+            conn.sendall(encryptor.file_tag())
+        except (ConnectionResetError, BrokenPipeError) as e:
+            if resp is not None:
+                raise
+            # the server may have refused the upload and closed the connection, its reply tells
+            refused = e
+        finally:
+            conn.close()
+        if resp is None:
+            resp = self.getresp()
+        if resp[0] != '1':
+            raise error_reply(resp)
+        if refused is not None:
+            raise refused
+        self.voidresp()
+        return self.voidresp()
+
+    def store_resumed(self, path, fp, callback=None):
+        """
+        Resume an interrupted upload (STOT or STSG): the server sends the committed length of the partial file
+        and its stream header (PLEN), and the records missing from it are encrypted with the same header and sent
+        with STSG at that position, followed by the file's MAC tag. The file is then completed with STSE.
+        The local file must not have changed since the interrupted upload, whose records aren't sent again
+        (they are verified on download, as usual). If there is nothing to resume, the file is uploaded as a whole.
+        As with store_tagged, the metadata tag is not updated.
+        :param path: (str) path of the file on the server
+        :param fp: (file) file object to read the contents from
+        :param callback: (Callable) called with every encrypted record sent
+        :return: (str) server response
         """
-        storcmd, path = cmd.split()
         enc_path = self._encrypt_path(path)
-        enc_bytes, tag = self._cipher.encrypt(fp.read())
-        super().storbinary(' '.join((storcmd, enc_path)), io.BytesIO(enc_bytes), blocksize, callback, rest)
+        try:
+            committed, header = self.sendcmd('PLEN ' + enc_path)[4:].split()
+        except error_perm:
+            return self.store_tagged(path, fp, callback)
+        encryptor = self._cipher.stream_encryptor(header=bytes.fromhex(header))
+        chunk_count = stream_chunk_count(fp.seek(0, os.SEEK_END), encryptor.chunk_size)
+        start = (int(committed) - STREAM_HEADER.size) // encryptor.record_size
+        if start > chunk_count:
+            # the partial file doesn't match the local one
+            return self.store_tagged(path, fp, callback)
+        offset = record_offset(start, encryptor.chunk_size, encryptor.version) if start else None
+        with self.transfercmd('STSG ' + enc_path, offset) as conn:
+            for record in encryptor.iter_range(fp, start, chunk_count, chunk_count):
+                conn.sendall(record)
+                if callback:
+                    callback(record)
+            conn.sendall(encryptor.file_tag(chunk_count))
+        self.voidresp()
+        return self.voidcmd('STSE ' + enc_path)
 
-        # send tag
-        resp = self.getresp()
-        if resp[0] == '3':
-            self.voidcmd('TAG ' + tag.hex())
-        return self.exchange_meta_tag()
+    def read_range(self, path, offset, length):
+        """
+        Read part of a file without downloading all of it: the records are all the same size, so only the records
+        of the chunks holding the range are retrieved (see _retrieve_records), verified and decrypted.
+        Files in the old format are downloaded as a whole.
+        Prints a security error message if the file data verification failed.
+        :param path: (str) path of the file on the server
+        :param offset: (int) position of the first byte to read
+        :param length: (int) number of bytes to read
+        :return: (bytes) the data read (shorter than length at the end of the file), None if the verification failed
+        """
+        enc_path = self._encrypt_path(path)
+        self.voidcmd('TYPE I')
+        try:
+            size = int(self.sendcmd('SIZE ' + enc_path)[4:])
+            header = self._retrieve_header(enc_path)
+            data = bytearray()
+            if not header.startswith(STREAM_MAGIC):
+                if not self.retrbinary('RETR ' + path, data.extend):
+                    return None
+                return bytes(data[offset:offset + length])
+            _, version, chunk_size, _ = STREAM_HEADER.unpack(header)
+            chunk_count = record_count(size, chunk_size, version)
+            start = min(offset // chunk_size, chunk_count - 1)
+            stop = max(start + 1, min(-(-(offset + length) // chunk_size), chunk_count))
+            self._retrieve_records(enc_path, header, (start, stop), chunk_count, size, data.extend)
+            offset -= start * chunk_size
+            return bytes(data[offset:offset + length])
+        except (error_perm, InvalidSignature) as e:
+            if not (isinstance(e, InvalidSignature) or str(e).startswith('555')):
+                raise e
+            print('SECURITY ALERT -- The file %s has been altered! Read aborted' % path, file=sys.stderr)
+            return None
+
+    def open_session(self, ticket=None):
+        """
+        Open another session of the logged in user on a new control connection, logging in with a session ticket
+        (see resume), so no keys are derived. The login file check is reported as in login, the metadata isn't
+        verified again. Used for transferring a file over several connections at once.
+        :param ticket: (str) session ticket (one is requested if not given)
+        :return: (MyFTPClient) the new session, in binary mode
+        """
+        if ticket is None:
+            ticket = self.voidcmd('TCKT')[4:].split()[0]
+        session = MyFTPClient(timeout=self.timeout, source_address=self.source_address)
+        session.connect(self.host, self.port)
+        session._set_cipher(self._cipher, self._names)
+        session._user = self._user
+        try:
+            session.resume(self._user, ticket)
+            try:
+                session.getresp()
+            except error_perm as e:
+                print('SECURITY ALERT -- ' + self.decrypt_server_message(str(e)[4:]), file=sys.stderr)
+            session.voidcmd('TYPE I')
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    def _open_sessions(self, count):
+        """
+        Open the given number of sessions at once (see open_session), with a single ticket.
+        :param count: (int) number of sessions
+        :return: (List(MyFTPClient)) the new sessions
+        """
+        if not count:
+            return []
+        ticket = self.voidcmd('TCKT')[4:].split()[0]
+        with ThreadPoolExecutor(count) as pool:
+            return list(pool.map(lambda _: self.open_session(ticket), range(count)))
+
+    @staticmethod
+    def _split_segments(chunk_count, streams):
+        """
+        :param chunk_count: (int) number of chunks in the file
+        :param streams: (int) number of connections to use
+        :return: (List(Tuple(int, int))) chunk ranges (start, stop) of the segments, at least one chunk each
+        """
+        streams = max(1, min(streams, chunk_count))
+        return [(chunk_count * i // streams, chunk_count * (i + 1) // streams) for i in range(streams)]
+
+    def store_segments(self, path, filename, streams=4):
+        """
+        Upload a file over several connections at once (STSG), so a large file isn't limited by the bandwidth
+        of a single TCP connection: the file is split into segments of whole chunks, encrypted and sent
+        concurrently, each by its own session (see open_session), at its offset in the stream.
+        The last segment ends with the file's MAC tag, and the file is completed with STSE once all were stored.
+        As with store_tagged, the metadata tag is not updated.
+        :param path: (str) path of the file on the server
+        :param filename: (str) filename of the local file to upload
+        :param streams: (int) number of connections to use
+        :return: (str) server response
+        """
+        encryptor = self._cipher.stream_encryptor()
+        chunk_count = stream_chunk_count(os.path.getsize(filename), encryptor.chunk_size)
+        segments = self._split_segments(chunk_count, streams)
+        enc_path = self._encrypt_path(path)
+        sessions = self._open_sessions(len(segments) - 1)
+        try:
+            # the first segment truncates the file, so the server must receive it before the others
+            conn = self.transfercmd('STSG ' + enc_path)
+            with ThreadPoolExecutor(max(1, len(sessions))) as pool:
+                futures = [pool.submit(session._store_segment, enc_path, filename, encryptor, segment, chunk_count)
+                           for session, segment in zip(sessions, segments[1:])]
+                self._store_segment(enc_path, filename, encryptor, segments[0], chunk_count, conn)
+                for future in futures:
+                    future.result()
+        finally:
+            for session in sessions:
+                session.close()
+        return self.voidcmd('STSE ' + enc_path)
+
+    def _store_segment(self, enc_path, filename, encryptor, segment, chunk_count, conn=None):
+        """
+        Encrypt and upload a segment of a file (see store_segments).
+        :param enc_path: (str) encrypted path of the file on the server
+        :param filename: (str) filename of the local file
+        :param encryptor: (StreamEncryptor) the file's stream encryptor (shared by all segments)
+        :param segment: (Tuple(int, int)) chunk range of the segment
+        :param chunk_count: (int) number of chunks in the file
+        :param conn: (socket) data connection, if the segment's STSG was already sent
+        :return: (str) server response
+        """
+        start, stop = segment
+        if conn is None:
+            conn = self.transfercmd('STSG ' + enc_path, record_offset(start, encryptor.chunk_size, encryptor.version))
+        with conn, open(filename, 'rb') as fp:
+            for record in encryptor.iter_range(fp, start, stop, chunk_count):
+                conn.sendall(record)
+            if stop == chunk_count:
+                conn.sendall(encryptor.file_tag(chunk_count))
+        return self.voidresp()
+
+    def retrieve_segments(self, path, filename, streams=4):
+        """
+        Download a file over several connections at once into a local file (RANG, then RETR): the stream header
+        is retrieved first, then segments of whole records are retrieved concurrently, each by its own session
+        (see open_session), and verified and decrypted into their place in the local file.
+        Every record is verified with its index, every segment is checked to end where the next one starts,
+        and the last one to end with the final record and the file's MAC tag, so the whole file is verified.
+        Files in the old format are downloaded with retrbinary.
+        Prints a security error message if the file data verification failed.
+        :param path: (str) path of the file on the server
+        :param filename: (str) filename of the local file to write
+        :param streams: (int) number of connections to use
+        :return: (str) server response, None if the verification failed
+        """
+        enc_path = self._encrypt_path(path)
+        try:
+            size = int(self.sendcmd('SIZE ' + enc_path)[4:])
+            header = self._retrieve_header(enc_path)
+            with open(filename, 'wb') as outfile:
+                if not header.startswith(STREAM_MAGIC):
+                    return self.retrbinary('RETR ' + path, outfile.write)
+            decryptor = self._cipher.stream_decryptor(header)
+            chunk_count = record_count(size, decryptor.chunk_size, decryptor.version)
+            segments = self._split_segments(chunk_count, streams)
+            sessions = self._open_sessions(len(segments) - 1)
+            try:
+                with ThreadPoolExecutor(max(1, len(sessions))) as pool:
+                    futures = [pool.submit(session._retrieve_segment, enc_path, filename, header, segment,
+                                           chunk_count, size)
+                               for session, segment in zip(sessions, segments[1:])]
+                    resp = self._retrieve_segment(enc_path, filename, header, segments[0], chunk_count, size)
+                    for future in futures:
+                        future.result()
+            finally:
+                for session in sessions:
+                    session.close()
+            return resp
+        except (error_perm, InvalidSignature) as e:
+            if not (isinstance(e, InvalidSignature) or str(e).startswith('555')):
+                raise e
+            print('SECURITY ALERT -- The file %s has been altered! Download aborted' % path, file=sys.stderr)
+            return None
+
+    def _retrieve_segment(self, enc_path, filename, header, segment, chunk_count, size):
+        """
+        Download, verify and decrypt a segment of a file into its place in the local file (see retrieve_segments).
+        :param filename: (str) filename of the local file
+        (see _retrieve_records for the other parameters)
+        :return: (str) server response
+        """
+        with open(filename, 'r+b') as outfile:
+            outfile.seek(segment[0] * STREAM_HEADER.unpack(header)[2])
+            return self._retrieve_records(enc_path, header, segment, chunk_count, size, outfile.write)
+
+    def _retrieve_records(self, enc_path, header, segment, chunk_count, size, callback):
+        """
+        Retrieve a range of records of a file (RANG, then RETR), verifying and decrypting them as they arrive.
+        The range is checked to end right before the record following it, or with the final record and the file's
+        MAC tag if it's the last one, so no record can be left out. An exception is raised if the verification failed.
+        :param enc_path: (str) encrypted path of the file on the server
+        :param header: (bytes) the file's stream header
+        :param segment: (Tuple(int, int)) chunk range of the records
+        :param chunk_count: (int) number of chunks in the file
+        :param size: (int) stored size of the file
+        :param callback: (Callable) called on the decrypted data
+        :return: (str) server response
+        """
+        start, stop = segment
+        last = stop == chunk_count
+        decryptor = self._cipher.stream_decryptor(header, start, has_trailer=last)
+        errors = []
+
+        def on_data(data):
+            # keep draining the data connection after a failure, so the control connection stays in sync
+            if errors:
+                return
+            try:
+                callback(decryptor.update(data))
+            except InvalidSignature as e:
+                errors.append(e)
+
+        resp = self._retrieve_range(enc_path, record_offset(start, decryptor.chunk_size, decryptor.version),
+                                    size + TAG_SIZE if last else record_offset(stop, decryptor.chunk_size,
+                                                                               decryptor.version), on_data)
+        if errors:
+            raise errors[0]
+        if last:
+            callback(decryptor.finalize())
+        else:
+            decryptor.finalize_segment(stop)
+        return resp
+
+    def _retrieve_header(self, enc_path):
+        """
+        :param enc_path: (str) encrypted path of the file on the server
+        :return: (bytes) the file's stream header (or as many bytes of a file in the old format)
+        """
+        header = bytearray()
+        self._retrieve_range(enc_path, 0, STREAM_HEADER.size, header.extend)
+        return bytes(header)
+
+    def _retrieve_range(self, enc_path, start, stop, callback, blocksize=8192):
+        """
+        Retrieve a byte range of a file as stored on the server, followed by its MAC tag (RANG, then RETR).
+        :param enc_path: (str) encrypted path of the file on the server
+        :param start: (int) offset of the first byte
+        :param stop: (int) offset following the last byte
+        :param callback: (Callable) called on every block of data received
+        :param blocksize: (int) maximal block size
+        :return: (str) server response
+        """
+        self.sendcmd('RANG %d %d' % (start, stop - 1))
+        with self.transfercmd('RETR ' + enc_path) as conn:
+            while True:
+                data = conn.recv(blocksize)
+                if not data:
+                    break
+                callback(data)
+        return self.voidresp()
 
     def retrlines(self, cmd, callback=None):
         """
-        Decrypt filenames received from LIST or NLST commands and return the result.
+        Encrypt the listed path (if any) and decrypt filenames received from LIST, NLST or MLSD commands
+        and return the result. The listing is decrypted as a batch once received (see _decrypt_listing).
         """
-        if cmd not in ('LIST', 'NLST'):
+        listcmd, _, path = cmd.partition(' ')
+        if listcmd not in ('LIST', 'NLST', 'MLSD'):
             return super().retrlines(cmd, callback)
         if callback is None:
             callback = print
+        if path:
+            cmd = ' '.join((listcmd, self._encrypt_path(path)))
 
-        return super().retrlines(cmd, lambda line: callback(self._decrypt_path(line)))
+        lines = []
+        resp = super().retrlines(cmd, lines.append)
+        for line in self._decrypt_listing(lines):
+            callback(line)
+        return resp
+
+    def quit(self):
+        """
+        Log out, forgetting the filename encryptions of this session's cipher.
+        """
+        try:
+            return super().quit()
+        finally:
+            self._names.clear()
 
     def exchange_meta_tag(self):
         """"
-        Send a MAC tag for the server files' metadata by requesting the metadata
-        and running the HMAC algorithm on it.
+        Send a MAC tag for the server files' metadata.
+        The metadata is authenticated with a Merkle tree: the server sends only the entries changed since the last
+        tag, with the siblings along their paths (MTREE). They are checked to start from the root verified or
+        tagged before, and the new root is MACed, so the cost doesn't grow with the number of files.
         This exchange follows every updating operation: storbinary, rename, delete, mkd, rmd
         :return: (Union(str, None)) server response or None on error
         """
-        with io.BytesIO() as buf:
-            try:
-                return super().retrbinary('META', buf.write, 8192, None)
-            except error_reply as e:
-                if str(e)[0] != '3':
-                    return None
-                buf.flush()
-                metatag = self._cipher.get_hmac_tag(buf.getvalue())
-                return self.voidcmd('METATAG ' + metatag.hex())
+        resp, tree = self._retrieve_json('MTREE')
+        updates = tree['updates']
+        if not updates:
+            return resp
+        try:
+            old_root, new_root = apply_tree_updates(updates)
+            if self._tree_root is not None and old_root != self._tree_root:
+                # the metadata was changed by another session since, so check the stored tag instead
+                # (sent along by the server as of the same changes, so another session can't tag in between)
+                self._authenticate_tree_root(
+                    old_root, self._unpack_tree_tag(bytes.fromhex(tree['tag'])) if 'tag' in tree else None)
+        except InvalidSignature:
+            print('SECURITY ALERT -- Filesystem may be compromised', file=sys.stderr)
+            return None
+        return self._send_tree_tag(new_root)
 
     def login_tag_verify(self):
         """
         Authenticate the files on server by requesting the file metadata and its tag
         and calling the HMAC verification method on them.
+        With a tree tag, all entries are requested and the root of their Merkle tree is verified (LGTREE).
+        Otherwise (the db was last tagged as a whole, by an older client) the whole db is verified as before,
+        the entries sent with LGTREE are checked to be those of the verified db, and the tree's root is tagged
+        from now on.
         Prints a security error message if the authentication failed.
         """
-        with io.BytesIO() as buf:
-            super().retrbinary('LGMETA', buf.write, 8192, None)
-            self.voidresp()
-            buf.flush()
-            metatag = bytes.fromhex(self.voidcmd('LGVF')[4:])
-            try:
+        metatag = bytes.fromhex(self.voidcmd('LGVF')[4:])
+        try:
+            if len(metatag) == TREE_TAG.size and metatag.startswith(TREE_TAG_MAGIC):
+                self._verify_tree(TREE_TAG.unpack(metatag)[2])
+                return
+            with io.BytesIO() as buf:
+                super().retrbinary('LGMETA', buf.write, 8192, None)
+                self.voidresp()
+                buf.flush()
+                rows = None
                 if metatag:
                     self._cipher.authenticate_hmac(buf.getvalue(), metatag)
-            except InvalidSignature:
-                print('SECURITY ALERT -- Filesystem may be compromised', file=sys.stderr)
+                    rows = _legacy_tree_rows(buf.getvalue())
+            self._verify_tree(None, rows)
+        except InvalidSignature:
+            print('SECURITY ALERT -- Filesystem may be compromised', file=sys.stderr)
+
+    def _verify_tree(self, metatag, rows=None):
+        """
+        Verify the file metadata tree: compute the root of all entries, check that the changes since the last tag
+        lead to it and that the tag matches the root they start from. The root is tagged anew if it changed.
+        :param metatag: (Union(bytes, None)) the tree tag, None to tag the root without verifying it
+        :param rows: (List(List)) entries verified otherwise (see _legacy_tree_rows), which must be the server's
+        """
+        tree = self._retrieve_json('LGTREE')[1]
+        if metatag is not None and 'tag' in tree:
+            # the tag as of the same changes (another session may have tagged newer ones since LGVF)
+            metatag = self._unpack_tree_tag(bytes.fromhex(tree['tag']))
+        root = merkle_root(tree['rows'])
+        if rows is not None and merkle_root(rows) != root:
+            raise InvalidSignature('The entries are not those of the verified metadata')
+        tagged_root = root
+        if tree['updates']:
+            tagged_root, new_root = apply_tree_updates(tree['updates'])
+            if new_root != root:
+                raise InvalidSignature('Inconsistent tree updates')
+        if metatag is not None:
+            self._authenticate_tree_root(tagged_root, metatag)
+        if metatag is None or tree['updates']:
+            self._send_tree_tag(root)
+        self._tree_root = root
+
+    def _authenticate_tree_root(self, root, metatag=None):
+        """
+        Verify a root of the file metadata tree against the stored tag. An exception is raised if verification fails.
+        :param root: (bytes) the root
+        :param metatag: (bytes) the stored tag (requested if not given)
+        """
+        if metatag is None:
+            metatag = self._unpack_tree_tag(bytes.fromhex(self.voidcmd('LGVF')[4:]))
+        self._cipher.authenticate_hmac(tree_tag_data(root), metatag)
+
+    @staticmethod
+    def _unpack_tree_tag(mtag):
+        """
+        :param mtag: (bytes) contents of the server's tag file
+        :return: (bytes) the tree tag in it. An exception is raised if it holds no tree tag.
+        """
+        if len(mtag) != TREE_TAG.size or not mtag.startswith(TREE_TAG_MAGIC):
+            raise InvalidSignature('Not a tree tag')
+        return TREE_TAG.unpack(mtag)[2]
+
+    def _send_tree_tag(self, root):
+        """
+        MAC a root of the file metadata tree and send the tag (following MTREE or LGTREE).
+        :param root: (bytes) the root
+        :return: (str) server response
+        """
+        resp = self.voidcmd('TREETAG ' + tree_tag(self._cipher, root).hex())
+        self._tree_root = root
+        return resp
+
+    def _retrieve_json(self, cmd):
+        """
+        :param cmd: (str) a command transferring JSON data
+        :return: (Tuple(str, object)) server response and the data
+        """
+        with io.BytesIO() as buf:
+            resp = super().retrbinary(cmd, buf.write, 8192, None)
+            return resp, json.loads(buf.getvalue())
 
     def rename(self, fromname, toname):
         super().rename(self._encrypt_path(fromname), self._encrypt_path(toname))
@@ -207,31 +913,212 @@ class MyFTPClient(FTP):
     def nlst(self, *args):
         return ', '.join(super().nlst(*args))
 
-    def upload_file(self, filename):
+    def upload_file(self, filename, resume=False):
         """
         Call storbinary to upload a file.
         :param filename: (str) filename of the local file to upload
+        :param resume: (bool) whether to resume an interrupted upload of the file (see store_resumed)
         :return: (str) server response
         """
-        return self.storbinary('STOR ' + filename, open(filename, 'rb'))
+        with open(filename, 'rb') as fp:
+            return self.storbinary('STOR ' + filename, fp, rest=0 if resume else None)
 
-    def download_file(self, filename):
+    def upload_files(self, *filenames):
+        """
+        Upload several files back to back (see store_tagged), then update the metadata tag once for all of them.
+        :param filenames: (str) filenames of the local files to upload
+        :return: (str) server response
+        """
+        self.voidcmd('TYPE I')
+        for filename in filenames:
+            with open(filename, 'rb') as fp:
+                self.store_tagged(filename, fp)
+        return self.exchange_meta_tag()
+
+    def download_file(self, filename, resume=False):
         """
         Call retrbinary to download a file into a local file.
         If the download failed, delete the local file.
         :param filename: (str) filename (or path) of the requested file to download
+        :param resume: (bool) whether to resume an interrupted download, appending to the local file
         :return: (str) server response
         """
+        local_filename = filename.split('/')[-1]
+        rest = os.path.getsize(local_filename) if resume and os.path.exists(local_filename) else None
         try:
-            with open(filename.split('/')[-1], 'wb') as outfile:
-                resp = self.retrbinary('RETR ' + filename, outfile.write)
+            with open(local_filename, 'ab' if rest else 'wb') as outfile:
+                resp = self.retrbinary('RETR ' + filename, outfile.write, rest=rest)
             if not resp:
-                os.remove(filename.split('/')[-1])
+                os.remove(local_filename)
             return resp
         except error_perm as e:
-            os.remove(filename.split('/')[-1])
+            os.remove(local_filename)
             raise e
 
+    def upload_file_parallel(self, filename, streams=4):
+        """
+        Upload a large file over several connections at once (see store_segments), then call exchange_meta_tag.
+        :param filename: (str) filename of the local file to upload
+        :param streams: (int) number of connections to use
+        :return: (str) server response
+        """
+        self.voidcmd('TYPE I')
+        self.store_segments(filename, filename, streams)
+        return self.exchange_meta_tag()
+
+    def download_file_parallel(self, filename, streams=4):
+        """
+        Download a large file over several connections at once into a local file (see retrieve_segments).
+        If the download failed, delete the local file.
+        :param filename: (str) filename (or path) of the requested file to download
+        :param streams: (int) number of connections to use
+        :return: (str) server response
+        """
+        self.voidcmd('TYPE I')
+        local_filename = filename.split('/')[-1]
+        resp = None
+        try:
+            resp = self.retrieve_segments(filename, local_filename, streams)
+            return resp
+        finally:
+            if not resp and os.path.exists(local_filename):
+                os.remove(local_filename)
+
+    def mirror(self, local_dir, remote_dir='', workers=8):
+        """
+        Mirror a local directory tree to the server: the local tree is walked and compared with the remote one
+        (listed with MLSD), and only new or changed files are uploaded, by several sessions at once
+        (see _run_in_sessions). The metadata tag is updated once at the end.
+        A file is changed if its stored size isn't the size of its encrypted stream, or if it was modified after
+        it was uploaded (as the file tag only authenticates the stream header and length, it can't tell).
+        Remote files missing from the local tree are kept.
+        :param local_dir: (str) the local directory
+        :param remote_dir: (str) the remote directory (relative to the working directory, created if missing)
+        :param workers: (int) number of sessions uploading at once
+        :return: (List(str)) paths of the uploaded files, relative to the directories
+        """
+        remote_dir = posixpath.join(self._decrypt_path(self.pwd()), remote_dir)
+        remote = self._walk_remote(remote_dir)
+        new_dirs = [''] if remote is None else []
+        remote = remote or {}
+        changed = []
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            rel_dir = os.path.relpath(dirpath, local_dir).replace(os.sep, '/')
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            if rel_dir and rel_dir not in remote:
+                new_dirs.append(rel_dir)
+            for filename in filenames:
+                rel_path = posixpath.join(rel_dir, filename)
+                st = os.stat(os.path.join(dirpath, filename))
+                entry = remote.get(rel_path)
+                if entry is None or entry[1] != stream_size(st.st_size) or int(st.st_mtime) > entry[2]:
+                    changed.append(rel_path)
+        self.voidcmd('TYPE I')
+        for rel_dir in new_dirs:
+            FTP.mkd(self, self._encrypt_path(posixpath.normpath(posixpath.join(remote_dir, rel_dir))))
+
+        def upload(session, rel_path):
+            with open(os.path.join(local_dir, *rel_path.split('/')), 'rb') as fp:
+                return session.store_tagged(posixpath.join(remote_dir, rel_path), fp)
+
+        self._run_in_sessions(upload, changed, workers)
+        if new_dirs or changed:
+            self.exchange_meta_tag()
+        return changed
+
+    def mirror_download(self, remote_dir, local_dir, workers=8):
+        """
+        Mirror a remote directory tree to a local directory: only files missing locally, whose local size isn't
+        the one of their stored stream, or which were uploaded after the local file was modified are downloaded,
+        by several sessions at once (see _run_in_sessions). Files whose verification failed are deleted.
+        :param remote_dir: (str) the remote directory (relative to the working directory)
+        :param local_dir: (str) the local directory (created if missing)
+        :param workers: (int) number of sessions downloading at once
+        :return: (List(str)) paths of the downloaded files (relative to the directories)
+        """
+        remote_dir = posixpath.join(self._decrypt_path(self.pwd()), remote_dir)
+        remote = self._walk_remote(remote_dir)
+        if remote is None:
+            raise error_perm('550 No such directory.')
+        changed = []
+        for rel_path, (entry_type, size, modify) in sorted(remote.items()):
+            local_path = os.path.join(local_dir, *rel_path.split('/'))
+            if entry_type == 'dir':
+                os.makedirs(local_path, exist_ok=True)
+            elif not os.path.isfile(local_path) or modify > os.path.getmtime(local_path) \
+                    or size not in [stream_size(os.path.getsize(local_path), version=version)
+                                    for version in RECORD_LAYOUTS]:
+                changed.append(rel_path)
+        os.makedirs(local_dir, exist_ok=True)
+
+        def download(session, rel_path):
+            local_path = os.path.join(local_dir, *rel_path.split('/'))
+            with open(local_path, 'wb') as outfile:
+                resp = session.retrbinary('RETR ' + posixpath.join(remote_dir, rel_path), outfile.write)
+            if not resp:
+                os.remove(local_path)
+            return resp
+
+        self.voidcmd('TYPE I')
+        return [rel_path for rel_path, resp in zip(changed, self._run_in_sessions(download, changed, workers)) if resp]
+
+    def _walk_remote(self, path):
+        """
+        List a remote directory tree (MLSD for every directory).
+        :param path: (str) absolute path of the directory
+        :return: (Dict(str, Tuple(str, int, float))) path relative to the directory -> type ('file' or 'dir'),
+                 stored size and modification time (of files) of every entry, None if the directory is missing
+        """
+        entries = {}
+        dirs = ['']
+        while dirs:
+            rel_dir = dirs.pop()
+            try:
+                listing = list(self.mlsd(posixpath.join(path, rel_dir), facts=['type', 'size', 'modify']))
+            except error_perm:
+                if rel_dir:
+                    raise
+                return None
+            for name, facts in listing:
+                rel_path = posixpath.join(rel_dir, name)
+                if facts['type'] == 'dir':
+                    entries[rel_path] = ('dir', None, None)
+                    dirs.append(rel_path)
+                elif facts['type'] == 'file':
+                    modify = calendar.timegm(time.strptime(facts['modify'][:14], '%Y%m%d%H%M%S'))
+                    entries[rel_path] = ('file', int(facts['size']), modify)
+        return entries
+
+    def _run_in_sessions(self, fun, items, workers):
+        """
+        Call fun(session, item) for every item, spread over several sessions (this one and new ones, see
+        open_session), each used by one thread at a time.
+        :param fun: (Callable) the operation
+        :param items: (List) the items to run it on
+        :param workers: (int) maximal number of sessions
+        :return: (List) the results, in the order of the items
+        """
+        if not items:
+            return []
+        sessions = [self] + self._open_sessions(min(workers, len(items)) - 1)
+        idle = queue.SimpleQueue()
+        for session in sessions:
+            idle.put(session)
+
+        def run(item):
+            session = idle.get()
+            try:
+                return fun(session, item)
+            finally:
+                idle.put(session)
+
+        try:
+            with ThreadPoolExecutor(len(sessions)) as pool:
+                return list(pool.map(run, items))
+        finally:
+            for session in sessions[1:]:
+                session.close()
+
     def client_op(self, *args):
         """
         Call an ftp method an print its response (decrypt if necessary).
@@ -299,6 +1186,11 @@ logged_in_menu = [
         'fun': MyFTPClient.client_op,
         'args': ['nlst']
     },
+    {
+        'name': 'List files with details',
+        'fun': MyFTPClient.client_op,
+        'args': ['dir']
+    },
     {
         'name': 'Upload file',
         'fun': MyFTPClient.client_op,
@@ -309,6 +1201,11 @@ logged_in_menu = [
         'fun': MyFTPClient.client_op,
         'args': ['download_file', 'filename']
     },
+    {
+        'name': 'Mirror folder to the server',
+        'fun': MyFTPClient.client_op,
+        'args': ['mirror', 'local folder', 'remote folder']
+    },
     {
         'name': 'Rename file or folder',
         'fun': MyFTPClient.client_op,
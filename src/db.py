@@ -1,29 +1,218 @@
 import sqlite3
 import os
+import sys
 import json
+import shutil
+import metrics
+from collections import OrderedDict
+from mycrypto import TREE_DEPTH, TREE_EMPTY, TREE_TAG, TREE_TAG_MAGIC, tree_leaf, tree_node, merkle_levels
 
 users_db = os.path.realpath('../server/users.db')
 
+# seconds to wait for a lock held by another connection (e.g. a session in another server process)
+DB_BUSY_TIMEOUT = 30
+
+# entries of a user's tree kept in memory per session for path translation (see PathCache)
+PATH_CACHE_SIZE = 10000
+
+# the users db connection is shared by all sessions of a process (each server process runs a single IOLoop)
+_users_dbcon = None
+_users_dbcon_path = None
+_users_dbcon_pid = None
+
+
+def connect(path):
+    """
+    Open a long-lived connection to an SQLite database.
+    Statements are prepared once and cached by the connection (per SQL string), so the queries below
+    are only compiled on first use. Use the connection as a context manager for explicit transactions.
+    Several server processes may use the same db: a write waits for the others' (up to DB_BUSY_TIMEOUT),
+    and transactions which read before writing start with BEGIN IMMEDIATE, so what they read can't change
+    before they write.
+    :param path: (str) database file path
+    :return: (sqlite3.Connection) the connection
+    """
+    dbcon = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, cached_statements=256)
+    if metrics.enabled:
+        dbcon.set_trace_callback(metrics.count_query)
+    # only affects WAL mode, where it is still safe against corruption
+    dbcon.execute("""PRAGMA synchronous = NORMAL""")
+    return dbcon
+
+
+def users_dbcon():
+    """
+    :return: (sqlite3.Connection) the connection to the users db (opened on first use, in WAL mode,
+             and again in a forked process)
+    """
+    global _users_dbcon, _users_dbcon_path, _users_dbcon_pid
+    if _users_dbcon_pid != os.getpid():
+        # a connection must not be used across fork(), nor closed by the child: leave it to the parent
+        _users_dbcon = None
+    if _users_dbcon is None or _users_dbcon_path != users_db:
+        if _users_dbcon is not None:
+            _users_dbcon.close()
+        _users_dbcon = connect(users_db)
+        _users_dbcon.execute("""PRAGMA journal_mode = WAL""")
+        _users_dbcon_path = users_db
+        _users_dbcon_pid = os.getpid()
+    return _users_dbcon
+
+
+def close_users_dbcon():
+    """
+    Close the connection to the users db (it's opened again when needed), e.g. before forking server processes.
+    """
+    global _users_dbcon
+    if _users_dbcon is not None and _users_dbcon_pid == os.getpid():
+        _users_dbcon.close()
+    _users_dbcon = None
+
+
+class PathCache(object):
+    """
+    A bounded in-memory copy of entries of the Filenums tree, for translating paths without querying the db.
+    Entries are kept the way the db keeps them, as a trie of parent pointers: every entry holds only its own name
+    (interned), keyed by its parent's file number, so paths share their prefixes' entries.
+    Only entries known to exist are kept (a path missing from the cache is resolved from the db), and the least
+    recently used ones are evicted first.
+    """
+
+    def __init__(self, max_size=PATH_CACHE_SIZE):
+        self.max_size = max_size
+        self._children = OrderedDict()  # (parent, name) -> filenum
+        self._entries = {}  # filenum -> (parent, name)
+
+    def __len__(self):
+        return len(self._children)
+
+    def child(self, parent, name):
+        """
+        :return: (Union(int, None)) file number of the entry of the given name in the given directory, if cached
+        """
+        key = (parent, name)
+        filenum = self._children.get(key)
+        if filenum is not None:
+            self._children.move_to_end(key)
+        return filenum
+
+    def entry(self, filenum):
+        """
+        :return: (Union(Tuple(int, str), None)) the parent and name of the given entry, if cached
+        """
+        return self._entries.get(filenum)
+
+    def add(self, filenum, parent, name):
+        """
+        Add an entry, or move it to its new place.
+        """
+        key = (parent, sys.intern(name))
+        old_key = self._entries.get(filenum)
+        if old_key is not None and old_key != key:
+            del self._children[old_key]
+        old_filenum = self._children.get(key)
+        if old_filenum is not None and old_filenum != filenum:
+            del self._entries[old_filenum]
+        self._children[key] = filenum
+        self._children.move_to_end(key)
+        self._entries[filenum] = key
+        while len(self._children) > self.max_size:
+            _, filenum = self._children.popitem(last=False)
+            del self._entries[filenum]
+
+    def discard(self, filenum):
+        key = self._entries.pop(filenum, None)
+        if key is not None:
+            del self._children[key]
+
+    def clear(self):
+        self._children.clear()
+        self._entries.clear()
+
 
 class FileMetaHandler(object):
     """
     Handles file metadata storage per user (root) with SQLite.
     File metadata includes 2 tables: Filenums and FileMetadata.
     Filenums contains mappings between FTP file paths and physical paths (numbers, AKA numpaths). More details
-    explained in the MyDBFS class in server.py.
+    explained in the MyDBFS class in server.py. It's stored as a tree: every entry (file number) is keyed by
+    its parent directory's file number and its name, and paths are resolved by walking it.
     FileMetadata stores file sizes and MAC tags for uploaded files.
+    Both are authenticated by the user with a Merkle tree over all entries (see merkle_levels in mycrypto.py),
+    kept up to date in TreeNodes. Every change to it is recorded in TreeJournal, with the entry's old leaf and
+    the siblings along its path, until the user MACs the new root: so the user only handles the entries changed
+    since the last tag, instead of the whole db.
+    A separate db (not sent to the user) keeps a snapshot of the files' stats on disk for the login check
+    (see find_anomalies).
+    A single connection per db is kept open for the whole session (see close()).
+    Paths are translated through a cache of the Filenums tree (see PathCache), updated along with the db.
+    It's dropped whenever another connection (another session of the user) changed the db, which SQLite tells
+    without reading it (PRAGMA data_version).
+    Sessions of the same user may run in different server processes: every change is a single transaction
+    (the ones reading before writing start with BEGIN IMMEDIATE), and the metadata tag file is replaced
+    atomically, under the db's write lock.
     """
 
     def __init__(self, homedir):
         self.homedir = str(homedir)
         self.root = os.path.realpath(self.homedir)
+        self.root_filenum = int(os.path.basename(self.root))
         self.meta_db_path = self.root + os.sep + 'file_metadata.db'
+        self.tagged_db_path = self.root + os.sep + 'file_metadata.tagged.db'
+        self.stats_db_path = self.root + os.sep + 'file_stats.db'
+        self.mtag_path = self.root + os.sep + 'mtag'
+        self._dbcon = None
+        self._statscon = None
+        self._paths = PathCache()
+        self._data_version = None
+
+    @property
+    def dbcon(self):
+        if self._dbcon is None:
+            self._dbcon = connect(self.meta_db_path)
+        return self._dbcon
+
+    @property
+    def statscon(self):
+        if self._statscon is None:
+            self._statscon = connect(self.stats_db_path)
+            self._statscon.execute("""CREATE TABLE IF NOT EXISTS Stats (
+                                    filenum INTEGER PRIMARY KEY NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    mtime INTEGER NOT NULL,
+                                    ctime INTEGER NOT NULL)""")
+        return self._statscon
+
+    def close(self):
+        if self._dbcon is not None:
+            self._dbcon.close()
+            self._dbcon = None
+            self._data_version = None
+        if self._statscon is not None:
+            self._statscon.close()
+            self._statscon = None
+
+    def sync_db_file(self, enable_wal=False):
+        """
+        Make sure the db file itself holds all committed data, before it is sent to the user as a whole
+        (in WAL mode, recent transactions may only be in the -wal file).
+        :param enable_wal: (bool) switch the db to WAL mode first. This changes the file, so it should only
+                           be done right before the user re-tags it (META), not before verification (LGMETA).
+        """
+        if enable_wal:
+            self.dbcon.execute("""PRAGMA journal_mode = WAL""")
+        self.dbcon.execute("""PRAGMA wal_checkpoint(TRUNCATE)""")
 
     def create_file_metadata(self):
+        """
+        Create the file metadata db (on registration) or upgrade an existing one to the current schema
+        (on login), then create the metadata tag file if missing.
+        """
         file_meta_existed = os.path.isfile(self.meta_db_path)
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
             if not file_meta_existed:
+                cursor.execute("""PRAGMA journal_mode = WAL""")
                 cursor.execute("""CREATE TABLE Filenums (
                                             filenum INTEGER PRIMARY KEY NOT NULL,
                                             numpath TEXT NOT NULL,
@@ -34,129 +223,667 @@ class FileMetaHandler(object):
                                 filenum INTEGER NOT NULL,
                                 FOREIGN KEY (filenum) REFERENCES Filenums(filenum))""")
                 cursor.execute("""INSERT INTO Filenums VALUES (?, ?, ?)""", (int(self.homedir), self.root, '/'))
-        open(self.root + os.sep + 'mtag', 'wb')
+        self.migrate(keep_tagged_copy=file_meta_existed)
+        self._paths.clear()
+        # (appending doesn't clear a tag stored meanwhile by another session)
+        open(self.mtag_path, 'ab').close()
+
+    @property
+    def schema_version(self):
+        return self.dbcon.execute("""PRAGMA user_version""").fetchone()[0]
+
+    def migrate(self, keep_tagged_copy=True):
+        """
+        Upgrade the db to the current schema version, running each migration in its own transaction.
+        Migrations change the db file, which the user has MACed as a whole. So unless one exists already,
+        a copy of the tagged file is kept and sent for verification (LGMETA) until the user re-tags the db.
+        :param keep_tagged_copy: (bool) keep a copy of the tagged file before migrating
+        """
+        version = self.schema_version
+        if version >= len(MIGRATIONS):
+            return
+        if keep_tagged_copy and not os.path.isfile(self.tagged_db_path):
+            self.sync_db_file()
+            shutil.copyfile(self.meta_db_path, self.tagged_db_path)
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            with self.dbcon as dbcon:
+                cursor = dbcon.cursor()
+                cursor.execute("""BEGIN IMMEDIATE""")
+                # another session may have migrated the db meanwhile
+                if cursor.execute("""PRAGMA user_version""").fetchone()[0] < version:
+                    migration(self, cursor)
+                    cursor.execute("""PRAGMA user_version = %d""" % version)
+
+    def _migrate_parent_pointers(self, cursor):
+        """
+        Schema version 1: add a parent filenum column to Filenums, and indexes for all lookups.
+        """
+        cursor.execute("""ALTER TABLE Filenums ADD COLUMN parent INTEGER REFERENCES Filenums(filenum)""")
+        cursor.execute("""SELECT filenum, numpath FROM Filenums WHERE ftppath != '/'""")
+        cursor.executemany("""UPDATE Filenums SET parent = (?) WHERE filenum = (?)""",
+                           [(int(numpath.split(os.sep)[-2]), filenum) for filenum, numpath in cursor.fetchall()])
+        # renaming over an existing file used to leave a duplicate entry, keep the newest one
+        cursor.execute("""DELETE FROM FileMetadata WHERE rowid NOT IN
+                          (SELECT MAX(rowid) FROM FileMetadata GROUP BY filenum)""")
+        cursor.execute("""CREATE UNIQUE INDEX FilenumsFtppath ON Filenums(ftppath)""")
+        cursor.execute("""CREATE UNIQUE INDEX FilenumsNumpath ON Filenums(numpath)""")
+        cursor.execute("""CREATE INDEX FilenumsParent ON Filenums(parent)""")
+        cursor.execute("""CREATE UNIQUE INDEX FileMetadataFilenum ON FileMetadata(filenum)""")
+
+    def _migrate_tree(self, cursor):
+        """
+        Schema version 2: key entries by (parent, name) instead of storing full ftp paths and numpaths,
+        so moving a directory only changes its own row. Paths are resolved by walking the tree.
+        Parents are taken from where entries actually are on disk, which fixes entries left behind by
+        directory renames before this version.
+        """
+        on_disk = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [dirname for dirname in dirnames if dirname.isdigit()]
+            for filenum in dirnames + filenames:
+                if filenum.isdigit():
+                    on_disk[int(filenum)] = int(os.path.basename(dirpath))
+        cursor.execute("""SELECT filenum, parent, ftppath FROM Filenums""")
+        entries = [(filenum, on_disk.get(filenum, parent), ftppath.split('/')[-1])
+                   for filenum, parent, ftppath in cursor.fetchall()]
+        cursor.execute("""CREATE TABLE Tree (
+                          filenum INTEGER PRIMARY KEY NOT NULL,
+                          parent INTEGER REFERENCES Tree(filenum),
+                          name TEXT NOT NULL,
+                          UNIQUE (parent, name))""")
+        # entries present on disk win over stale ones with the same path
+        entries.sort(key=lambda entry: entry[0] not in on_disk)
+        cursor.executemany("""INSERT OR IGNORE INTO Tree VALUES (?, ?, ?)""", entries)
+        cursor.execute("""DROP TABLE Filenums""")
+        cursor.execute("""ALTER TABLE Tree RENAME TO Filenums""")
+        cursor.execute("""DELETE FROM FileMetadata WHERE filenum NOT IN (SELECT filenum FROM Filenums)""")
+
+    def _migrate_autoincrement(self, cursor):
+        """
+        Schema version 3: allocate file numbers with AUTOINCREMENT when inserting entries
+        (instead of a separate MAX(filenum) query), so numbers are never reused, even across concurrent sessions.
+        """
+        cursor.execute("""CREATE TABLE Tree (
+                          filenum INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                          parent INTEGER REFERENCES Tree(filenum),
+                          name TEXT NOT NULL,
+                          UNIQUE (parent, name))""")
+        cursor.execute("""INSERT INTO Tree SELECT filenum, parent, name FROM Filenums""")
+        cursor.execute("""DROP TABLE Filenums""")
+        cursor.execute("""ALTER TABLE Tree RENAME TO Filenums""")
+
+    def _migrate_merkle_tree(self, cursor):
+        """
+        Schema version 4: store the Merkle tree of all entries and a journal of its changes.
+        The user keeps MACing the db file as a whole until they tag the tree's root (see store_tree_tag).
+        """
+        cursor.execute("""CREATE TABLE TreeNodes (
+                          level INTEGER NOT NULL,
+                          idx INTEGER NOT NULL,
+                          hash BLOB NOT NULL,
+                          PRIMARY KEY (level, idx)) WITHOUT ROWID""")
+        cursor.execute("""CREATE TABLE TreeJournal (
+                          seq INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                          filenum INTEGER NOT NULL,
+                          old_leaf BLOB,
+                          row TEXT,
+                          siblings TEXT NOT NULL)""")
+        rows = self._fetch_tree_rows(cursor)
+        for level, nodes in enumerate(merkle_levels({row[0]: tree_leaf(row) for row in rows})):
+            cursor.executemany("""INSERT INTO TreeNodes VALUES (?, ?, ?)""",
+                               [(level, index, node) for index, node in nodes.items() if node != TREE_EMPTY])
+
+    @staticmethod
+    def _fetch_tree_rows(cursor, _filenum=None):
+        """
+        :return: (List(List)) the entries as hashed into the Merkle tree (see tree_leaf in mycrypto.py):
+                 all of them, or only the given file number's
+        """
+        query = """SELECT Filenums.filenum, parent, name, tag, size FROM Filenums
+                   LEFT JOIN FileMetadata ON FileMetadata.filenum = Filenums.filenum"""
+        if _filenum is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query + """ WHERE Filenums.filenum = (?)""", (_filenum,))
+        return [list(row) for row in cursor.fetchall()]
+
+    def _update_tree(self, cursor, *filenums):
+        """
+        Update the Merkle tree after entries changed (in the same transaction), and record the changes.
+        Only the path from the entry's leaf to the root is rewritten, so an update is logarithmic in the tree's size.
+        :param filenums: (int) file numbers of the entries which changed
+        """
+        for filenum in filenums:
+            filenum = int(filenum)
+            if not 0 <= filenum < 2 ** TREE_DEPTH:
+                raise ValueError('file number out of range: %d' % filenum)
+            row = self._fetch_tree_rows(cursor, filenum)
+            row = row[0] if row else None
+            node = tree_leaf(row) if row else TREE_EMPTY
+            cursor.execute("""SELECT hash FROM TreeNodes WHERE level = 0 AND idx = (?)""", (filenum,))
+            old_leaf = cursor.fetchone()
+            if (old_leaf[0] if old_leaf else TREE_EMPTY) == node:
+                continue
+
+            # the siblings along the path, fetched at once
+            path = [(level, filenum >> level ^ 1) for level in range(TREE_DEPTH)]
+            cursor.execute("""SELECT level, hash FROM TreeNodes
+                              WHERE (level, idx) IN (SELECT value ->> 0, value ->> 1 FROM json_each(?))""",
+                           (json.dumps(path),))
+            siblings = dict(cursor.fetchall())
+            siblings = [siblings.get(level, TREE_EMPTY) for level in range(TREE_DEPTH)]
+            nodes = [node]
+            for level, sibling in enumerate(siblings):
+                node = tree_node(sibling, node) if filenum >> level & 1 else tree_node(node, sibling)
+                nodes.append(node)
+            cursor.executemany("""INSERT OR REPLACE INTO TreeNodes VALUES (?, ?, ?)""",
+                               [(level, filenum >> level, node)
+                                for level, node in enumerate(nodes) if node != TREE_EMPTY])
+            cursor.executemany("""DELETE FROM TreeNodes WHERE level = (?) AND idx = (?)""",
+                               [(level, filenum >> level)
+                                for level, node in enumerate(nodes) if node == TREE_EMPTY])
+            siblings = [sibling.hex() if sibling != TREE_EMPTY else None for sibling in siblings]
+            cursor.execute("""INSERT INTO TreeJournal (filenum, old_leaf, row, siblings) VALUES (?, ?, ?, ?)""",
+                           (filenum, old_leaf[0] if old_leaf else None, json.dumps(row), json.dumps(siblings)))
+
+    def fetch_tree_rows(self):
+        with self.dbcon as dbcon:
+            return self._fetch_tree_rows(dbcon.cursor())
+
+    def fetch_tree_updates(self):
+        """
+        :return: (Tuple(int, List(List))) the sequence number of the last change, and the changes not tagged
+                 by the user yet: filenum, old leaf (hex or None), new row (or None), siblings (hex or None)
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            # a single snapshot, so the sequence number matches the changes
+            cursor.execute("""BEGIN""")
+            return self._fetch_tree_updates(cursor)
+
+    @staticmethod
+    def _fetch_tree_updates(cursor):
+        cursor.execute("""SELECT seq FROM sqlite_sequence WHERE name = 'TreeJournal'""")
+        seq = cursor.fetchone()
+        cursor.execute("""SELECT filenum, old_leaf, row, siblings FROM TreeJournal ORDER BY seq""")
+        return (seq[0] if seq else 0,
+                [[filenum, old_leaf.hex() if old_leaf else None, json.loads(row), json.loads(siblings)]
+                 for filenum, old_leaf, row, siblings in cursor])
+
+    def fetch_tree_snapshot(self, _rows=False):
+        """
+        Fetch the changes not tagged yet together with the stored metadata tag (and all the entries), as of the same
+        moment: the write lock keeps other sessions from changing or tagging the tree in between.
+        :param _rows: (bool) whether to fetch all the entries too (see fetch_tree_rows)
+        :return: (Tuple(int, List(List), bytes, List(List))) as fetch_tree_updates, then the contents of the tag file,
+                 then the entries (or None)
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            cursor.execute("""BEGIN IMMEDIATE""")
+            seq, updates = self._fetch_tree_updates(cursor)
+            with open(self.mtag_path, 'rb') as fo:
+                mtag = fo.read()
+            return seq, updates, mtag, self._fetch_tree_rows(cursor) if _rows else None
+
+    def store_tree_tag(self, _tag, _seq):
+        """
+        Store the user's MAC tag of the tree's root after the change with the given sequence number,
+        and forget the changes up to it. A tag older than the stored one (from a concurrent session) is ignored.
+        :param _tag: (bytes) the MAC tag
+        :param _seq: (int) sequence number of the last change tagged (see fetch_tree_updates)
+        :return: (bool) whether the tag was stored
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            # the write lock orders this with the other sessions' tags and changes
+            cursor.execute("""BEGIN IMMEDIATE""")
+            with open(self.mtag_path, 'rb') as fo:
+                mtag = fo.read()
+            if len(mtag) == TREE_TAG.size and mtag.startswith(TREE_TAG_MAGIC) and TREE_TAG.unpack(mtag)[1] > _seq:
+                return False
+            self._write_mtag(TREE_TAG.pack(TREE_TAG_MAGIC, _seq, _tag))
+            self._clear_tree_journal(cursor, _seq)
+        self.on_retagged()
+        return True
+
+    def store_meta_tag(self, _tag):
+        """
+        Store the user's MAC tag of the whole db file (the tree isn't tagged yet), and forget all the tree changes.
+        :param _tag: (bytes) the MAC tag
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            cursor.execute("""BEGIN IMMEDIATE""")
+            self._write_mtag(_tag)
+            self._clear_tree_journal(cursor)
+        self.on_retagged()
+
+    def _write_mtag(self, mtag):
+        """
+        Replace the metadata tag file atomically, so sessions reading it (LGVF) never see a partial tag.
+        """
+        tmp_path = '%s.%d.tmp' % (self.mtag_path, os.getpid())
+        with open(tmp_path, 'wb') as fo:
+            fo.write(mtag)
+        os.replace(tmp_path, self.mtag_path)
+
+    def clear_tree_journal(self, _seq=None):
+        """
+        Forget the tree changes up to the given sequence number (all of them by default).
+        """
+        with self.dbcon as dbcon:
+            self._clear_tree_journal(dbcon.cursor(), _seq)
+
+    @staticmethod
+    def _clear_tree_journal(cursor, _seq=None):
+        cursor.execute("""DELETE FROM TreeJournal WHERE (?) IS NULL OR seq <= (?)""", (_seq, _seq))
+
+    @property
+    def verification_db_path(self):
+        """
+        :return: (str) path of the db file which matches the user's metadata tag
+        """
+        return self.tagged_db_path if os.path.isfile(self.tagged_db_path) else self.meta_db_path
+
+    def on_retagged(self):
+        """
+        Called when the user sent a new tag for the current db file.
+        """
+        if os.path.isfile(self.tagged_db_path):
+            os.remove(self.tagged_db_path)
 
     def add_file_meta(self, _filenum, _tag, _size):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
             cursor.execute("""INSERT INTO FileMetadata VALUES (?,?,?)""", (_tag, _size, _filenum))
-            return cursor.lastrowid
+            rowid = cursor.lastrowid
+            self._update_tree(cursor, _filenum)
+            return rowid
+
+    def store_file_meta(self, _filenum, _tag, _size):
+        """
+        Add or update a file's metadata in a single statement (another session may be storing the same file).
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            cursor.execute("""INSERT INTO FileMetadata VALUES (?,?,?)
+                              ON CONFLICT (filenum) DO UPDATE SET tag = excluded.tag, size = excluded.size""",
+                           (_tag, _size, _filenum))
+            self._update_tree(cursor, _filenum)
 
     def update_file_meta(self, _filenum, _tag, _size):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
             cursor.execute("""UPDATE FileMetadata SET tag = (?), size = (?)
                               WHERE filenum = (?)""", (_tag, _size, _filenum))
+            self._update_tree(cursor, _filenum)
 
-    def update_filenum_in_meta(self, _old_filenum, _new_filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+    def move_entry(self, _filenum, _dst_filenum):
+        """
+        Move an entry to the place (parent and name) of another one, which is removed along with its metadata
+        (it may be an existing file being replaced, or an entry just created for the destination path).
+        Since entries are keyed by (parent, name), only these two rows change - a directory's subtree moves with it.
+        """
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""UPDATE FileMetadata SET filenum = (?)
-                              WHERE filenum = (?)""", (_new_filenum, _old_filenum))
+            cursor.execute("""BEGIN IMMEDIATE""")
+            cursor.execute("""SELECT parent, name FROM Filenums WHERE filenum = (?)""", (_dst_filenum,))
+            parent, name = cursor.fetchone()
+            cursor.execute("""DELETE FROM FileMetadata WHERE filenum = (?)""", (_dst_filenum,))
+            cursor.execute("""DELETE FROM Filenums WHERE filenum = (?)""", (_dst_filenum,))
+            cursor.execute("""UPDATE Filenums SET parent = (?), name = (?) WHERE filenum = (?)""",
+                           (parent, name, _filenum))
+            self._update_tree(cursor, _dst_filenum, _filenum)
+        self._paths.discard(int(_dst_filenum))
+        self._paths.add(int(_filenum), parent, name)
 
     def fetch_tag(self, _filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
             cursor.execute("""SELECT tag FROM FileMetadata WHERE filenum = (?)""", (_filenum,))
             return cursor.fetchone()
 
     def fetch_size(self, _filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
             cursor.execute("""SELECT size FROM FileMetadata WHERE filenum = (?)""", (_filenum,))
             return cursor.fetchone()
 
     def fetch_all_file_sizes(self):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        paths = self._fetch_all_paths()
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT numpath, ftppath, size FROM FileMetadata
-                              INNER JOIN Filenums ON Filenums.filenum = FileMetadata.filenum""")
-            return cursor.fetchall()
+            cursor.execute("""SELECT filenum, size FROM FileMetadata""")
+            return [paths[filenum][::-1] + (size,) for filenum, size in cursor if filenum in paths]
 
-    def add_numpath(self, _filenum, _numpath, _ftppath):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+    def fetch_sizes(self, _filenums):
+        """
+        :param _filenums: (Iterable(int)) file numbers
+        :return: (Dict(int, int)) filenum -> stored size, for the given files which have metadata
+        """
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""INSERT INTO Filenums VALUES (?,?,?)""", (_filenum, _numpath, _ftppath))
-            return cursor.lastrowid
+            cursor.execute("""SELECT filenum, size FROM FileMetadata
+                              WHERE filenum IN (SELECT value FROM json_each(?))""", (json.dumps(list(_filenums)),))
+            return dict(cursor.fetchall())
+
+    def add_numpath(self, _parent, _name):
+        """
+        Add an entry, allocating its file number in the same statement.
+        :return: (int) the new file number
+        """
+        with self.dbcon as dbcon:
+            filenum = self._add_numpath(dbcon.cursor(), _parent, _name)
+        self._paths.add(filenum, _parent, _name)
+        return filenum
+
+    def _add_numpath(self, cursor, _parent, _name):
+        cursor.execute("""INSERT INTO Filenums (parent, name) VALUES (?,?)""", (_parent, _name))
+        filenum = cursor.lastrowid
+        self._update_tree(cursor, filenum)
+        return filenum
+
+    def _numpath(self, filenums):
+        """
+        :param filenums: (List(int)) file numbers along a path, starting at the root
+        :return: (str) the numpath
+        """
+        return os.sep.join([self.root] + [str(filenum) for filenum in filenums[1:]])
 
-    def fetch_filenum(self, _ftppath):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+    def _check_paths(self):
+        """
+        Drop the path cache if another connection changed the db since the last check.
+        """
+        data_version = self.dbcon.execute("""PRAGMA data_version""").fetchone()[0]
+        if data_version != self._data_version:
+            self._paths.clear()
+            self._data_version = data_version
+
+    def load_paths(self):
+        """
+        Fill the path cache with the oldest entries (up to its size) with a single query, e.g. on login.
+        """
+        self._check_paths()
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT serial_num FROM Filenums WHERE ftppath = (?)""", (_ftppath,))
-            return cursor.fetchone()
+            cursor.execute("""SELECT filenum, parent, name FROM Filenums WHERE filenum != (?)
+                              ORDER BY filenum LIMIT (?)""", (self.root_filenum, self._paths.max_size))
+            for filenum, parent, name in cursor:
+                self._paths.add(filenum, parent, name)
+
+    def _walk(self, names, cursor=None):
+        """
+        Resolve an ftp path (given as its names) by walking the tree from the root, one index seek per name
+        (past the entries found in the path cache).
+        :param names: (List(str)) the names along the path
+        :param cursor: (sqlite3.Cursor) walk within the cursor's transaction, in the db only
+        :return: (List(int)) file numbers of the longest existing prefix of the path, starting with the root
+        """
+        filenums = [self.root_filenum]
+        if cursor is None:
+            self._check_paths()
+            for name in names:
+                filenum = self._paths.child(filenums[-1], name)
+                if filenum is None:
+                    break
+                filenums.append(filenum)
+            if len(filenums) > len(names):
+                return filenums
+            with self.dbcon as dbcon:
+                return filenums[:-1] + self._walk_db(names[len(filenums) - 1:], filenums[-1], dbcon.cursor())
+        return self._walk_db(names, self.root_filenum, cursor)
+
+    def _walk_db(self, names, parent, cursor):
+        """
+        :return: (List(int)) file numbers of the longest existing prefix of the path from the given directory
+                 (the directory's first), which are added to the path cache
+        """
+        filenums = [parent]
+        for name in names:
+            cursor.execute("""SELECT filenum FROM Filenums WHERE parent = (?) AND name = (?)""", (filenums[-1], name))
+            filenum = cursor.fetchone()
+            if not filenum:
+                break
+            self._paths.add(filenum[0], filenums[-1], name)
+            filenums.append(filenum[0])
+        return filenums
 
     def fetch_numpath_by_ftppath(self, _ftppath):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
-            cursor = dbcon.cursor()
-            cursor.execute("""SELECT numpath FROM Filenums WHERE ftppath = (?)""", (_ftppath,))
-            return cursor.fetchone()
+        names = [name for name in _ftppath.split('/') if name]
+        filenums = self._walk(names)
+        return (self._numpath(filenums),) if len(filenums) == len(names) + 1 else None
 
     def fetch_numpath_by_filenum(self, _filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT numpath FROM Filenums WHERE filenum = (?)""", (_filenum,))
-            return cursor.fetchone()
+            cursor.execute("""WITH RECURSIVE up(depth, filenum, parent) AS (
+                                  SELECT 0, filenum, parent FROM Filenums WHERE filenum = (?)
+                                  UNION ALL
+                                  SELECT up.depth + 1, Filenums.filenum, Filenums.parent FROM up
+                                  JOIN Filenums ON Filenums.filenum = up.parent)
+                              SELECT filenum FROM up ORDER BY depth DESC""", (_filenum,))
+            filenums = [filenum for filenum, in cursor]
+            return (self._numpath(filenums),) if filenums else None
 
     def fetch_filepath(self, _numpath):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        if not (_numpath + os.sep).startswith(self.root + os.sep):
+            return None
+        filenums = [int(filenum) for filenum in _numpath[len(self.root) + 1:].split(os.sep) if filenum]
+        self._check_paths()
+        names = []
+        parent = self.root_filenum
+        for filenum in filenums:
+            entry = self._paths.entry(filenum)
+            if entry is None or entry[0] != parent:
+                break
+            names.append(entry[1])
+            parent = filenum
+        else:
+            return ('/' + '/'.join(names),)
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT ftppath FROM Filenums WHERE numpath = (?)""", (_numpath,))
-            return cursor.fetchone()
+            cursor.execute("""SELECT filenum, parent, name FROM Filenums
+                              WHERE filenum IN (SELECT value FROM json_each(?))""", (json.dumps(filenums),))
+            entries = {filenum: (parent, name) for filenum, parent, name in cursor}
+            if len(entries) != len(set(filenums)):
+                return None
+            for filenum, (parent, name) in entries.items():
+                self._paths.add(filenum, parent, name)
+            return ('/' + '/'.join(entries[filenum][1] for filenum in filenums),)
 
     def fetch_filename(self, _filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT ftppath FROM Filenums WHERE filenum = (?)""", (_filenum,))
-            ftppath = cursor.fetchone()
-            if ftppath:
-                ftppath = ftppath[0].split('/')[-1]
-            return ftppath
+            cursor.execute("""SELECT name FROM Filenums WHERE filenum = (?)""", (_filenum,))
+            name = cursor.fetchone()
+            return name[0] if name else None
+
+    def fetch_dir_entries(self, _parent):
+        """
+        Fetch the ftp-filenames and stored sizes of all entries of a directory with a single query.
+        :param _parent: (int) the directory's file number
+        :return: (Dict(int, Tuple(str, Union(int, None)))) filenum -> (filename, size or None for directories)
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            cursor.execute("""SELECT Filenums.filenum, name, size FROM Filenums
+                              LEFT JOIN FileMetadata ON FileMetadata.filenum = Filenums.filenum
+                              WHERE parent = (?)""", (_parent,))
+            return {filenum: (name, size) for filenum, name, size in cursor}
+
+    def fetch_subtree_numpaths(self, _filenum, _numpath):
+        """
+        :param _filenum: (int) a directory's file number
+        :param _numpath: (str) the directory's numpath
+        :return: (List(str)) numpaths of all entries under the directory (recursively)
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            cursor.execute("""WITH RECURSIVE down(filenum, numpath) AS (
+                                  SELECT filenum, (?) || filenum FROM Filenums WHERE parent = (?)
+                                  UNION ALL
+                                  SELECT Filenums.filenum, down.numpath || (?) || Filenums.filenum FROM down
+                                  JOIN Filenums ON Filenums.parent = down.filenum)
+                              SELECT numpath FROM down""", (_numpath + os.sep, _filenum, os.sep))
+            return [numpath for numpath, in cursor]
+
+    def _fetch_all_paths(self):
+        """
+        Resolve the paths of all entries at once.
+        :return: (Dict(int, Tuple(str, str))) filenum -> (ftppath, numpath)
+        """
+        with self.dbcon as dbcon:
+            cursor = dbcon.cursor()
+            cursor.execute("""SELECT filenum, parent, name FROM Filenums""")
+            entries = {filenum: (parent, name) for filenum, parent, name in cursor}
+        paths = {self.root_filenum: ('/', self.root)}
+
+        def resolve(filenum):
+            if filenum not in paths:
+                parent, name = entries[filenum]
+                if parent not in entries:
+                    # detached entry
+                    return None
+                parent_path = resolve(parent)
+                if parent_path is None:
+                    return None
+                paths[filenum] = (parent_path[0].rstrip('/') + '/' + name, parent_path[1] + os.sep + str(filenum))
+            return paths[filenum]
+
+        for filenum in entries:
+            resolve(filenum)
+        return paths
 
     def fetch_all_files(self):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        return list(self._fetch_all_paths().values())
+
+    def fetch_stats(self):
+        """
+        :return: (Dict(int, Tuple(int, int, int))) filenum -> (size, mtime, ctime) as of the last login check
+        """
+        with self.statscon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT ftppath, numpath FROM Filenums""")
-            return cursor.fetchall()
+            cursor.execute("""SELECT filenum, size, mtime, ctime FROM Stats""")
+            return {filenum: tuple(stat) for filenum, *stat in cursor}
 
-    def remove_filenum(self, _filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+    def update_stats(self, _stats, _removed):
+        """
+        :param _stats: (Dict(int, Tuple(int, int, int))) filenum -> (size, mtime, ctime) to store
+        :param _removed: (Iterable(int)) file numbers to forget
+        """
+        with self.statscon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""DELETE FROM Filenums WHERE filenum = (?)""", (_filenum,))
-            return cursor.fetchone()
+            cursor.executemany("""INSERT OR REPLACE INTO Stats VALUES (?,?,?,?)""",
+                               [(filenum,) + stat for filenum, stat in _stats.items()])
+            cursor.executemany("""DELETE FROM Stats WHERE filenum = (?)""", [(filenum,) for filenum in _removed])
 
-    def get_next_filenum(self):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+    def find_anomalies(self):
+        """
+        Compare the files on disk with the metadata, for the login check.
+        Every entry's stat (size, mtime and ctime) is compared with a snapshot saved by the previous check, and
+        only what changed since is compared with the metadata: entries of a directory which didn't change can't be
+        missing, and a file which didn't change can't have been resized. So apart from stat'ing every entry once,
+        the work is proportional to the changes. Anomalies are left out of the new snapshot, so they are found
+        again until fixed. The snapshot is saved once the generator is exhausted.
+        :return: (Generator(Tuple(str, str))) ('missing' or 'resized', ftp path) for every anomaly found
+        """
+        snapshot = self.fetch_stats()
+        stats = {}
+        stack = [(self.root_filenum, self.root)]
+        while stack:
+            dirnum, dirpath = stack.pop()
+            dir_stat = _stat(os.stat(dirpath))
+            with os.scandir(dirpath) as it:
+                entries = {int(entry.name): entry for entry in it if entry.name.isdigit()}
+
+            missing = []
+            if snapshot.get(dirnum) != dir_stat:
+                for filenum in self.fetch_dir_entries(dirnum).keys() - entries.keys():
+                    numpath = dirpath + os.sep + str(filenum)
+                    missing += [numpath] + self.fetch_subtree_numpaths(filenum, numpath)
+            for numpath in missing:
+                ftppath = self.fetch_filepath(numpath)
+                if ftppath:
+                    yield 'missing', ftppath[0]
+            if not missing:
+                stats[dirnum] = dir_stat
+
+            changed = {}
+            for filenum, entry in entries.items():
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((filenum, entry.path))
+                    continue
+                stat = _stat(entry.stat(follow_symlinks=False))
+                if snapshot.get(filenum) != stat:
+                    changed[filenum] = stat
+                else:
+                    stats[filenum] = stat
+            sizes = self.fetch_sizes(changed) if changed else {}
+            for filenum, stat in changed.items():
+                ftppath = self.fetch_filepath(entries[filenum].path) if sizes.get(filenum, stat[0]) != stat[0] else None
+                if ftppath:
+                    yield 'resized', ftppath[0]
+                else:
+                    stats[filenum] = stat
+
+        self.update_stats({filenum: stat for filenum, stat in stats.items() if snapshot.get(filenum) != stat},
+                          snapshot.keys() - stats.keys())
+
+    def remove_filenum(self, _filenum):
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
-            cursor.execute("""SELECT MAX(filenum) FROM Filenums""")
-            max_num = cursor.fetchone()[0]
-            return (max_num + 1) if max_num is not None else 0
+            cursor.execute("""DELETE FROM Filenums WHERE filenum = (?)""", (_filenum,))
+            self._update_tree(cursor, _filenum)
+        self._paths.discard(int(_filenum))
 
     def remove_file_by_num(self, _filenum):
-        with sqlite3.connect(self.meta_db_path) as dbcon:
+        with self.dbcon as dbcon:
             cursor = dbcon.cursor()
             cursor.execute("""DELETE FROM FileMetadata WHERE filenum = (?)""", (_filenum,))
             cursor.execute("""DELETE FROM Filenums WHERE filenum = (?)""", (_filenum,))
-            return cursor.fetchone()
+            self._update_tree(cursor, _filenum)
+        self._paths.discard(int(_filenum))
 
     def get_numpath(self, path):
         """
-        Fetch a file's numpath from the DB, or creates one if doesn't exist.
+        Fetch a file's numpath from the DB, or creates one if doesn't exist (along with missing parents).
         """
-        numpath = self.fetch_numpath_by_ftppath(path)
-        if not numpath:
-            new_num = self.get_next_filenum()
-            parent_ftppath = '/'.join(path.split('/')[:-1]) or '/'
-            parent_numpath = self.fetch_numpath_by_ftppath(parent_ftppath)[0]
-            numpath = os.sep.join((parent_numpath, str(new_num)))
-            self.add_numpath(new_num, numpath, path)
-        else:
-            numpath = numpath[0]
-        return numpath
+        names = [name for name in path.split('/') if name]
+        filenums = self._walk(names)
+        if len(filenums) <= len(names):
+            with self.dbcon as dbcon:
+                cursor = dbcon.cursor()
+                # walk again under the write lock, as another session may be adding the same entries
+                cursor.execute("""BEGIN IMMEDIATE""")
+                filenums = self._walk(names, cursor)
+                existing = len(filenums)
+                for name in names[len(filenums) - 1:]:
+                    filenums.append(self._add_numpath(cursor, filenums[-1], name))
+            for index in range(existing, len(filenums)):
+                self._paths.add(filenums[index], filenums[index - 1], names[index - 1])
+        return self._numpath(filenums)
+
+
+def _stat(stat_result):
+    """
+    :return: (Tuple(int, int, int)) the size, mtime and ctime (ns) of an os.stat result
+    """
+    return stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ctime_ns
+
+
+# schema migrations of the file metadata db, in order (the db's user_version is the number of migrations applied)
+MIGRATIONS = [
+    FileMetaHandler._migrate_parent_pointers,
+    FileMetaHandler._migrate_tree,
+    FileMetaHandler._migrate_autoincrement,
+    FileMetaHandler._migrate_merkle_tree,
+]
 
 
 def create_user_metadata():
     metadata_existed = os.path.isfile(users_db)
-    with sqlite3.connect(users_db) as dbcon:
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
         if not metadata_existed:
             cursor.execute("""CREATE TABLE Users (
@@ -168,10 +895,17 @@ def create_user_metadata():
                             msg_quit TEXT NOT NULL,
                             salt TEXT NOT NULL,
                             hashed_pass BLOB NOT NULL)""")
+        # counters for allocating numbers, seeded from the existing users' root folders
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Counters (
+                        name TEXT PRIMARY KEY NOT NULL,
+                        value INTEGER NOT NULL)""")
+        cursor.execute("""SELECT homedir FROM Users""")
+        last_user_num = max([int(os.path.basename(homedir)) for homedir, in cursor.fetchall()], default=0)
+        cursor.execute("""INSERT OR IGNORE INTO Counters VALUES ('users', ?)""", (last_user_num,))
 
 
 def add_user_metadata(username, homedir, perm, operms, msg_login, msg_quit, salt, hashed_pass):
-    with sqlite3.connect(users_db) as dbcon:
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
         cursor.execute("""INSERT INTO Users VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
                        (username, homedir, perm, json.dumps(operms), msg_login, msg_quit, salt, hashed_pass))
@@ -179,21 +913,34 @@ def add_user_metadata(username, homedir, perm, operms, msg_login, msg_quit, salt
 
 
 def remove_user_metadata(username):
-    with sqlite3.connect(users_db) as dbcon:
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
         cursor.execute("""DELETE FROM Users WHERE username = (?)""", (username,))
         return cursor.lastrowid
 
 
 def fetch_user_metadata(username):
-    with sqlite3.connect(users_db) as dbcon:
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
         cursor.execute("""SELECT homedir, perm, msg_login, msg_quit FROM Users WHERE username = (?)""", (username,))
         return cursor.fetchone()
 
 
+def fetch_user_record(username):
+    """
+    :return: (Union(Tuple(str, str, str, str, object), None)) the user's home directory, permissions,
+             login and quit messages and permission overrides (decoded), or None if there's no such user
+    """
+    with users_dbcon() as dbcon:
+        cursor = dbcon.cursor()
+        cursor.execute("""SELECT homedir, perm, msg_login, msg_quit, operms FROM Users WHERE username = (?)""",
+                       (username,))
+        row = cursor.fetchone()
+        return row[:4] + (json.loads(row[4]),) if row else None
+
+
 def fetch_operms(username):
-    with sqlite3.connect(users_db) as dbcon:
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
         cursor.execute("""SELECT operms FROM Users WHERE username = (?)""", (username,))
         return json.loads(cursor.fetchone()[0])
@@ -201,17 +948,21 @@ def fetch_operms(username):
 
 # Returns a tuple containing the salt and hashed password of a given username
 def fetch_user_pass(_name):
-    with sqlite3.connect(users_db) as dbcon:
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
         cursor.execute("""SELECT salt, hashed_pass FROM Users WHERE username = (?)""", (_name,))
         return cursor.fetchone()
 
 
-def fetch_next_user_num():
-    with sqlite3.connect(users_db) as dbcon:
+def allocate_user_num():
+    """
+    Atomically allocate a number (root folder name) for a new user. Numbers are never reused.
+    :return: (int) the new user number
+    """
+    with users_dbcon() as dbcon:
         cursor = dbcon.cursor()
-        cursor.execute("""SELECT Count(*) FROM Users""")
-        return cursor.fetchone()[0]+1
+        cursor.execute("""UPDATE Counters SET value = value + 1 WHERE name = 'users' RETURNING value""")
+        return cursor.fetchone()[0]
 
 
 def has_user(_name):
@@ -0,0 +1,197 @@
+import time
+import bisect
+import inspect
+import functools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# nothing is recorded (and FileMetaHandler isn't instrumented) until enable() is called
+enabled = False
+
+# upper bounds of the histograms' buckets
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1 << 10, 1 << 14, 1 << 18, 1 << 20, 1 << 24, 1 << 28, 1 << 32)
+
+# all metrics, in the order they are exposed
+registry = []
+
+
+class Counter(object):
+    """
+    A Prometheus counter, with a value per combination of label values.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, value=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def samples(self):
+        """
+        :return: (List(Tuple(str, Tuple, float))) name suffix, label values and value of every sample
+        """
+        with self._lock:
+            return [('', label_values, value) for label_values, value in sorted(self._values.items())]
+
+
+class Histogram(Counter):
+    """
+    A Prometheus histogram, with fixed buckets, per combination of label values.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # a count per bucket (and past the last one), then the sum
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for _, label_values, counts in super().samples():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                samples.append(('_bucket', label_values + (bound,), total))
+            samples += [('_sum', label_values, counts[-1]), ('_count', label_values, total)]
+        return samples
+
+
+command_seconds = Histogram('ftp_command_seconds', 'Time from receiving an FTP command to its final reply.',
+                            ('command',))
+session_data_bytes = Histogram('ftp_session_data_bytes', 'Bytes transferred over data connections per session.',
+                               ('direction',), BYTES_BUCKETS)
+data_bytes = Counter('ftp_data_bytes_total', 'Bytes transferred over data connections.', ('direction',))
+db_seconds = Histogram('ftp_db_seconds', 'Time spent in FileMetaHandler methods.', ('method',))
+db_queries = Counter('ftp_db_queries_total', 'SQLite statements run by FileMetaHandler methods.', ('method',))
+password_seconds = Histogram('ftp_password_seconds',
+                             'Time to derive or verify a password (scrypt), including the wait for the process pool.',
+                             ('operation',))
+login_check_seconds = Histogram('ftp_login_check_seconds', 'Duration of the login file check.')
+
+# the FileMetaHandler method running in the current thread, which the statements run are counted for
+_current = threading.local()
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition():
+    """
+    :return: (str) all metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines += ['# HELP %s %s' % (metric.name, metric.help), '# TYPE %s %s' % (metric.name, metric.type)]
+        for suffix, label_values, value in metric.samples():
+            names = metric.labels + ('le',) if suffix == '_bucket' else metric.labels
+            labels = ','.join('%s="%s"' % (name, _format_value(label_value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, label_value in zip(names, label_values))
+            lines.append('%s%s%s %s' % (metric.name, suffix, '{%s}' % labels if labels else '', _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def count_query(statement):
+    """
+    SQLite trace callback (see db.connect): count a statement for the FileMetaHandler method running.
+    """
+    method = getattr(_current, 'method', None)
+    if method is not None:
+        db_queries.inc(1, method)
+
+
+def _instrument(name, fun):
+    """
+    :return: (Callable) the method, recording its time and its statements under the given name
+    """
+    if inspect.isgeneratorfunction(fun):
+        @functools.wraps(fun)
+        def generator(*args, **kwargs):
+            # only the time spent in the generator is recorded, not the consumer's
+            it = fun(*args, **kwargs)
+            elapsed = 0
+            try:
+                while True:
+                    outer, _current.method = getattr(_current, 'method', None), name
+                    start = time.perf_counter()
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                        _current.method = outer
+                    yield item
+            finally:
+                db_seconds.observe(elapsed, name)
+        return generator
+
+    @functools.wraps(fun)
+    def method(*args, **kwargs):
+        outer, _current.method = getattr(_current, 'method', None), name
+        start = time.perf_counter()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            db_seconds.observe(time.perf_counter() - start, name)
+            _current.method = outer
+    return method
+
+
+def enable():
+    """
+    Start recording metrics. The public methods of db.FileMetaHandler are wrapped to record their time
+    and count their statements, so there is no cost for that while disabled.
+    """
+    global enabled
+    if enabled:
+        return
+    import db
+    for name, attr in list(vars(db.FileMetaHandler).items()):
+        if not name.startswith('_') and inspect.isfunction(attr):
+            setattr(db.FileMetaHandler, name, _instrument(name, attr))
+    enabled = True
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(address):
+    """
+    Enable metrics and expose them at http://<address>/metrics, from a thread.
+    :param address: (Tuple(str, int)) address to listen on
+    :return: (ThreadingHTTPServer) the HTTP server (shutdown() stops it)
+    """
+    enable()
+    httpd = ThreadingHTTPServer(address, MetricsRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
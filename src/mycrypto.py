@@ -1,18 +1,44 @@
 import os
+import json
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.hazmat.primitives import hashes, hmac
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
+# chunked stream format (see StreamEncryptor below)
+STREAM_MAGIC = b'MYCS'
+STREAM_VERSION = 2  # the version new streams are written in
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_HEADER = struct.Struct('>4sBI16s')  # magic, version, chunk size, file id
+RECORD_HEADER = struct.Struct('>BI')  # flags, plaintext length
+RECORD_FINAL = 1
+# record nonce and tag sizes of every stream version (1: AES-CTR and HMAC, 2: AES-GCM)
+RECORD_LAYOUTS = {1: (16, 32), 2: (12, 16)}
+TAG_SIZE = 32  # HMAC tags (the file tag etc.)
+
+# file metadata Merkle tree (see merkle_levels below)
+TREE_DEPTH = 32
+TREE_EMPTY = bytes(32)
+TREE_TAG = struct.Struct('>4sQ32s')  # stored metadata tag: magic, journal sequence number, tag
+TREE_TAG_MAGIC = b'TREE'
+
 
 class MyCipher(object):
     """
     An object responsible for encryption and decryption, as well as authentication and key derivation,
     according to the master secret given by the user when initializing the object.
     All cryptography operations are provided by the cryptography.hazmat python library.
-    The encryption algorithm being used is AES with CBC, and for authentication - HMAC.
+    The encryption algorithm being used is AES with CBC, and for authentication - HMAC
+    (file contents are encrypted with AES-GCM, see StreamEncryptor).
+    The per-key state (the AES key, the keyed HMAC and the AEAD objects) is set up once, on initialization.
     Additionally, this class is used by the server for password storage and authentication.
     """
 
@@ -20,17 +46,36 @@ class MyCipher(object):
         self._secret = secret.encode()
         self._cipher_key = self.derive_key(self._secret + b'1')
         self._mac_key = self.derive_key(self._secret + b'2')
+        self._aes = algorithms.AES(self._cipher_key)
+        self._mac = hmac.HMAC(self._mac_key, hashes.SHA256(), default_backend())
+        self._aead = AESGCM(self.derive_key(self._secret + b'4'))
+        # first step of derive_key(secret || filename), the HKDF extraction (with no salt), up to the filename
+        self._filename_prk = hmac.HMAC(bytes(32), hashes.SHA256(), default_backend())
+        self._filename_prk.update(self._secret)
+
+    def stream_encryptor(self, chunk_size=STREAM_CHUNK_SIZE, header=None, version=STREAM_VERSION):
+        return StreamEncryptor(self, chunk_size, header, version)
+
+    def stream_decryptor(self, header=None, first_index=0, has_trailer=True):
+        return StreamDecryptor(self, header, first_index, has_trailer)
 
     def derive_server_key(self):
         return self.derive_key(self._secret + b'3').hex()
 
+    def hmac_context(self):
+        """
+        :return: (hmac.HMAC) a fresh HMAC context under the MAC key, copied from the keyed one (so the key isn't
+                 set up again)
+        """
+        return self._mac.copy()
+
     def get_hmac_tag(self, data):
         """
         Run the HMAC algorithm on the given data and return the authentication tag.
         :param data: (bytes) data to authenticate
         :return: (bytes) MAC tag
         """
-        h = hmac.HMAC(self._mac_key, hashes.SHA256(), default_backend())
+        h = self.hmac_context()
         h.update(data)
         return h.finalize()
 
@@ -40,10 +85,23 @@ class MyCipher(object):
         :param data: (bytes) data to verify
         :param tag: (bytes) MAC tag
         """
-        h = hmac.HMAC(self._mac_key, hashes.SHA256(), default_backend())
+        h = self.hmac_context()
         h.update(data)
         h.verify(tag)
 
+    def _filename_iv(self, pt):
+        """
+        Derive the IV of a filename: the first 16 bytes of derive_key(secret || pt), computed as HKDF does
+        (extract, then expand to a single block), from the extraction state kept after the secret.
+        :param pt: (bytes) filename
+        :return: (bytes) IV
+        """
+        extract = self._filename_prk.copy()
+        extract.update(pt)
+        expand = hmac.HMAC(extract.finalize(), hashes.SHA256(), default_backend())
+        expand.update(b'\x01')
+        return expand.finalize()[:16]
+
     def encrypt(self, pt, is_filename=False):
         """
         Encrypt and authenticate the given plaintext using AES and HMAC.
@@ -60,8 +118,8 @@ class MyCipher(object):
         padder = PKCS7(256).padder()
         padded_pt = padder.update(pt) + padder.finalize()
 
-        iv = self.derive_key(self._secret + pt)[:16] if is_filename else os.urandom(16)
-        cipher = Cipher(algorithms.AES(self._cipher_key), modes.CBC(iv), default_backend())
+        iv = self._filename_iv(pt) if is_filename else os.urandom(16)
+        cipher = Cipher(self._aes, modes.CBC(iv), default_backend())
         encryptor = cipher.encryptor()
         ct = encryptor.update(padded_pt) + encryptor.finalize()
 
@@ -84,7 +142,7 @@ class MyCipher(object):
 
         self.authenticate_hmac(iv_and_ct, tag)
 
-        cipher = Cipher(algorithms.AES(self._cipher_key), modes.CBC(iv), default_backend())
+        cipher = Cipher(self._aes, modes.CBC(iv), default_backend())
         decryptor = cipher.decryptor()
         padded_pt = decryptor.update(ct) + decryptor.finalize()
 
@@ -92,6 +150,102 @@ class MyCipher(object):
         unpadder = PKCS7(256).unpadder()
         return unpadder.update(padded_pt) + unpadder.finalize()
 
+    def encrypt_many(self, pts, is_filename=False, workers=1):
+        """
+        Encrypt and authenticate a batch of plaintexts, as encrypt does for each of them.
+        The CBC encryption runs
+        block by block over all the plaintexts at once (each block in ECB mode, XORed with the previous one).
+        :param pts: (List(bytes)) plaintexts
+        :param is_filename: (bool) encrypting filenames (see encrypt)
+        :param workers: (int) number of threads to split the batch between
+        :return: (List(Union(Tuple, bytes))) encrypted data of every plaintext, in the same order (see encrypt)
+        """
+        if workers > 1:
+            return self._map_batches(lambda batch: self.encrypt_many(batch, is_filename), pts, workers)
+        ivs = [self._filename_iv(pt) if is_filename else os.urandom(16) for pt in pts]
+        padded_pts = []
+        for pt in pts:
+            padder = PKCS7(256).padder()
+            padded_pts.append(padder.update(pt) + padder.finalize())
+
+        encryptor = Cipher(self._aes, modes.ECB(), default_backend()).encryptor()
+        blocks = list(ivs)
+        cts = [[] for _ in pts]
+        for offset in range(0, max(map(len, padded_pts), default=0), 16):
+            batch = [i for i, padded_pt in enumerate(padded_pts) if len(padded_pt) > offset]
+            out = encryptor.update(_xor(b''.join([padded_pts[i][offset:offset + 16] for i in batch]),
+                                        b''.join([blocks[i] for i in batch])))
+            for j, i in enumerate(batch):
+                blocks[i] = out[16 * j:16 * j + 16]
+                cts[i].append(blocks[i])
+
+        msgs = []
+        for iv, ct in zip(ivs, cts):
+            iv_and_ct = iv + b''.join(ct)
+            h = self.hmac_context()
+            h.update(iv_and_ct)
+            tag = h.finalize()
+            msgs.append(iv_and_ct + tag if is_filename else (iv_and_ct, tag))
+        return msgs
+
+    def decrypt_many(self, msgs, workers=1):
+        """
+        Verify and decrypt a batch of messages, as decrypt does for each of them.
+        All the blocks are decrypted by a single call (in ECB mode, then XORed with the preceding blocks,
+        which makes CBC).
+        :param msgs: (List) encrypted data (structure above)
+        :param workers: (int) number of threads to split the batch between
+        :return: (List(bytes)) decrypted plaintexts, in the same order, None for the messages that failed verification
+            or have invalid padding
+        """
+        if workers > 1:
+            return self._map_batches(self.decrypt_many, msgs, workers)
+        verified = []
+        for msg in msgs:
+            if isinstance(msg, tuple):
+                msg = b''.join(msg)
+            h = self.hmac_context()
+            h.update(msg[:-32])
+            try:
+                h.verify(msg[-32:])
+                verified.append(msg)
+            except InvalidSignature:
+                verified.append(None)
+
+        valid = [msg for msg in verified if msg is not None]
+        decryptor = Cipher(self._aes, modes.ECB(), default_backend()).decryptor()
+        padded_pts = _xor(decryptor.update(b''.join([msg[16:-32] for msg in valid])),
+                          b''.join([msg[:-48] for msg in valid]))
+        pts = []
+        offset = 0
+        for msg in verified:
+            if msg is None:
+                pts.append(None)
+                continue
+            padded_pt = padded_pts[offset:offset + len(msg) - 48]
+            offset += len(padded_pt)
+            # unpad (an authenticated message can still have invalid padding, if it was made with the key)
+            unpadder = PKCS7(256).unpadder()
+            try:
+                pts.append(unpadder.update(padded_pt) + unpadder.finalize())
+            except ValueError:
+                pts.append(None)
+        return pts
+
+    @staticmethod
+    def _map_batches(fun, items, workers):
+        """
+        Split a batch between threads (the OpenSSL calls can run in parallel, the rest holds the GIL).
+        :param fun: (Callable) batch operation, called with a part of the items
+        :param items: (List) the batch
+        :param workers: (int) number of threads
+        :return: (List) the results of all the parts, in order
+        """
+        size = -(-len(items) // workers) or 1
+        with ThreadPoolExecutor(workers) as pool:
+            return [result for results in pool.map(fun, [items[i:i + size] for i in range(0, len(items), size)])
+                    for result in results]
+
     @staticmethod
     def derive_key(key_material):
         """
@@ -137,3 +291,426 @@ class MyCipher(object):
             p=1,
             backend=default_backend()
         ).verify(bytes.fromhex(password), key)
+
+
+class StreamEncryptor(object):
+    """
+    Encrypts files in the chunked stream format, so files of any size can be encrypted, sent, received,
+    verified and decrypted as a pipeline in constant memory.
+
+    Format (version 2):
+        header = magic (4) || version (1) || chunk size (4) || random file id (16)
+        record = flags (1) || pt length (4) || nonce (12) || ct || tag (16)
+    Every chunk is encrypted and authenticated in a single pass with AES-GCM under its own random nonce,
+    with header || chunk index || record header as associated data, so chunks can't be reordered, moved between
+    files or altered.
+    In version 1 (still decrypted), records have a 16 bytes nonce and a 32 bytes tag: every chunk is encrypted
+    with AES-CTR and authenticated with HMAC over header || chunk index || record header || nonce || ct.
+    All records but the last hold exactly chunk size bytes of plaintext; the last one has the final flag set
+    (and may be empty), so truncation is detected.
+    The file tag (sent to the server with TAG) authenticates the header and the number of chunks.
+    """
+
+    def __init__(self, cipher, chunk_size=STREAM_CHUNK_SIZE, header=None, version=STREAM_VERSION):
+        """
+        :param cipher: (MyCipher) the user's cipher
+        :param chunk_size: (int) stream chunk size
+        :param header: (bytes) the stream header, when encrypting more of an existing stream (sets the chunk size
+                       and the version)
+        :param version: (int) stream format version
+        """
+        self._cipher = cipher
+        self.header = header or STREAM_HEADER.pack(STREAM_MAGIC, version, chunk_size, os.urandom(16))
+        _, self.version, self.chunk_size, _ = STREAM_HEADER.unpack(self.header)
+        if self.version not in RECORD_LAYOUTS:
+            raise ValueError('Unsupported stream version %d' % self.version)
+        self.record_size = record_size(self.chunk_size, self.version)
+        self.chunk_count = 0
+
+    def encrypt_chunk(self, index, pt, final):
+        """
+        Encrypt and authenticate a single chunk.
+        :param index: (int) chunk index within the file
+        :param pt: (bytes) chunk plaintext (exactly chunk size bytes unless final)
+        :param final: (bool) whether this is the last chunk of the file
+        :return: (bytes) the encrypted record
+        """
+        record_header = RECORD_HEADER.pack(RECORD_FINAL if final else 0, len(pt))
+        associated_data = self.header + struct.pack('>Q', index) + record_header
+        nonce = os.urandom(RECORD_LAYOUTS[self.version][0])
+        if self.version == 1:
+            encryptor = Cipher(self._cipher._aes, modes.CTR(nonce), default_backend()).encryptor()
+            ct = encryptor.update(pt) + encryptor.finalize()
+            return record_header + nonce + ct + self._cipher.get_hmac_tag(associated_data + nonce + ct)
+        # the tag is appended to the ciphertext
+        return record_header + nonce + self._cipher._aead.encrypt(nonce, pt, associated_data)
+
+    def iter_records(self, fp):
+        """
+        Read the given file object chunk by chunk and yield the header followed by the encrypted records.
+        When done, chunk_count holds the number of chunks and file_tag() may be called.
+        :param fp: (file) binary file object to encrypt
+        :return: (Generator(bytes)) the encrypted stream
+        """
+        yield self.header
+        index = 0
+        chunk = fp.read(self.chunk_size)
+        while True:
+            next_chunk = fp.read(self.chunk_size) if len(chunk) == self.chunk_size else b''
+            final = not next_chunk
+            yield self.encrypt_chunk(index, chunk, final)
+            index += 1
+            if final:
+                break
+            chunk = next_chunk
+        self.chunk_count = index
+
+    def iter_range(self, fp, start, stop, chunk_count):
+        """
+        Encrypt a segment of a file: chunks start to stop - 1 (out of chunk_count), read from the given file object.
+        Every segment but the first starts at a record boundary (see record_offset), so segments can be encrypted
+        and sent concurrently, each with its own file object, and laid out one after the other on the server.
+        :param fp: (file) binary file object to encrypt
+        :param start: (int) index of the first chunk of the segment
+        :param stop: (int) index of the chunk following the segment
+        :param chunk_count: (int) number of chunks in the file (see stream_chunk_count)
+        :return: (Generator(bytes)) the encrypted segment (starting with the header for the first segment)
+        """
+        if start == 0:
+            yield self.header
+        fp.seek(start * self.chunk_size)
+        for index in range(start, stop):
+            yield self.encrypt_chunk(index, fp.read(self.chunk_size), index == chunk_count - 1)
+
+    def file_tag(self, chunk_count=None):
+        """
+        :param chunk_count: (int) number of chunks in the file (defaults to the number encrypted by iter_records)
+        :return: (bytes) the file-level MAC tag
+        """
+        return file_tag(self._cipher, self.header, self.chunk_count if chunk_count is None else chunk_count)
+
+
+class StreamDecryptor(object):
+    """
+    Verifies and decrypts data in the chunked stream format as it arrives.
+    Files stored in the old single-blob format (iv||ct||tag) are detected by the missing header,
+    buffered and decrypted as a whole on finalize().
+    """
+
+    def __init__(self, cipher, header=None, first_index=0, has_trailer=True):
+        """
+        :param cipher: (MyCipher) the user's cipher
+        :param header: (bytes) the stream header, if the data doesn't start with it (ranged/resumed reads)
+        :param first_index: (int) index of the first record in the data
+        :param has_trailer: (bool) whether the data ends with the file tag (as sent by the server on RETR)
+        """
+        self._cipher = cipher
+        self._buf = bytearray()
+        self._legacy = False
+        self.header = None
+        self.version = None
+        self.index = first_index
+        self.final = False
+        self.has_trailer = has_trailer
+        if header:
+            self._set_header(header)
+
+    def _set_header(self, header):
+        magic, version, chunk_size, _ = STREAM_HEADER.unpack(header)
+        if version not in RECORD_LAYOUTS:
+            raise InvalidSignature('Unsupported stream version %d' % version)
+        self.header = bytes(header)
+        self.version = version
+        self.chunk_size = chunk_size
+
+    def update(self, data):
+        """
+        Feed received data.
+        :param data: (bytes) next piece of the encrypted stream
+        :return: (bytes) plaintext of all records completed (and verified) by this data
+        """
+        self._buf += data
+        if self._legacy:
+            return b''
+        if self.header is None:
+            if len(self._buf) < STREAM_HEADER.size:
+                if not STREAM_MAGIC.startswith(bytes(self._buf[:len(STREAM_MAGIC)])):
+                    self._legacy = True
+                return b''
+            if self._buf[:len(STREAM_MAGIC)] != STREAM_MAGIC:
+                self._legacy = True
+                return b''
+            self._set_header(self._buf[:STREAM_HEADER.size])
+            del self._buf[:STREAM_HEADER.size]
+
+        pts = []
+        pos = 0
+        while not self.final and len(self._buf) - pos >= RECORD_HEADER.size:
+            flags, length = RECORD_HEADER.unpack_from(self._buf, pos)
+            if length > self.chunk_size or (not flags & RECORD_FINAL and length != self.chunk_size):
+                raise InvalidSignature('Malformed record')
+            end = pos + record_size(length, self.version)
+            if len(self._buf) < end:
+                break
+            pts.append(self.decrypt_record(self.index, self._buf[pos:end]))
+            self.index += 1
+            self.final = bool(flags & RECORD_FINAL)
+            pos = end
+        del self._buf[:pos]
+        return b''.join(pts)
+
+    def decrypt_record(self, index, record):
+        """
+        Verify and decrypt a single record.
+        :param index: (int) the record's chunk index within the file
+        :param record: (bytes) the record
+        :return: (bytes) the chunk plaintext
+        """
+        record = bytes(record)
+        nonce_size, tag_size = RECORD_LAYOUTS[self.version]
+        ct_start = RECORD_HEADER.size + nonce_size
+        associated_data = self.header + struct.pack('>Q', index) + record[:RECORD_HEADER.size]
+        nonce = record[RECORD_HEADER.size:ct_start]
+        if self.version == 1:
+            self._cipher.authenticate_hmac(associated_data + record[RECORD_HEADER.size:-tag_size], record[-tag_size:])
+            decryptor = Cipher(self._cipher._aes, modes.CTR(nonce), default_backend()).decryptor()
+            return decryptor.update(record[ct_start:-tag_size]) + decryptor.finalize()
+        try:
+            return self._cipher._aead.decrypt(nonce, record[ct_start:], associated_data)
+        except InvalidTag:
+            raise InvalidSignature('Record altered')
+
+    def finalize(self):
+        """
+        Check that the stream ended properly (and verify the file tag, if expected).
+        An exception is raised if verification fails.
+        :return: (bytes) remaining plaintext (only for files in the old format)
+        """
+        if self._legacy or self.header is None:
+            return self._cipher.decrypt(bytes(self._buf))
+        if not self.final:
+            raise InvalidSignature('Stream truncated')
+        if self.has_trailer:
+            if len(self._buf) != TAG_SIZE:
+                raise InvalidSignature('Missing file tag')
+            self._cipher.authenticate_hmac(file_tag_data(self.header, self.index), bytes(self._buf))
+        elif self._buf:
+            raise InvalidSignature('Trailing data after final record')
+        return b''
+
+    def finalize_segment(self, stop):
+        """
+        Check that a segment of the stream which doesn't hold the final record (see StreamEncryptor.iter_range)
+        ended right before the record stop. An exception is raised if it didn't.
+        :param stop: (int) index of the record following the segment
+        """
+        if self._legacy or self.header is None or self.final or self._buf or self.index != stop:
+            raise InvalidSignature('Segment truncated')
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def record_size(length, version=STREAM_VERSION):
+    """
+    :param length: (int) chunk plaintext length
+    :param version: (int) stream format version
+    :return: (int) size of its encrypted record
+    """
+    nonce_size, tag_size = RECORD_LAYOUTS[version]
+    return RECORD_HEADER.size + nonce_size + length + tag_size
+
+
+def stream_chunk_count(length, chunk_size):
+    """
+    :param length: (int) file length
+    :param chunk_size: (int) stream chunk size
+    :return: (int) number of chunks the file is encrypted in (an empty file has a single empty chunk)
+    """
+    return max(1, -(-length // chunk_size))
+
+
+def stream_size(length, chunk_size=STREAM_CHUNK_SIZE, version=STREAM_VERSION):
+    """
+    :param length: (int) file length
+    :param chunk_size: (int) stream chunk size
+    :param version: (int) stream format version
+    :return: (int) size of the file's stream (as stored on the server, without the file tag)
+    """
+    full_chunks = stream_chunk_count(length, chunk_size) - 1
+    return record_offset(full_chunks, chunk_size, version) + record_size(length - full_chunks * chunk_size, version)
+
+
+def record_offset(index, chunk_size, version=STREAM_VERSION):
+    """
+    :param index: (int) chunk index
+    :param chunk_size: (int) stream chunk size
+    :param version: (int) stream format version
+    :return: (int) offset of the chunk's record in the stream (all records but the last are the same size)
+    """
+    return STREAM_HEADER.size + index * record_size(chunk_size, version)
+
+
+def record_count(size, chunk_size, version=STREAM_VERSION):
+    """
+    :param size: (int) size of a stream (without the file tag)
+    :param chunk_size: (int) stream chunk size
+    :param version: (int) stream format version
+    :return: (int) number of records in the stream (see record_offset)
+    """
+    return -(-(size - STREAM_HEADER.size) // record_size(chunk_size, version))
+
+
+def _walk_records(fp, size):
+    """
+    Walk the record headers of a stream (without decrypting anything, see check_stream_layout).
+    :param fp: (file) binary file object holding the stream
+    :param size: (int) size of the stream (without the file tag)
+    :return: (Tuple(int, bool)) offset following the complete records the stream starts with (0 if the header
+             isn't valid), and whether the last of them is final
+    """
+    fp.seek(0)
+    header = fp.read(STREAM_HEADER.size)
+    if len(header) != STREAM_HEADER.size or size < STREAM_HEADER.size:
+        return 0, False
+    magic, version, chunk_size, _ = STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC or version not in RECORD_LAYOUTS or not chunk_size:
+        return 0, False
+    pos = STREAM_HEADER.size
+    while pos + RECORD_HEADER.size <= size:
+        fp.seek(pos)
+        flags, length = RECORD_HEADER.unpack(fp.read(RECORD_HEADER.size))
+        end = pos + record_size(length, version)
+        if end > size or length > chunk_size or (not flags & RECORD_FINAL and length != chunk_size):
+            break
+        pos = end
+        if flags & RECORD_FINAL:
+            return pos, True
+    return pos, False
+
+
+def check_stream_layout(fp, size):
+    """
+    Check that a stream is complete, walking its record headers without decrypting anything (the server can't),
+    so a file uploaded in segments isn't stored with a segment missing, cut short or left from an older upload:
+    all records but the last must hold a full chunk and the last one must be final and end the stream.
+    :param fp: (file) binary file object holding the stream
+    :param size: (int) size of the stream (without the file tag)
+    :return: (bool) whether the layout is valid
+    """
+    end, final = _walk_records(fp, size)
+    return final and end == size
+
+
+def stream_committed_length(fp, size):
+    """
+    Find how much of a partially uploaded stream can be kept when resuming the upload: the header and the
+    complete records following it (a record cut short, or anything after a missing one, is sent again).
+    :param fp: (file) binary file object holding the partial stream
+    :param size: (int) size of the partial stream
+    :return: (int) the committed length (0 if not even the header is valid)
+    """
+    return _walk_records(fp, size)[0]
+
+
+def file_tag_data(header, chunk_count):
+    return b'FILE' + header + struct.pack('>Q', chunk_count)
+
+
+def file_tag(cipher, header, chunk_count):
+    return cipher.get_hmac_tag(file_tag_data(header, chunk_count))
+
+
+def tree_leaf(row):
+    """
+    :param row: (List) a file metadata entry: filenum, parent, name, tag, size (tag and size are None for
+                directories)
+    :return: (bytes) its leaf hash in the metadata Merkle tree
+    """
+    return hashlib.sha256(b'\0' + json.dumps(list(row), separators=(',', ':')).encode()).digest()
+
+
+def tree_node(left, right):
+    """
+    :return: (bytes) the hash of an inner node of the metadata Merkle tree, given its children's hashes
+    """
+    if left == right == TREE_EMPTY:
+        return TREE_EMPTY
+    return hashlib.sha256(b'\1' + left + right).digest()
+
+
+def merkle_levels(leaves):
+    """
+    Compute the file metadata Merkle tree: a sparse binary tree of depth TREE_DEPTH, whose leaves are indexed
+    by file number. Empty subtrees hash to TREE_EMPTY, so only the nodes above entries are computed (and stored).
+    :param leaves: (Dict(int, bytes)) filenum -> leaf hash
+    :return: (Generator(Dict(int, bytes))) index -> hash of the non-empty nodes of every level,
+             from the leaves up to the root
+    """
+    level = dict(leaves)
+    yield level
+    for _ in range(TREE_DEPTH):
+        parents = {}
+        for index in level:
+            parent = index >> 1
+            if parent not in parents:
+                parents[parent] = tree_node(level.get(parent * 2, TREE_EMPTY), level.get(parent * 2 + 1, TREE_EMPTY))
+        level = parents
+        yield level
+
+
+def merkle_root(rows):
+    """
+    :param rows: (Iterable(List)) all file metadata entries (see tree_leaf)
+    :return: (bytes) the root hash of their Merkle tree
+    """
+    for level in merkle_levels({row[0]: tree_leaf(row) for row in rows}):
+        pass
+    return level.get(0, TREE_EMPTY)
+
+
+def merkle_path_root(index, leaf, siblings):
+    """
+    :param index: (int) the leaf's index (filenum)
+    :param leaf: (bytes) the leaf hash
+    :param siblings: (List(bytes)) the siblings along the leaf's path, from the bottom up
+    :return: (bytes) the root hash
+    """
+    if len(siblings) != TREE_DEPTH or not 0 <= index < 2 ** TREE_DEPTH:
+        raise InvalidSignature('Malformed tree update')
+    node = leaf
+    for sibling in siblings:
+        node = tree_node(sibling, node) if index & 1 else tree_node(node, sibling)
+        index >>= 1
+    return node
+
+
+def apply_tree_updates(updates):
+    """
+    Check a sequence of updates to the metadata Merkle tree, each made of an entry's old leaf hash, its new row
+    and the siblings along its path. Each update must start from the root the previous one ended with.
+    An exception is raised if they don't.
+    :param updates: (List(List)) updates as sent by the server: filenum, old leaf (hex or None), new row (or None),
+                    siblings (hex or None, bottom up)
+    :return: (Tuple(bytes, bytes)) the roots before and after the updates (None if there are none)
+    """
+    old_root = new_root = None
+    for filenum, old_leaf, row, siblings in updates:
+        if row is not None and row[0] != filenum:
+            raise InvalidSignature('Malformed tree update')
+        siblings = [bytes.fromhex(sibling) if sibling else TREE_EMPTY for sibling in siblings]
+        root = merkle_path_root(filenum, bytes.fromhex(old_leaf) if old_leaf else TREE_EMPTY, siblings)
+        if new_root is not None and root != new_root:
+            raise InvalidSignature('Inconsistent tree update')
+        old_root = old_root or root
+        new_root = merkle_path_root(filenum, tree_leaf(row) if row is not None else TREE_EMPTY, siblings)
+    return old_root, new_root
+
+
+def tree_tag_data(root):
+    return TREE_TAG_MAGIC + root
+
+
+def tree_tag(cipher, root):
+    return cipher.get_hmac_tag(tree_tag_data(root))
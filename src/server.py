@@ -1,15 +1,83 @@
 import os
+import json
+import time
+import hmac
+import errno
+import struct
+import queue
+import socket
+import sqlite3
+import hashlib
+import argparse
+import contextlib
+import tempfile
+import weakref
+import threading
 import db
-from mycrypto import MyCipher
+import metrics
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from mycrypto import MyCipher, STREAM_HEADER, TAG_SIZE, check_stream_layout, stream_committed_length
 import pyftpdlib.filesystems
 from pyftpdlib.authorizers import DummyAuthorizer
-from pyftpdlib.handlers import FTPHandler, proto_cmds
+from pyftpdlib.handlers import FTPHandler, DTPHandler, FileProducer, proto_cmds, _strerror
 from pyftpdlib.servers import FTPServer
+from pyftpdlib.prefork import fork_processes
 from pyftpdlib.filesystems import AbstractedFS
+from pyftpdlib.filesystems import FilesystemError
 from cryptography.exceptions import InvalidKey
 
 ip = 'localhost'
 
+# session tickets: expiry time (unix) || HMAC-SHA256 (see MySmartyAuthorizer.issue_ticket)
+TICKET_EXPIRY = struct.Struct('>Q')
+TICKET_KEY_SIZE = 32
+
+# seconds the authorizer keeps a user's record (a user removed by another server process is seen after that long)
+USER_CACHE_TTL = 60
+
+
+def _verify_password(password, salt, key):
+    """
+    Verify a stored password (runs in the authorizer's process pool).
+    :return: (bool) whether the password is correct
+    """
+    try:
+        MyCipher.verify_stored_password(password, salt, key)
+        return True
+    except InvalidKey:
+        return False
+
+
+def _index_operms(operms):
+    """
+    Index permission overrides by directory, for looking up those of a path's parents (see MySmartyAuthorizer.has_perm).
+    :param operms: (Union(dict, str)) directory -> (permissions, recursive), as stored ('' for none)
+    :return: (Dict(str, Tuple(int, str, str, bool))) directory (without trailing separator) ->
+             (order the override was set in, directory, permissions, recursive)
+    """
+    return {os.path.normcase(dir).rstrip(os.sep): (index, os.path.normcase(dir), operm, recursive)
+            for index, (dir, (operm, recursive)) in enumerate((operms or {}).items())}
+
+
+def _check_files(home, notify, cancelled):
+    """
+    Run the login file check with a db connection of its own (runs in the file check thread pool).
+    :param home: (str) the user's home directory
+    :param notify: (Callable) called with every anomaly found (see FileMetaHandler.find_anomalies)
+    :param cancelled: (threading.Event) set to stop checking
+    """
+    file_meta_handler = db.FileMetaHandler(home)
+    start = time.perf_counter()
+    try:
+        for anomaly in file_meta_handler.find_anomalies():
+            if cancelled.is_set():
+                return
+            notify(anomaly)
+        if metrics.enabled:
+            metrics.login_check_seconds.observe(time.perf_counter() - start)
+    finally:
+        file_meta_handler.close()
+
 
 class MySmartyAuthorizer(DummyAuthorizer):
     """
@@ -17,15 +85,168 @@ class MySmartyAuthorizer(DummyAuthorizer):
     It extends DummyAuthorizer which simply stores user data as-is in an object field,
     and instead works with MyCipher's password derivation method and local database management
     for persistent (encrypted) storage.
+    Password derivation and verification (Scrypt, which is slow by design) run in a process pool,
+    so logins and registrations don't stall the server's IOLoop (see the *_async methods).
+    Users who logged in can get an expiring session ticket, which can be presented on later connections
+    instead of the password and is verified with a single HMAC.
+    pyftpdlib looks up the user's home directory and permissions several times per command, so user records
+    are cached (see _fetch_user), with their permission overrides indexed by directory.
     """
 
-    def __init__(self):
+    def __init__(self, password_workers=None, ticket_lifetime=3600, user_cache_ttl=USER_CACHE_TTL):
+        """
+        :param password_workers: (int) number of processes deriving passwords (default: number of CPUs).
+                                 0 derives them in the calling thread.
+        :param ticket_lifetime: (int) seconds a session ticket is valid for
+        :param user_cache_ttl: (float) seconds a user's record is cached for
+        """
         db.create_user_metadata()
+        self.password_workers = password_workers
+        self._password_pool = None
+        self.ticket_lifetime = ticket_lifetime
+        self._ticket_key = None
+        self.user_cache_ttl = user_cache_ttl
+        self._users = {}
+
+    @property
+    def password_pool(self):
+        if self._password_pool is None and self.password_workers != 0:
+            self._password_pool = ProcessPoolExecutor(self.password_workers)
+        return self._password_pool
+
+    def close(self):
+        """
+        Shut down the password pool (it's started again when needed).
+        """
+        if self._password_pool is not None:
+            self._password_pool.shutdown()
+            self._password_pool = None
+
+    def _submit(self, fun, *args):
+        """
+        Run a function in the password pool.
+        :return: (Future) its result
+        """
+        if self.password_pool is not None:
+            return self.password_pool.submit(fun, *args)
+        future = Future()
+        try:
+            future.set_result(fun(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _submit_timed(self, operation, fun, *args):
+        """
+        Run a password derivation in the password pool, recording its time (see metrics.password_seconds).
+        :return: (Future) its result
+        """
+        future = self._submit(fun, *args)
+        if metrics.enabled:
+            start = time.perf_counter()
+            future.add_done_callback(
+                lambda _: metrics.password_seconds.observe(time.perf_counter() - start, operation))
+        return future
+
+    def derive_password_async(self, password):
+        """
+        :param password: (str) a password in hashed form (hex)
+        :return: (Future) the salt and the derived password for storage (see MyCipher.derive_password_for_storage)
+        """
+        return self._submit_timed('derive', MyCipher.derive_password_for_storage, password)
+
+    def validate_authentication_async(self, username, password):
+        """
+        :return: (Future) whether the password is correct for the user
+        """
+        if not self.has_user(username):
+            return self._submit(bool, False)
+        salt, hashed_pass = db.fetch_user_pass(username)
+        return self._submit_timed('verify', _verify_password, password, salt, hashed_pass)
+
+    @property
+    def ticket_key(self):
+        """
+        The key session tickets are signed with. It's generated once and stored next to the user database,
+        so tickets stay valid across server restarts (and are valid in all server processes).
+        The key file is written aside and linked in place, so another process never reads a partial key.
+        """
+        if self._ticket_key is None:
+            path = os.path.join(os.path.dirname(db.users_db), 'ticket.key')
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as fo:
+                    fo.write(os.urandom(TICKET_KEY_SIZE))
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+            with open(path, 'rb') as fo:
+                self._ticket_key = fo.read()
+        return self._ticket_key
+
+    def _ticket_tag(self, username, expiry):
+        data = b'TCKT' + expiry + self.get_home_dir(username).encode() + b'\0' + username.encode()
+        return hmac.new(self.ticket_key, data, hashlib.sha256).digest()
+
+    def issue_ticket(self, username):
+        """
+        Issue a session ticket for a user, which can be used for logging in until it expires.
+        The ticket is bound to the user's name and home directory.
+        :param username: (str) the user's name
+        :return: (str) the ticket (hex)
+        """
+        expiry = TICKET_EXPIRY.pack(int(time.time()) + self.ticket_lifetime)
+        return (expiry + self._ticket_tag(username, expiry)).hex()
+
+    def validate_ticket(self, username, ticket):
+        """
+        Verify a session ticket. An exception is raised if the ticket is invalid or expired.
+        :param username: (str) the user's name
+        :param ticket: (str) the ticket (hex), as returned by issue_ticket
+        """
+        msg = "Authentication failed."
+        try:
+            ticket = bytes.fromhex(ticket)
+        except ValueError:
+            raise pyftpdlib.authorizers.AuthenticationFailed(msg)
+        expiry, tag = ticket[:TICKET_EXPIRY.size], ticket[TICKET_EXPIRY.size:]
+        if not self.has_user(username) or not hmac.compare_digest(tag, self._ticket_tag(username, expiry)):
+            raise pyftpdlib.authorizers.AuthenticationFailed(msg)
+        if TICKET_EXPIRY.unpack(expiry)[0] < time.time():
+            raise pyftpdlib.authorizers.AuthenticationFailed("Session ticket expired.")
+
+    def _fetch_user(self, username):
+        """
+        Fetch a user's record from the users db, or from the cache if fetched less than user_cache_ttl seconds ago.
+        Users missing from the db are not cached, so a user registered by another server process is found at once.
+        :return: (Union(Tuple(str, str, str, str, dict), None)) the user's home directory, permissions,
+                 login and quit messages and permission overrides (see _index_operms), or None if there's no such user
+        """
+        cached = self._users.get(username)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        record = db.fetch_user_record(username)
+        if record is None:
+            self._users.pop(username, None)
+            return None
+        record = record[:4] + (_index_operms(record[4]),)
+        self._users[username] = (time.monotonic() + self.user_cache_ttl, record)
+        return record
+
+    def _user(self, username):
+        record = self._fetch_user(username)
+        if record is None:
+            raise KeyError(username)
+        return record
 
     def add_user(self, username, password, homedir, perm='elr',
-                 msg_login="Login successful.", msg_quit="Goodbye."):
+                 msg_login="Login successful.", msg_quit="Goodbye.", derived_password=None):
         """
         Adds encrypted user data into the database.
+        :param derived_password: (Tuple(bytes)) the salt and derived password, if derived already
+                                 (see derive_password_async)
         """
         if self.has_user(username):
             raise ValueError('user %r already exists' % username)
@@ -35,60 +256,62 @@ class MySmartyAuthorizer(DummyAuthorizer):
             raise ValueError('no such directory: %r' % homedir)
         homedir = os.path.realpath(homedir)
         self._check_permissions(username, perm)
-        salt, key = MyCipher.derive_password_for_storage(password)
+        salt, key = derived_password or MyCipher.derive_password_for_storage(password)
         db.add_user_metadata(username, homedir, perm, '', msg_login, msg_quit, salt, key)
+        self._users.pop(username, None)
 
     def remove_user(self, username):
-        super().remove_user(username)
         db.remove_user_metadata(username)
+        self._users.pop(username, None)
 
     def validate_authentication(self, username, password, handler):
         msg = "Authentication failed."
         if not self.has_user(username):
             raise pyftpdlib.authorizers.AuthenticationFailed(msg)
-        try:
-            salt, hashed_pass = db.fetch_user_pass(username)
-            MyCipher.verify_stored_password(password, salt, hashed_pass)
-        except InvalidKey:
+        salt, hashed_pass = db.fetch_user_pass(username)
+        if not _verify_password(password, salt, hashed_pass):
             raise pyftpdlib.authorizers.AuthenticationFailed(msg)
 
     def get_home_dir(self, username):
-        return db.fetch_user_metadata(username)[0]
+        return self._user(username)[0]
 
     def has_user(self, username):
-        return db.has_user(username)
+        return self._fetch_user(username) is not None
 
     def has_perm(self, username, perm, path=None):
-        if path is None:
-            return perm in self.get_perms(username)
+        """
+        Like DummyAuthorizer.has_perm, the first permission override set (by override_perm) which applies to the path
+        is used, else the user's permissions. Only the overrides of the path and its parents are looked up.
+        """
+        _, perms, _, _, operms = self._user(username)
+        if path is None or not operms:
+            return perm in perms
 
         path = os.path.normcase(path)
-        operms = self.get_operms(username)
-        if not operms:
-            return perm in self.get_perms(username)
-        for dir in operms.keys():
-            operm, recursive = operms[dir]
-            if self._issubpath(path, dir):
-                if recursive:
-                    return perm in operm
-                if (path == dir or os.path.dirname(path) == dir and not
-                        os.path.isdir(path)):
-                    return perm in operm
-        return perm in self.get_perms(username)
+        names = path.rstrip(os.sep).split(os.sep)
+        found = None
+        for depth in range(len(names), 0, -1):
+            override = operms.get(os.sep.join(names[:depth]))
+            if override is None or found is not None and found[0] < override[0]:
+                continue
+            _, dir, operm, recursive = override
+            if recursive or path == dir or os.path.dirname(path) == dir and not os.path.isdir(path):
+                found = override
+        return perm in (found[2] if found else perms)
 
     def get_perms(self, username):
         """Return current user permissions."""
-        return db.fetch_user_metadata(username)[1]
+        return self._user(username)[1]
 
     def get_operms(self, username):
-        return db.fetch_operms(username)
+        return {dir: [operm, recursive] for _, dir, operm, recursive in sorted(self._user(username)[4].values())}
 
     def get_msg_login(self, username):
-        return db.fetch_user_metadata(username)[2]
+        return self._user(username)[2]
 
     def get_msg_quit(self, username):
         try:
-            return db.fetch_user_metadata(username)[3]
+            return self._user(username)[3]
         except KeyError:
             return "Goodbye."
 
@@ -109,6 +332,11 @@ class MyDBFS(AbstractedFS):
          becomes:
          [root]/1/2
     """
+
+    def __init__(self, root, cmd_channel):
+        super().__init__(root, cmd_channel)
+        self._listed = None
+
     def ftp2fs(self, ftppath):
         return self.cmd_channel.file_meta_handler.get_numpath(self.ftpnorm(ftppath))
 
@@ -117,19 +345,195 @@ class MyDBFS(AbstractedFS):
 
     def listdir(self, path):
         """
-        Gets ftp-filenames (not full paths) for each file.
-        NLST works. LIST doesn't work!
+        Gets ftp-filenames (not full paths) for each file, resolving all of them with a single query.
+        The numpaths and stored sizes of the entries are kept for formatting LIST and MLSD output (see lstat).
+        """
+        filenums = [filenum for filenum in super().listdir(path)
+                    if not (filenum.endswith(('.db', '.db-wal', '.db-shm')) or filenum == 'mtag')]
+        entries = self.cmd_channel.file_meta_handler.fetch_dir_entries(int(path.split(os.sep)[-1]))
+        listed = {}
+        for filenum in filenums:
+            filename, size = entries.get(int(filenum), (filenum, None)) if filenum.isdigit() else (filenum, None)
+            listed[filename] = (os.path.join(path, filenum), size)
+        self._listed = (path, listed)
+        return list(listed)
+
+    def _stat_listed(self, path, stat_fun):
+        """
+        Stat an entry of the last listed directory by its ftp-filename, reporting its stored size.
+        pyftpdlib formats LIST and MLSD lines by stat-ing basedir/filename for each listed filename.
         """
-        return [self.cmd_channel.file_meta_handler.fetch_filename(filenum) or filenum
-                for filenum in super().listdir(path)
-                if not (filenum.endswith('.db') or filenum == 'mtag')]
+        dirname, filename = os.path.split(path)
+        if self._listed is None or dirname != self._listed[0] or filename not in self._listed[1]:
+            return stat_fun(path)
+        numpath, size = self._listed[1][filename]
+        st = stat_fun(numpath)
+        if size is not None:
+            st = os.stat_result(st[:6] + (size,) + st[7:])
+        return st
+
+    def lstat(self, path):
+        return self._stat_listed(path, super().lstat)
+
+    def stat(self, path):
+        return self._stat_listed(path, super().stat)
 
     def rename(self, src, dst):
-        super().rename(src, dst)
-        src_num = int(src.split(os.sep)[-1])
-        dst_num = int(dst.split(os.sep)[-1])
-        self.cmd_channel.file_meta_handler.remove_filenum(src_num)
-        self.cmd_channel.file_meta_handler.update_filenum_in_meta(src_num, dst_num)
+        """
+        Move the source entry (keeping its number) into the destination's parent directory, under the
+        destination's name. A directory's subtree moves along with it, so this costs the same for any
+        directory size. The destination's entry (created when its path was translated, or an existing file
+        being replaced) is removed.
+        """
+        src_num = int(os.path.basename(src))
+        dst_num = int(os.path.basename(dst))
+        if src_num == dst_num:
+            return
+        if self.lexists(dst):
+            # replace the destination, like os.rename() does
+            if self.isdir(dst) != self.isdir(src):
+                code = errno.EISDIR if self.isdir(dst) else errno.ENOTDIR
+                raise OSError(code, os.strerror(code))
+            if self.isdir(dst):
+                self.rmdir(dst)
+            else:
+                self.remove(dst)
+        super().rename(src, os.path.join(os.path.dirname(dst), str(src_num)))
+        self.cmd_channel.file_meta_handler.move_entry(src_num, dst_num)
+
+
+class TaggedFileProducer(FileProducer):
+    """
+    A file producer which sends a trailer (the file's MAC tag) right after the file data.
+    The file data is sent from the current position of the file up to the given end (for ranged reads, see RANG).
+    """
+
+    def __init__(self, file, type, trailer, end):
+        super().__init__(file, type)
+        self.trailer = trailer
+        self.end = end
+
+    def more(self):
+        self.buffer_size = min(FileProducer.buffer_size, max(0, self.end - self.file.tell()))
+        data = super().more() if self.buffer_size else b''
+        if not data and self.trailer:
+            data, self.trailer = self.trailer, b''
+        return data
+
+
+class MyDTPHandler(DTPHandler):
+    """
+    The custom data channel handler used by the server.
+    It supports TaggedFileProducer while still sending the file itself with sendfile():
+    once the file was sent, the trailer is sent with a regular send() before closing the channel.
+    """
+
+    def __init__(self, sock, cmd_channel):
+        self._trailer = b''
+        self._file_end = None
+        self._sendfile = True
+        super().__init__(sock, cmd_channel)
+
+    def use_sendfile(self):
+        return self._sendfile and super().use_sendfile()
+
+    def close(self):
+        if metrics.enabled and not self._closed:
+            metrics.data_bytes.inc(self.tot_bytes_received, 'in')
+            metrics.data_bytes.inc(self.tot_bytes_sent, 'out')
+            self.cmd_channel._data_bytes[0] += self.tot_bytes_received
+            self.cmd_channel._data_bytes[1] += self.tot_bytes_sent
+        super().close()
+
+    def readable(self):
+        if not self.receive and not self._initialized:
+            # the data was sent right after connecting, before the transfer command was processed (see STOT):
+            # stop polling the connection until receiving is enabled, rather than dropping it
+            self.modify_ioloop_events(0)
+            return False
+        return super().readable()
+
+    def push_with_producer(self, producer):
+        if isinstance(producer, TaggedFileProducer):
+            # with only (part of) the trailer left to send (REST past the file data), the producer sends it
+            self._sendfile = producer.file.tell() < producer.end
+        if isinstance(producer, TaggedFileProducer) and self.use_sendfile():
+            self._trailer = producer.trailer
+            self._file_end = producer.end
+        super().push_with_producer(producer)
+        if 'initiate_send' not in self.__dict__:
+            # sendfile() is not used, the producer sends the trailer itself
+            self._trailer = b''
+            self._file_end = None
+
+    def initiate_sendfile(self):
+        if self._file_end is None:
+            super().initiate_sendfile()
+            return
+        if self._offset >= self._file_end:
+            trailer, self._trailer = self._trailer, b''
+            self._file_end = None
+            del self.initiate_send
+            # send the trailer before the close-when-done marker already queued
+            if trailer:
+                self.producer_fifo.appendleft(trailer)
+            self.initiate_send()
+            return
+        # don't send past the end of the requested range
+        self.ac_out_buffer_size = min(DTPHandler.ac_out_buffer_size, self._file_end - self._offset)
+        try:
+            super().initiate_sendfile()
+        finally:
+            del self.ac_out_buffer_size
+
+
+class FuturePoller(object):
+    """
+    Polls the futures waited for by the sessions of an IOLoop (see MyFTPHandler.wait_for) with a single timer,
+    which only runs while some are pending, so concurrent logins don't each wake the IOLoop up.
+    """
+
+    # IOLoop -> its poller
+    _pollers = weakref.WeakKeyDictionary()
+
+    def __init__(self, ioloop, interval):
+        """
+        :param ioloop: (IOLoop) the IOLoop to run the callbacks in
+        :param interval: (float) seconds between checks
+        """
+        self.ioloop = ioloop
+        self.interval = interval
+        self._waiting = []
+        self._timer = None
+
+    @classmethod
+    def of(cls, ioloop, interval):
+        """
+        :return: (FuturePoller) the poller of the IOLoop (created with the given interval if it has none)
+        """
+        poller = cls._pollers.get(ioloop)
+        if poller is None:
+            poller = cls._pollers[ioloop] = cls(ioloop, interval)
+        return poller
+
+    def add(self, future, callback):
+        """
+        Call callback with the future once it's done.
+        """
+        self._waiting.append((future, callback))
+        if self._timer is None:
+            self._timer = self.ioloop.call_every(self.interval, self._poll)
+
+    def _poll(self):
+        waiting, self._waiting = self._waiting, []
+        for future, callback in waiting:
+            if future.done():
+                callback(future)
+            else:
+                self._waiting.append((future, callback))
+        if not self._waiting:
+            self._timer.cancel()
+            self._timer = None
 
 
 class MyFTPHandler(FTPHandler):
@@ -141,12 +545,30 @@ class MyFTPHandler(FTPHandler):
     New protocol commands added:
         RGTR - registration
         TAG - receive file MAC tag from the user
+        STOT - receive a file followed by its MAC tag from the user (STOR and TAG in one command)
         META - transfer the file metadata to the user for them to send an updated verification tag for it
         LGMETA - transfer the file metadata to the user to verify integrity on login
         METATAG - receive the MAC tag of the file metadata from the user
         LGVF - transfer the MAC tag of the file metadata to the user to verify integrity on login
+        MTREE - transfer the file metadata changes since the last tag to the user for them to send an updated tag
+        LGTREE - transfer all file metadata entries and the changes since the last tag to the user,
+                 for login verification
+        TREETAG - receive the MAC tag of the file metadata tree's root from the user
+        TCKT - issue a session ticket to the logged in user
+        RSME - log in with a session ticket instead of a password (follows USER)
+        STSG - receive a segment of a file at the REST position (see MyFTPClient.store_segments)
+        STSE - complete a file received in segments, storing the MAC tag it ends with (see STSG)
+        RANG - set the byte range of the next RETR (the stored file followed by its MAC tag)
+        PLEN - send the committed length of a partially uploaded file, for resuming the upload with STSG
     """
 
+    dtp_handler = MyDTPHandler
+    # seconds between checks for results from the authorizer's process pool (or the file check thread pool)
+    wait_poll_interval = 0.005
+    # number of threads checking files on login (see handle_auth_success), 0 checks them in the IOLoop
+    file_check_workers = 0
+    _file_check_pool = None
+
     def __init__(self, conn, server, ioloop=None):
         super().__init__(conn, server, ioloop)
 
@@ -158,6 +580,9 @@ class MyFTPHandler(FTPHandler):
             'TAG': dict(
                 perm='w', auth=True, arg=True,
                 help='Syntax: TAG <SP> tag (store a file tag).'),
+            'STOT': dict(
+                perm='w', auth=True, arg=True,
+                help='Syntax: STOT <SP> file-name (store a file followed by its tag).'),
             'META': dict(
                 perm='w', auth=True, arg=False,
                 help='Syntax: META (send file metadata db for fs updates).'),
@@ -169,13 +594,47 @@ class MyFTPHandler(FTPHandler):
                 help='Syntax: METATAG <SP> tag (store the file metadata db tag).'),
             'LGVF': dict(
                 perm='w', auth=True, arg=False,
-                help='Syntax: LGVF (send the file metadata db tag).')
+                help='Syntax: LGVF (send the file metadata db tag).'),
+            'MTREE': dict(
+                perm=None, auth=True, arg=False,
+                help='Syntax: MTREE (send file metadata changes for fs updates).'),
+            'LGTREE': dict(
+                perm=None, auth=True, arg=False,
+                help='Syntax: LGTREE (send file metadata entries and changes for login verification).'),
+            'TREETAG': dict(
+                perm=None, auth=True, arg=True,
+                help='Syntax: TREETAG <SP> tag (store the file metadata tree tag).'),
+            'TCKT': dict(
+                perm=None, auth=True, arg=False,
+                help='Syntax: TCKT (issue a session ticket).'),
+            'RSME': dict(
+                perm=None, auth=False, arg=True,
+                help='Syntax: RSME <SP> ticket (log in with a session ticket).'),
+            'STSG': dict(
+                perm='w', auth=True, arg=True,
+                help='Syntax: STSG <SP> file-name (store a file segment at the REST position).'),
+            'STSE': dict(
+                perm='w', auth=True, arg=True,
+                help='Syntax: STSE <SP> file-name (complete a file stored in segments).'),
+            'RANG': dict(
+                perm=None, auth=True, arg=True,
+                help='Syntax: RANG <SP> start-point <SP> end-point (set the byte range of the next RETR).'),
+            'PLEN': dict(
+                perm='w', auth=True, arg=True,
+                help='Syntax: PLEN <SP> file-name (send the committed length of a partial upload).')
         })
 
         self._registering = False
         self._received_file = None
-        self._sending_temp_file = False
+        self._tagged_upload = None
+        self._segment_upload = None
+        self._range_end = None
+        self._tree_seq = None
         self.file_meta_handler = None
+        # the command waiting for its final reply and when it was received, and the data bytes in and out
+        # (recorded with metrics enabled)
+        self._timed_command = None
+        self._data_bytes = [0, 0]
 
     def ftp_RGTR(self, line):
         """
@@ -197,20 +656,114 @@ class MyFTPHandler(FTPHandler):
         if not self._received_file:
             self.respond("503 Bad sequence of commands: use STOR first.")
             return
-        filesize = self.fs.getsize(self._received_file)
-        filenum = self._received_file.split(os.sep)[-1]
-        if not self.file_meta_handler.fetch_tag(filenum):
-            self.file_meta_handler.add_file_meta(filenum, line, filesize)
-        else:
-            self.file_meta_handler.update_file_meta(filenum, line, filesize)
+        self._store_file_meta(self._received_file, line, self.fs.getsize(self._received_file))
         self._received_file = None
         self.respond("250 File transfer completed.")
 
+    def _store_file_meta(self, file, tag, size):
+        self.file_meta_handler.store_file_meta(file.split(os.sep)[-1], tag, size)
+
+    def ftp_STOR(self, file, mode='w'):
+        self._tagged_upload = None
+        return super().ftp_STOR(file, mode)
+
+    def ftp_STOT(self, file):
+        """
+        Store a file followed by its MAC tag (the last TAG_SIZE bytes received), saving the TAG round trip.
+        The file is complete once the second response (250) is sent, right after 226.
+        The metadata tag is not requested, so it can be updated once for a batch of uploads (see MTREE).
+        """
+        if self._restart_position:
+            self._restart_position = 0
+            self.respond("504 REST is not supported with STOT.")
+            return
+        self._tagged_upload = file
+        return super().ftp_STOR(file)
+
+    def ftp_STSG(self, file):
+        """
+        Store a segment of a file at the REST position, without truncating the file (unless at position 0),
+        so a large file can be uploaded over several connections at once, each segment with its own session.
+        The first segment (position 0) must be started before the others, and STSE must follow once all are stored.
+        """
+        rest_pos = self._restart_position
+        if rest_pos:
+            try:
+                # segments may arrive in any order, extend the file up to this one (REST beyond the end is refused)
+                with self.run_as_current_user(self.fs.open, file, 'ab') as fo:
+                    if fo.tell() < rest_pos:
+                        fo.truncate(rest_pos)
+            except (EnvironmentError, FilesystemError) as err:
+                self._restart_position = 0
+                self.respond('550 %s.' % _strerror(err))
+                return
+        self._segment_upload = file
+        return super().ftp_STOR(file, mode='r+' if rest_pos else 'w')
+
+    def ftp_PLEN(self, file):
+        """
+        Send the committed length of a partially uploaded file (an interrupted STOT or STSG) and its stream header,
+        so the user can resume the upload from the first missing record, with STSG at that position and then STSE.
+        Files whose upload was completed (their size is the stored one) have nothing to resume.
+        """
+        if not self.fs.isfile(file):
+            self.respond("550 No such file.")
+            return
+        size = self.fs.getsize(file)
+        stored_size = self.file_meta_handler.fetch_size(file.split(os.sep)[-1])
+        if stored_size and stored_size[0] == size:
+            self.respond("550 File upload is complete.")
+            return
+        try:
+            with self.run_as_current_user(self.fs.open, file, 'rb') as fo:
+                committed = stream_committed_length(fo, size)
+                fo.seek(0)
+                header = fo.read(STREAM_HEADER.size)
+        except (EnvironmentError, FilesystemError) as err:
+            self.respond('550 %s.' % _strerror(err))
+            return
+        if not committed:
+            self.respond("550 Nothing to resume.")
+            return
+        self.respond("213 %d %s" % (committed, header.hex()))
+
+    def ftp_STSE(self, file):
+        """
+        Complete a file uploaded in segments (see STSG), which ends with its MAC tag as with STOT.
+        The server can't verify the segments (only their owner holds the key), but it checks that they make up
+        a whole stream before storing the file metadata, the client verifies the records and the file tag on download.
+        """
+        if not self.fs.isfile(file):
+            self.respond("550 No such file.")
+            return
+        self._on_tagged_file_received(file)
+
+    def _on_tagged_file_received(self, file):
+        """
+        Strip the MAC tag off a file received with STOT (or STSG) and store it.
+        The records of the stream are checked first (see check_stream_layout), as a connection closed midway
+        looks like a complete upload. An incomplete file is kept for resuming the upload (see PLEN).
+        :param file: (str) the received file
+        """
+        with self.fs.open(file, 'r+b') as fo:
+            size = fo.seek(0, os.SEEK_END) - TAG_SIZE
+            valid = size >= 0 and check_stream_layout(fo, size)
+            if valid:
+                fo.seek(size)
+                tag = fo.read()
+                fo.truncate(size)
+        if not valid:
+            self.respond("554 Incomplete file, the upload can be resumed.")
+            return
+        self._store_file_meta(file, tag.hex(), size)
+        self.respond("250 File transfer completed.")
+
     def ftp_META(self, line):
         """
         Send the file metadata to the user for them to generate and send an updated MAC tag for it.
         Expect a METATAG call to follow.
         """
+        self.file_meta_handler.sync_db_file(enable_wal=True)
         super().ftp_RETR(self.file_meta_handler.meta_db_path)
         self.respond('351 Waiting for meta tag.')
 
@@ -218,15 +771,45 @@ class MyFTPHandler(FTPHandler):
         """
         Send the file metadata to the user for them to verify the integrity of their stored files.
         """
-        super().ftp_RETR(self.file_meta_handler.meta_db_path)
+        self.file_meta_handler.sync_db_file()
+        super().ftp_RETR(self.file_meta_handler.verification_db_path)
         self.respond('269 Metadata transfer complete.')
 
     def ftp_METATAG(self, line):
         """
         Receive an updated MAC tag for the file metadata.
         """
-        with open(self.file_meta_handler.root + os.sep + 'mtag', 'wb') as fo:
-            fo.write(bytes.fromhex(line))
+        self.file_meta_handler.store_meta_tag(bytes.fromhex(line))
+
+    def ftp_MTREE(self, line):
+        """
+        Send the file metadata changes since the last tag, each with the siblings along its path in the Merkle tree,
+        and that tag, for the user to check them against the tagged root and tag the new one.
+        Expect a TREETAG call to follow.
+        """
+        self._tree_seq, updates, mtag, _ = self.file_meta_handler.fetch_tree_snapshot()
+        self.push_dtp_data(json.dumps({'updates': updates, 'tag': mtag.hex()}).encode(), cmd='MTREE')
+
+    def ftp_LGTREE(self, line):
+        """
+        Send all file metadata entries, the changes since the last tag and that tag, for the user to verify
+        the integrity of their stored files.
+        """
+        self._tree_seq, updates, mtag, rows = self.file_meta_handler.fetch_tree_snapshot(_rows=True)
+        self.push_dtp_data(json.dumps({'rows': rows, 'updates': updates, 'tag': mtag.hex()}).encode(), cmd='LGTREE')
+
+    def ftp_TREETAG(self, line):
+        """
+        Receive an updated MAC tag for the root of the file metadata tree (following MTREE or LGTREE).
+        """
+        if self._tree_seq is None:
+            self.respond("503 Bad sequence of commands: use MTREE first.")
+            return
+        if self.file_meta_handler.store_tree_tag(bytes.fromhex(line), self._tree_seq):
+            self.respond("250 Metadata tag stored.")
+        else:
+            self.respond("250 A newer metadata tag is stored.")
+        self._tree_seq = None
 
     def ftp_LGVF(self, line):
         """
@@ -235,30 +818,142 @@ class MyFTPHandler(FTPHandler):
         with open(self.file_meta_handler.root + os.sep + 'mtag', 'rb') as fo:
             self.respond('256 ' + fo.read().hex())
 
+    def ftp_TCKT(self, line):
+        """
+        Issue a session ticket, to be used with RSME on later connections.
+        The response holds the ticket and the number of seconds it is valid for.
+        """
+        self.respond('259 %s %d' % (self.authorizer.issue_ticket(self.username), self.authorizer.ticket_lifetime))
+
+    def ftp_RSME(self, line):
+        """
+        Log in with a session ticket (see TCKT) instead of a password, skipping the password derivation.
+        Otherwise the same as PASS on login.
+        """
+        if self.authenticated:
+            self.respond("503 User already authenticated.")
+            return
+        if not self.username or self._registering:
+            self.respond("503 Login with USER first.")
+            return
+
+        try:
+            self.authorizer.validate_ticket(self.username, line)
+            home = self.authorizer.get_home_dir(self.username)
+            msg_login = self.authorizer.get_msg_login(self.username)
+        except (pyftpdlib.authorizers.AuthenticationFailed, pyftpdlib.authorizers.AuthorizerError) as err:
+            self.handle_auth_failed(str(err), line)
+        else:
+            self.handle_auth_success(home, line, msg_login)
+
     def ftp_PASS(self, line):
         """
-        On login, continue normally (super-method).
-        On registration, create a root folder for the user and add their data to the local user database.
+        On login, verify the password in the authorizer's process pool, then continue as the super-method.
+        On registration, derive the password for storage in the pool, then create a root folder for the user
+        and add their data to the local user database.
+        Other sessions are served in the meantime; this session's commands are not read until it's done.
         """
-        if not self._registering:
+        if self.authenticated or not self.username:
             super().ftp_PASS(line)
             return
 
         username = self.username
+        if not self._registering:
+            self.wait_for(self.authorizer.validate_authentication_async(username, line),
+                          lambda future: self._on_password_validated(future, username, line))
+            return
+
+        self.wait_for(self.authorizer.derive_password_async(line),
+                      lambda future: self._register(future, username, line))
+
+    def _on_password_validated(self, future, username, line):
+        try:
+            if not future.result():
+                raise pyftpdlib.authorizers.AuthenticationFailed('Authentication failed.')
+            home = self.authorizer.get_home_dir(username)
+            msg_login = self.authorizer.get_msg_login(username)
+        except (pyftpdlib.authorizers.AuthenticationFailed, pyftpdlib.authorizers.AuthorizerError) as err:
+            self.handle_auth_failed(str(err), line)
+        else:
+            self.handle_auth_success(home, line, msg_login)
+
+    def _register(self, future, username, line):
+        """
+        Once the password is derived, create the user's root folder, add the user and log in.
+        The name may have been registered by another session in the meantime: then nothing is kept (550).
+        """
+        derived_password = future.result()
         self.flush_account()
         self.username = username
-        homedir = db.fetch_next_user_num()
-        self.handle_auth_success(str(homedir), line, 'New USER "%s" registered.' % username)
-        self.fs.mkdir(str(homedir))
+        homedir = None
+        try:
+            if self.authorizer.has_user(username):
+                raise ValueError('user %r already exists' % username)
+            homedir = str(db.allocate_user_num())
+            os.mkdir(homedir)
+            self.authorizer.add_user(username, line, homedir, perm='elradfmwMT', derived_password=derived_password)
+        except (ValueError, sqlite3.IntegrityError):
+            if homedir is not None:
+                os.rmdir(homedir)
+            self.flush_account()
+            self._registering = False
+            self.respond("550 Username already exists. Choose a different name.")
+            return
+        self.handle_auth_success(homedir, line, 'New USER "%s" registered.' % username)
         self.file_meta_handler.create_file_metadata()
-        self.authorizer.add_user(username, line, str(homedir), perm='elradfmwMT')
         self._registering = False
 
+    def wait_for(self, future, callback):
+        """
+        Wait for a future (e.g. running in the authorizer's process pool) without blocking the IOLoop,
+        then call callback with it. Commands from this session are not read in the meantime.
+        :param future: (Future) the future to wait for
+        :param callback: (Callable) called with the done future
+        """
+        if future.done():
+            callback(future)
+            return
+
+        def on_done(future):
+            if self._closed:
+                return
+            self.add_channel()
+            try:
+                callback(future)
+            except Exception:
+                self.handle_error()
+
+        self.del_channel()
+        FuturePoller.of(self.ioloop, self.wait_poll_interval).add(future, on_done)
+
+    def ftp_REST(self, line):
+        self._range_end = None
+        return super().ftp_REST(line)
+
+    def ftp_RANG(self, line):
+        """
+        Set the byte range of the next RETR (as in the FTP range draft, the end point is inclusive),
+        so a large file can be downloaded over several connections at once, a segment each.
+        The range is within the file followed by its MAC tag, as sent by RETR.
+        """
+        try:
+            start, end = [int(point) for point in line.split()]
+            if start < 0 or end < start - 1:
+                raise ValueError
+        except ValueError:
+            self.respond("501 Invalid RANG parameters.")
+            return
+        self._restart_position = start
+        self._range_end = end + 1
+        self.respond("350 Restarting at %d. End byte range at %d." % (start, end))
+
     def ftp_RETR(self, file):
         """
-        Create a temporary file with the requested file data and tag from the db appended to it
-        and call the super-method with it (file transfer to user).
+        Send the requested file followed by its tag from the db (file transfer to user).
+        The file is streamed as is (with sendfile() where possible) and the tag is sent as a trailer.
+        With REST or RANG, only the requested part of the file followed by the tag is sent.
         """
+        range_end, self._range_end = self._range_end, None
         filenum = file.split(os.sep)[-1]
         stored_size = self.file_meta_handler.fetch_size(filenum)
         if not stored_size:
@@ -267,13 +962,29 @@ class MyFTPHandler(FTPHandler):
         if stored_size != self.fs.getsize(file):
             self.respond('555 File size changed.')
             return
-        temp_filename = file + '__temp__'
-        with self.fs.open(temp_filename, 'wb') as temp_file, self.fs.open(file, 'rb') as fd:
-            temp_file.write(fd.read())
-            temp_file.write(bytes.fromhex(self.file_meta_handler.fetch_tag(filenum)[0]))
+        tag = bytes.fromhex(self.file_meta_handler.fetch_tag(filenum)[0])
 
-        self._sending_temp_file = True
-        return super().ftp_RETR(temp_filename)
+        rest_pos = self._restart_position
+        self._restart_position = 0
+        end = stored_size + TAG_SIZE if range_end is None else min(stored_size + TAG_SIZE, range_end)
+        if rest_pos > stored_size + TAG_SIZE:
+            self.respond('554 REST position (%s) > file size (%s)' % (rest_pos, stored_size + TAG_SIZE))
+            return
+        try:
+            fd = self.run_as_current_user(self.fs.open, file, 'rb')
+        except (EnvironmentError, FilesystemError) as err:
+            self.respond('550 %s.' % _strerror(err))
+            return
+        try:
+            if rest_pos:
+                fd.seek(min(rest_pos, stored_size))
+            trailer = tag[max(0, rest_pos - stored_size):max(0, end - stored_size)]
+            producer = TaggedFileProducer(fd, self._current_type, trailer, min(end, stored_size))
+            self.push_dtp_data(producer, isproducer=True, file=fd, cmd="RETR")
+            return file
+        except Exception:
+            fd.close()
+            raise
 
     def ftp_DELE(self, path):
         super().ftp_DELE(path)
@@ -287,21 +998,59 @@ class MyFTPHandler(FTPHandler):
         """
         After a STOR command was done (a file was uploaded from the user), expect a MAC tag for it.
         """
+        if file == self._tagged_upload:
+            self._tagged_upload = None
+            self._on_tagged_file_received(file)
+            return
+        if file == self._segment_upload:
+            # the file is complete once all segments were received (see STSE)
+            self._segment_upload = None
+            return
         self._received_file = file
         self.respond("350 Ready for authentication tag.")
 
-    def on_file_sent(self, file):
-        if self._sending_temp_file:
-            os.remove(file)
-            self._sending_temp_file = False
-
-    def on_incomplete_file_sent(self, file):
-        self.on_file_sent(file)
+    def on_incomplete_file_received(self, file):
+        self._tagged_upload = None
+        self._segment_upload = None
 
     def on_file_deleted(self, path):
         filenum = path.split(os.sep)[-1]
         self.file_meta_handler.remove_file_by_num(filenum)
 
+    def close(self):
+        closed = self._closed
+        super().close()
+        if self.file_meta_handler:
+            self.file_meta_handler.close()
+        if metrics.enabled and not closed:
+            metrics.session_data_bytes.observe(self._data_bytes[0], 'in')
+            metrics.session_data_bytes.observe(self._data_bytes[1], 'out')
+
+    def process_command(self, cmd, *args, **kwargs):
+        """
+        With metrics enabled, the time until the command's final (not 1xx) reply is recorded
+        (see metrics.command_seconds), including transfers and work done outside the IOLoop.
+        """
+        if metrics.enabled:
+            self._timed_command = (cmd, time.perf_counter())
+        super().process_command(cmd, *args, **kwargs)
+
+    def respond(self, resp, *args, **kwargs):
+        super().respond(resp, *args, **kwargs)
+        if self._timed_command is not None and not resp.startswith('1'):
+            cmd, start = self._timed_command
+            self._timed_command = None
+            metrics.command_seconds.observe(time.perf_counter() - start, cmd)
+
+    def logline(self, msg, *args, **kwargs):
+        # session tickets are masked like passwords (see FTPHandler.pre_process_command)
+        if msg[3:8].upper() == 'RSME ' or msg.startswith('-> 259 '):
+            msg = ' '.join(msg.split(' ')[:2] + ['*' * 6])
+        super().logline(msg, *args, **kwargs)
+
+    def log_cmd(self, cmd, arg, respcode, respstr):
+        super().log_cmd(cmd, '*' * 6 if cmd == 'RSME' else arg, respcode, respstr)
+
     def pre_process_command(self, line, cmd, arg):
         if cmd in ('TAG', 'META', 'LGMETA', 'METATAG', 'LGVF'):
             self.logline("<- %s" % line)
@@ -314,16 +1063,30 @@ class MyFTPHandler(FTPHandler):
         On login success, check for missing / renamed files and resized files by comparing
         the current state of files with their saved state, stored in a local database.
         A response is sent accordingly (230 if everything is ok, 556 if anomalies were detected)
+        Only files changed since the last login are compared (see FileMetaHandler.find_anomalies).
+        With file_check_workers, the check runs in a thread and the response is streamed (see stream_file_check).
         """
+        if self.file_meta_handler:
+            self.file_meta_handler.close()
         self.file_meta_handler = db.FileMetaHandler(home)
         super().handle_auth_success(home, password, msg_login)
         if self._registering:
             return
+        # upgrade the metadata db of existing users to the current schema
+        self.file_meta_handler.create_file_metadata()
+        self.file_meta_handler.load_paths()
+        if self.file_check_workers:
+            self.stream_file_check(home)
+            return
+
         msg = '556 '
-        missing_files = [ftppath for ftppath, numpath in self.file_meta_handler.fetch_all_files()
-                         if not self.fs.lexists(numpath)]
-        altered_size_files = [ftppath for numpath, ftppath, size in self.file_meta_handler.fetch_all_file_sizes()
-                              if self.fs.lexists(numpath) and size != self.fs.getsize(numpath)]
+        missing_files = []
+        altered_size_files = []
+        start = time.perf_counter()
+        for anomaly, ftppath in self.file_meta_handler.find_anomalies():
+            (missing_files if anomaly == 'missing' else altered_size_files).append(ftppath)
+        if metrics.enabled:
+            metrics.login_check_seconds.observe(time.perf_counter() - start)
         if missing_files:
             msg += 'The following files have been removed or renamed: %s. ' % ', '.join(missing_files)
         if altered_size_files:
@@ -334,10 +1097,107 @@ class MyFTPHandler(FTPHandler):
         else:
             self.respond('230 All files unchanged')
 
+    @classmethod
+    def file_check_pool(cls):
+        if cls._file_check_pool is None:
+            cls._file_check_pool = ThreadPoolExecutor(cls.file_check_workers)
+        return cls._file_check_pool
+
+    def stream_file_check(self, home):
+        """
+        Run the login file check in the file check thread pool, so the IOLoop keeps serving other sessions.
+        Every anomaly is sent as soon as it's found, as a line of a multi-line 556 response
+        (or 230 if everything is ok). As with wait_for, commands from this session are not read in the meantime.
+        :param home: (str) the user's home directory
+        """
+        notices = queue.SimpleQueue()
+        cancelled = threading.Event()
+        future = self.file_check_pool().submit(_check_files, home, notices.put, cancelled)
+        messages = {'missing': 'The following file has been removed or renamed: %s',
+                    'resized': 'The following file\'s size has been altered: %s'}
+        found = False
+
+        def poll():
+            nonlocal found
+            if self._closed:
+                cancelled.set()
+                poller.cancel()
+                return
+            done = future.done()
+            while not notices.empty():
+                anomaly, ftppath = notices.get()
+                found = True
+                self.push('556-%s\r\n' % messages[anomaly] % ftppath)
+            if not done:
+                return
+            poller.cancel()
+            # (a reply which didn't fit in the socket's buffer may have registered the channel again)
+            if self._fileno not in self.ioloop.socket_map:
+                self.add_channel()
+            future.result()
+            if found:
+                self.respond('556 Some files have been removed, renamed or altered.')
+            else:
+                self.respond('230 All files unchanged')
+
+        self.del_channel()
+        poller = self.ioloop.call_every(self.wait_poll_interval, poll, _errback=self.handle_error)
+
+
+def serve(address, handler, workers=1, metrics_port=None):
+    """
+    Run the FTP server. With several workers, that many processes are forked (and restarted if they crash,
+    see pyftpdlib's fork_processes), each with its own IOLoop and its own socket listening on the address
+    (SO_REUSEPORT), so the kernel spreads the connections between them.
+    Sessions of the same user may be served by different processes: they share nothing but the users db,
+    the user's metadata dbs and tag file, whose updates are atomic (see db.FileMetaHandler).
+    It returns once interrupted (SIGINT to all the processes, as sent by Ctrl+C).
+    :param address: (Tuple(str, int)) address to listen on
+    :param handler: (type) the FTP handler class, with its authorizer set
+    :param workers: (int) number of server processes (0 for one per CPU)
+    :param metrics_port: (int) port to expose metrics on, on the loopback interface (see metrics.serve),
+                         None to disable them. Every worker exposes its own, on the next ports.
+    """
+    task_id = 0
+    if workers != 1:
+        authorizer = handler.authorizer
+        # generate the ticket key before forking, so all workers load it
+        authorizer.ticket_key
+        if authorizer.password_workers is None:
+            # split the CPUs between the workers' password pools
+            authorizer.password_workers = max(1, os.cpu_count() // (workers or os.cpu_count()))
+        db.close_users_dbcon()
+        try:
+            task_id = fork_processes(workers)
+        except KeyboardInterrupt:
+            # the workers are interrupted too, and stop on their own
+            with contextlib.suppress(ChildProcessError):
+                while True:
+                    os.wait()
+            return
+        address = socket.create_server(address, reuse_port=True)
+    if metrics_port is not None:
+        metrics.serve(('127.0.0.1', metrics_port + task_id))
+
+    server = FTPServer(address, handler)
+
+    # set a limit for connections (per process)
+    server.max_cons = 256
+    server.max_cons_per_ip = 5
+
+    # start ftp server
+    server.serve_forever()
+
 
 def main():
     global ip
 
+    parser = argparse.ArgumentParser(description='The encrypted FTP server.')
+    parser.add_argument('--workers', type=int, default=1, help='number of server processes (0 for one per CPU)')
+    parser.add_argument('--metrics', type=int, metavar='PORT',
+                        help='expose metrics at http://127.0.0.1:PORT/metrics (the next ports for more workers)')
+    args = parser.parse_args()
+
     if not os.path.exists('../server'):
         os.mkdir('../server')
     os.chdir('../server')
@@ -350,16 +1210,8 @@ def main():
     handler.authorizer = authorizer
     handler.abstracted_fs = MyDBFS
 
-    # Instantiate FTP server class and listen on localhost:21
-    address = (ip, 21)
-    server = FTPServer(address, handler)
-
-    # set a limit for connections
-    server.max_cons = 256
-    server.max_cons_per_ip = 5
-
-    # start ftp server
-    server.serve_forever()
+    # listen on port 21
+    serve((ip, 21), handler, args.workers, args.metrics)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,39 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import logging
+import asyncio
+import sqlite3
+import tempfile
+import textwrap
 import unittest
-from mycrypto import MyCipher
+import threading
+import contextlib
+import subprocess
+import urllib.request
+from concurrent.futures import Future
+from unittest import mock
+from ftplib import FTP, error_perm
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+from mycrypto import MyCipher, merkle_root, apply_tree_updates, check_stream_layout, record_offset, \
+    record_count, stream_chunk_count, stream_committed_length, stream_size, STREAM_VERSION, TAG_SIZE, \
+    TREE_TAG_MAGIC
+from pyftpdlib.authorizers import AuthenticationFailed
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.ioloop import IOLoop
+import db
+import server
+import client
+import aioclient
+import metrics
+import bench
 
 
 class TestMyCrypto(unittest.TestCase):
@@ -26,6 +60,787 @@ class TestMyCrypto(unittest.TestCase):
 
         pt = MyCipher(self.secret).decrypt(ct1).decode()
         self.assertEqual(filename, pt)
+        # the IV is derived from the secret and the filename
+        self.assertEqual(MyCipher.derive_key((self.secret + filename).encode())[:16], ct1[:16])
+
+    def test_mycipher_many(self):
+        cipher = MyCipher(self.secret)
+        filenames = [b'', b'a', b'file.txt', os.urandom(100)]
+        msgs = cipher.encrypt_many(filenames, is_filename=True)
+        self.assertEqual([cipher.encrypt(filename, is_filename=True) for filename in filenames], msgs)
+        self.assertEqual(filenames, cipher.decrypt_many(msgs))
+        self.assertEqual(filenames, cipher.decrypt_many(msgs, workers=3))
+
+        pts = [os.urandom(n) for n in (0, 31, 32, 5000)]
+        msgs = cipher.encrypt_many(pts, workers=2)
+        self.assertEqual(pts, [cipher.decrypt(msg) for msg in msgs])
+        self.assertEqual(pts, cipher.decrypt_many(msgs))
+
+        tampered = bytearray(msgs[1][0])
+        tampered[20] ^= 1
+        self.assertEqual([pts[0], None, pts[2]], cipher.decrypt_many([msgs[0], (bytes(tampered), msgs[1][1]), msgs[2]]))
+        self.assertEqual([], cipher.decrypt_many([]))
+
+        # authenticated, but not padded as PKCS7
+        for padded_pt in (bytes(32), bytes(31) + b'\x21', bytes(30) + b'\x01\x02'):
+            iv = os.urandom(16)
+            encryptor = Cipher(cipher._aes, modes.CBC(iv)).encryptor()
+            ct = iv + encryptor.update(padded_pt) + encryptor.finalize()
+            msg = (ct, cipher.get_hmac_tag(ct))
+            self.assertRaises(ValueError, cipher.decrypt, msg)
+            self.assertEqual([pts[1], None, pts[2]], cipher.decrypt_many([msgs[1], msg, msgs[2]]))
+
+    def _stream_roundtrip(self, data, chunk_size=1024, version=STREAM_VERSION):
+        encryptor = MyCipher(self.secret).stream_encryptor(chunk_size, version=version)
+        ct = b''.join(encryptor.iter_records(io.BytesIO(data))) + encryptor.file_tag()
+        decryptor = MyCipher(self.secret).stream_decryptor()
+        # feed in odd-sized pieces, as received from the network
+        pt = b''.join(decryptor.update(ct[i:i + 1000]) for i in range(0, len(ct), 1000))
+        return ct, pt + decryptor.finalize()
+
+    def test_mycipher_stream(self):
+        for size in (0, 1, 1024, 3000, 4096):
+            data = os.urandom(size)
+            self.assertEqual(data, self._stream_roundtrip(data)[1])
+            # streams of the previous version are still decrypted
+            ct, pt = self._stream_roundtrip(data, version=1)
+            self.assertEqual(data, pt)
+            self.assertEqual(stream_size(size, 1024, version=1) + 32, len(ct))
+
+    def test_mycipher_stream_tampered(self):
+        ct, _ = self._stream_roundtrip(os.urandom(3000))
+        for bad_ct in (ct[:-1100] + ct[-32:], ct[:100] + bytes([ct[100] ^ 1]) + ct[101:], ct[:-1]):
+            decryptor = MyCipher(self.secret).stream_decryptor()
+            with self.assertRaises(InvalidSignature):
+                decryptor.update(bad_ct)
+                decryptor.finalize()
+
+    def test_mycipher_stream_legacy(self):
+        data = os.urandom(3000)
+        iv_and_ct, tag = MyCipher(self.secret).encrypt(data)
+        decryptor = MyCipher(self.secret).stream_decryptor()
+        self.assertEqual(b'', decryptor.update(iv_and_ct + tag))
+        self.assertEqual(data, decryptor.finalize())
+
+    def test_mycipher_stream_segments(self):
+        data = os.urandom(5000)
+        cipher = MyCipher(self.secret)
+        encryptor = cipher.stream_encryptor(1024)
+        chunk_count = stream_chunk_count(len(data), 1024)
+        segments = [b''.join(encryptor.iter_range(io.BytesIO(data), start, stop, chunk_count))
+                    for start, stop in ((0, 2), (2, 4), (4, 5))]
+        stream = b''.join(segments)
+        self.assertEqual(record_offset(2, 1024), len(segments[0]))
+        self.assertEqual(chunk_count, record_count(len(stream), 1024))
+        self.assertEqual(len(stream), stream_size(len(data), 1024))
+        self.assertTrue(check_stream_layout(io.BytesIO(stream), len(stream)))
+        holed = segments[0] + bytes(len(segments[1])) + segments[2]
+        self.assertFalse(check_stream_layout(io.BytesIO(holed), len(holed)))
+        self.assertFalse(check_stream_layout(io.BytesIO(stream[:-1]), len(stream) - 1))
+
+        decryptor = cipher.stream_decryptor()
+        pt = decryptor.update(stream + encryptor.file_tag(chunk_count))
+        self.assertEqual(data, pt + decryptor.finalize())
+        decryptor = cipher.stream_decryptor(encryptor.header, 2, has_trailer=False)
+        self.assertEqual(data[2048:4096], decryptor.update(segments[1]))
+        decryptor.finalize_segment(4)
+        decryptor = cipher.stream_decryptor(encryptor.header, 2, has_trailer=False)
+        decryptor.update(segments[1][:-1])
+        with self.assertRaises(InvalidSignature):
+            decryptor.finalize_segment(4)
+
+    def test_stream_committed_length(self):
+        encryptor = MyCipher(self.secret).stream_encryptor(1024)
+        stream = b''.join(encryptor.iter_records(io.BytesIO(os.urandom(3000))))
+        for size, committed in ((10, 0), (record_offset(0, 1024), record_offset(0, 1024)),
+                                (record_offset(2, 1024) + 5, record_offset(2, 1024)), (len(stream), len(stream))):
+            self.assertEqual(committed, stream_committed_length(io.BytesIO(stream[:size]), size))
+
+
+class TestFileMetaHandler(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        os.mkdir('1')
+        self.meta = db.FileMetaHandler('1')
+
+    def tearDown(self):
+        self.meta.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_migrate_schema_v0(self):
+        # a metadata db as created before schema versioning
+        with sqlite3.connect(self.meta.meta_db_path) as dbcon:
+            dbcon.execute("""CREATE TABLE Filenums (filenum INTEGER PRIMARY KEY NOT NULL,
+                             numpath TEXT NOT NULL, ftppath TEXT NOT NULL)""")
+            dbcon.execute("""CREATE TABLE FileMetadata (tag TEXT NOT NULL, size INTEGER NOT NULL,
+                             filenum INTEGER NOT NULL)""")
+            dbcon.executemany("""INSERT INTO Filenums VALUES (?, ?, ?)""", [
+                (1, self.meta.root, '/'),
+                (2, os.path.join(self.meta.root, '2'), '/dir'),
+                (3, os.path.join(self.meta.root, '2', '3'), '/dir/file'),
+            ])
+            dbcon.executemany("""INSERT INTO FileMetadata VALUES (?, ?, ?)""", [('old', 1, 3), ('new', 2, 3)])
+        dbcon.close()
+        with open(self.meta.meta_db_path, 'rb') as fd:
+            tagged = fd.read()
+
+        self.meta.create_file_metadata()
+        self.assertEqual(len(db.MIGRATIONS), self.meta.schema_version)
+        # the client reads the entries of the tagged file as migrated
+        self.assertEqual(sorted(self.meta.fetch_tree_rows()), sorted(client._legacy_tree_rows(tagged)))
+        self.assertEqual({3: ('file', 2)}, self.meta.fetch_dir_entries(2))
+        self.assertEqual(os.path.join(self.meta.root, '2', '4'), self.meta.get_numpath('/dir/other'))
+        with open(self.meta.verification_db_path, 'rb') as fd:
+            self.assertEqual(tagged, fd.read())
+        self.meta.on_retagged()
+        self.assertEqual(self.meta.meta_db_path, self.meta.verification_db_path)
+
+    def test_move_directory(self):
+        self.meta.create_file_metadata()
+        file_numpath = self.meta.get_numpath('/a/b/file')
+        dst_numpath = self.meta.get_numpath('/c')
+        self.meta.move_entry(int(os.path.basename(self.meta.get_numpath('/a'))), int(os.path.basename(dst_numpath)))
+        self.assertIsNone(self.meta.fetch_numpath_by_ftppath('/a/b/file'))
+        self.assertEqual((file_numpath,), self.meta.fetch_numpath_by_ftppath('/c/b/file'))
+        self.assertEqual(('/c/b/file',), self.meta.fetch_filepath(file_numpath))
+
+    def test_path_cache(self):
+        self.meta.create_file_metadata()
+        file_numpath = self.meta.get_numpath('/a/b/file')
+        dir_numpath = self.meta.get_numpath('/c')
+        other = db.FileMetaHandler('1')
+        other.load_paths()
+        self.assertEqual(3 + 1, len(other._paths))
+        self.assertEqual(('/a/b/file',), other.fetch_filepath(file_numpath))
+
+        # the cache follows the session's own changes
+        self.meta.move_entry(int(os.path.basename(self.meta.get_numpath('/a'))), int(os.path.basename(dir_numpath)))
+        self.assertEqual(('/c/b/file',), self.meta.fetch_filepath(file_numpath))
+        self.assertIsNone(self.meta.fetch_numpath_by_ftppath('/a/b/file'))
+        self.meta.remove_file_by_num(os.path.basename(file_numpath))
+        self.assertIsNone(self.meta.fetch_numpath_by_ftppath('/c/b/file'))
+
+        # and is dropped after changes by another session
+        self.assertIsNone(other.fetch_numpath_by_ftppath('/a/b/file'))
+        self.assertIsNone(other.fetch_filepath(file_numpath))
+        other.close()
+
+        paths = db.PathCache(max_size=2)
+        for filenum, name in enumerate('abc', 2):
+            paths.add(filenum, 1, name)
+        self.assertEqual((None, 3, 4), (paths.child(1, 'a'), paths.child(1, 'b'), paths.child(1, 'c')))
+        paths.add(3, 4, 'b')
+        self.assertEqual((None, 3, (4, 'b')), (paths.child(1, 'b'), paths.child(4, 'b'), paths.entry(3)))
+
+    def test_tree_updates(self):
+        self.meta.create_file_metadata()
+        root = merkle_root(self.meta.fetch_tree_rows())
+        file_numpath = self.meta.get_numpath('/a/file')
+        self.meta.add_file_meta(os.path.basename(file_numpath), '00', 4)
+        self.meta.move_entry(int(os.path.basename(file_numpath)), int(os.path.basename(self.meta.get_numpath('/b'))))
+        self.meta.remove_file_by_num(os.path.basename(self.meta.get_numpath('/a')))
+
+        seq, updates = self.meta.fetch_tree_updates()
+        self.assertEqual((root, merkle_root(self.meta.fetch_tree_rows())), apply_tree_updates(updates))
+        updates[0][2][2] = 'x'
+        self.assertRaises(InvalidSignature, apply_tree_updates, updates)
+
+        self.meta.clear_tree_journal(seq)
+        self.assertEqual((seq, []), self.meta.fetch_tree_updates())
+
+    def test_tree_snapshot(self):
+        self.meta.create_file_metadata()
+        filenum = os.path.basename(self.meta.get_numpath('/file'))
+        self.meta.store_file_meta(filenum, '00', 4)
+        self.meta.store_file_meta(filenum, '11', 8)
+        self.assertEqual((('11',), (8,)), (self.meta.fetch_tag(filenum), self.meta.fetch_size(filenum)))
+
+        seq, updates, mtag, rows = self.meta.fetch_tree_snapshot(_rows=True)
+        self.assertEqual((seq, updates), self.meta.fetch_tree_updates())
+        self.assertEqual(self.meta.fetch_tree_rows(), rows)
+        self.assertTrue(self.meta.store_tree_tag(b'n' * 32, seq))
+        # a session tagging older changes doesn't overwrite the newer tag
+        self.assertFalse(self.meta.store_tree_tag(b'o' * 32, seq - 1))
+        self.assertEqual((seq, [], db.TREE_TAG.pack(db.TREE_TAG_MAGIC, seq, b'n' * 32), None),
+                         self.meta.fetch_tree_snapshot())
+
+    def test_find_anomalies(self):
+        self.meta.create_file_metadata()
+        numpaths = {}
+        for ftppath in ('/a/b/file', '/a/file', '/file'):
+            numpaths[ftppath] = self.meta.get_numpath(ftppath)
+            os.makedirs(os.path.dirname(numpaths[ftppath]), exist_ok=True)
+            with open(numpaths[ftppath], 'wb') as fo:
+                fo.write(b'data')
+            self.meta.add_file_meta(os.path.basename(numpaths[ftppath]), '00', 4)
+        self.assertEqual([], list(self.meta.find_anomalies()))
+        self.assertEqual([], list(self.meta.find_anomalies()))
+
+        shutil.rmtree(os.path.dirname(numpaths['/a/b/file']))
+        with open(numpaths['/file'], 'ab') as fo:
+            fo.write(b'more')
+        expected = [('missing', '/a/b'), ('missing', '/a/b/file'), ('resized', '/file')]
+        # anomalies are found again until fixed
+        self.assertEqual(expected, sorted(self.meta.find_anomalies()))
+        self.assertEqual(expected, sorted(self.meta.find_anomalies()))
+
+
+class TestMySmartyAuthorizer(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.users_db = db.users_db
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        os.mkdir('1')
+        db.users_db = os.path.realpath('users.db')
+        self.authorizer = server.MySmartyAuthorizer(password_workers=0)
+        self.authorizer.add_user('user', 'pass', '1', derived_password=(b'salt', b'key'))
+
+    def tearDown(self):
+        db.users_db = self.users_db
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_ticket(self):
+        ticket = self.authorizer.issue_ticket('user')
+        self.authorizer.validate_ticket('user', ticket)
+        # the key is persisted, so tickets survive a restart
+        server.MySmartyAuthorizer(password_workers=0).validate_ticket('user', ticket)
+
+        tampered = ticket[:-2] + ('00' if ticket[-2:] != '00' else '01')
+        self.assertRaises(AuthenticationFailed, self.authorizer.validate_ticket, 'user', tampered)
+        self.assertRaises(AuthenticationFailed, self.authorizer.validate_ticket, 'other', ticket)
+
+        self.authorizer.ticket_lifetime = -1
+        expired = self.authorizer.issue_ticket('user')
+        self.assertRaises(AuthenticationFailed, self.authorizer.validate_ticket, 'user', expired)
+
+    def test_user_cache(self):
+        home = self.authorizer.get_home_dir('user')
+        self.assertEqual(os.path.realpath('1'), home)
+        # overrides as set by DummyAuthorizer.override_perm: the first one which applies is used
+        os.makedirs(os.path.join('1', 'a', 'b'))
+        operms = {os.path.join(home, 'a', 'b'): ['elrw', False], os.path.join(home, 'a'): ['e', True]}
+        with db.users_dbcon() as dbcon:
+            dbcon.execute("""UPDATE Users SET operms = (?) WHERE username = 'user'""", (json.dumps(operms),))
+        self.assertEqual({}, self.authorizer.get_operms('user'))
+
+        authorizer = server.MySmartyAuthorizer(password_workers=0)
+        self.assertEqual(operms, authorizer.get_operms('user'))
+        self.assertTrue(authorizer.has_perm('user', 'w', os.path.join(home, 'a', 'b', 'file')))
+        self.assertFalse(authorizer.has_perm('user', 'w', os.path.join(home, 'a', 'b', 'c', 'file')))
+        self.assertFalse(authorizer.has_perm('user', 'l', os.path.join(home, 'a', 'file')))
+        self.assertTrue(authorizer.has_perm('user', 'l', os.path.join(home, 'file')))
+
+        authorizer.remove_user('user')
+        self.assertFalse(authorizer.has_user('user'))
+        self.assertRaises(KeyError, authorizer.get_home_dir, 'user')
+        # still cached by the other authorizer (e.g. in another server process) until it expires
+        self.assertTrue(self.authorizer.has_user('user'))
+
+
+class TestMyFTPClient(unittest.TestCase):
+    def setUp(self):
+        self.ftp = client.MyFTPClient()
+        self.ftp._set_cipher(MyCipher('dog'))
+
+    def test_filename_cache(self):
+        encrypted = self.ftp._encrypt_path('a/b/../c.txt')
+        names = encrypted.split('/')
+        self.assertEqual('..', names[2])
+        self.assertEqual(names[0], self.ftp._encrypt_filename('a'))
+        self.assertEqual('a/b/../c.txt', self.ftp._decrypt_path(encrypted))
+        self.assertEqual(['c.txt', 'a', 'c.txt'], self.ftp._decrypt_filenames([names[3], names[0], names[3]]))
+        self.assertEqual(['type=file; c.txt'], self.ftp._decrypt_listing(['type=file; ' + names[3]]))
+
+        # a new cipher starts with an empty cache
+        other = client.MyFTPClient()
+        other._set_cipher(MyCipher('cat'))
+        self.assertNotEqual(names[0], other._encrypt_filename('a'))
+
+        names = client.FilenameCache(max_size=2)
+        names.add('a', '0a')
+        names.add('b', '0b')
+        self.assertEqual('0a', names.encrypted('a'))
+        names.add('c', '0c')
+        self.assertIsNone(names.encrypted('b'))
+        # each direction is evicted by its own use
+        self.assertIsNone(names.decrypted('0a'))
+        self.assertEqual('b', names.decrypted('0b'))
+        names.clear()
+        self.assertIsNone(names.encrypted('a'))
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Runs the server in a thread, in a temporary directory which is also the client's working directory,
+    and registers a user.
+    """
+
+    def setUp(self):
+        cwd, users_db = os.getcwd(), db.users_db
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(workdir)
+        self.addCleanup(setattr, db, 'users_db', users_db)
+        db.users_db = os.path.realpath('users.db')
+        self.handler = type('Handler', (server.MyFTPHandler,), {
+            'authorizer': server.MySmartyAuthorizer(password_workers=0), 'abstracted_fs': server.MyDBFS})
+        # the connection to the users db is opened again by the server thread
+        db.close_users_dbcon()
+        sock = socket.create_server(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        self.server = FTPServer(sock, self.handler)
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._serve, args=(stopped,))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stopped.set)
+        self.connect().register('user', 'pass')
+
+    def _serve(self, stopped):
+        while not stopped.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False)
+        self.server.close_all()
+        db.close_users_dbcon()
+
+    def connect(self, login=False):
+        """
+        :param login: (bool) whether to log in as the registered user
+        :return: (client.MyFTPClient) a new connection to the server
+        """
+        ftp = client.MyFTPClient(timeout=10)
+        ftp.connect('127.0.0.1', self.port)
+        self.addCleanup(ftp.close)
+        if login:
+            ftp.login('user', 'pass')
+        return ftp
+
+    @staticmethod
+    def stored_files():
+        """
+        :return: (List(str)) paths of the files stored for the registered user
+        """
+        return [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk('1')
+                for filename in filenames if filename.isdigit()]
+
+
+class TestMyFTPHandler(ServerTestCase):
+    def test_register_conflict(self):
+        first, second = self.connect(), self.connect()
+        first.register('other', 'pass')
+        second._set_cipher(MyCipher('pass'))
+        second.sendcmd('RGTR ' + second._encrypt_filename('new'))
+        first.close()
+        self.connect().register('new', 'pass')
+        # the name was registered in the meantime: nothing is created for this session
+        self.assertRaises(error_perm, second.sendcmd, 'PASS ' + second._cipher.derive_server_key())
+        self.assertEqual(['1', '2', '3'], sorted(name for name in os.listdir() if name.isdigit()))
+        self.assertRaises(error_perm, second.nlst)
+        second.register('third', 'pass')
+        self.assertTrue(os.path.isdir('4'))
+
+    def test_list(self):
+        ftp = self.connect(login=True)
+        sizes = {'a.txt': 0, 'b.txt': 5, 'c.bin': 3000}
+        for name, size in sizes.items():
+            with open(name, 'wb') as fp:
+                fp.write(os.urandom(size))
+            ftp.upload_file(name)
+        ftp.mkd('dir')
+        # the stored sizes are listed, not those of the files on disk
+        for path in self.stored_files():
+            with open(path, 'ab') as fp:
+                fp.write(b'x')
+
+        expected = {name: stream_size(size) for name, size in sizes.items()}
+        lines = []
+        ftp.dir(lines.append)
+        self.assertEqual(sorted(expected) + ['dir'], sorted(line.split()[-1] for line in lines))
+        self.assertEqual(expected, {line.split()[-1]: int(line.split()[4]) for line in lines if line[0] == '-'})
+        facts = dict(ftp.mlsd(facts=['type', 'size']))
+        self.assertEqual('dir', facts.pop('dir')['type'])
+        self.assertEqual(expected, {name: int(fact['size']) for name, fact in facts.items()})
+
+    def test_stot(self):
+        ftp = self.connect(login=True)
+        ftp.voidcmd('TYPE I')
+        data = os.urandom(10000)
+        encryptor = ftp._cipher.stream_encryptor(chunk_size=1024)
+        records = list(encryptor.iter_records(io.BytesIO(data)))
+        conn = ftp.transfercmd('STOT ' + ftp._encrypt_path('file.bin'))
+        conn.sendall(b''.join(records) + encryptor.file_tag())
+        conn.close()
+        self.assertTrue(ftp.voidresp().startswith('226'))
+        self.assertTrue(ftp.voidresp().startswith('250'))
+        # the tag was stripped off the stored file
+        self.assertEqual([stream_size(len(data), 1024)], [os.path.getsize(path) for path in self.stored_files()])
+        ftp.download_file('file.bin')
+        with open('file.bin', 'rb') as fp:
+            self.assertEqual(data, fp.read())
+
+        ftp.sendcmd('REST 10')
+        self.assertRaisesRegex(error_perm, '^504', ftp.sendcmd, 'STOT ' + ftp._encrypt_path('file.bin'))
+
+        # an incomplete upload is kept, and resumed
+        conn = ftp.transfercmd('STOT ' + ftp._encrypt_path('part.bin'))
+        conn.sendall(b''.join(records[:3]))
+        conn.close()
+        ftp.voidresp()
+        self.assertRaisesRegex(error_perm, '^554', ftp.voidresp)
+        self.assertTrue(ftp.sendcmd('PLEN ' + ftp._encrypt_path('part.bin')).startswith('213'))
+        ftp.store_resumed('part.bin', io.BytesIO(data))
+        ftp.download_file('part.bin')
+        with open('part.bin', 'rb') as fp:
+            self.assertEqual(data, fp.read())
+
+    @staticmethod
+    def _retrieve_raw(ftp, path, rest=None):
+        """
+        :return: (bytes) the file as sent by the server, in the current TYPE
+        """
+        with ftp.transfercmd('RETR ' + ftp._encrypt_path(path), rest) as conn:
+            data = b''.join(iter(lambda: conn.recv(65536), b''))
+        ftp.voidresp()
+        return data
+
+    def test_stot_refused(self):
+        with contextlib.closing(sqlite3.connect(db.users_db)) as dbcon, dbcon:
+            dbcon.execute("""UPDATE Users SET perm = 'elr'""")
+        ftp = self.connect(login=True)
+        # the data sent before the refusal is limited, the rest isn't sent
+        for size in (10, 10 * client.STOT_EAGER_SIZE):
+            self.assertRaisesRegex(error_perm, '^550', ftp.store_tagged, 'file.bin', io.BytesIO(os.urandom(size)))
+            ftp.voidcmd('NOOP')
+
+    def test_segments(self):
+        ftp = self.connect(login=True)
+        # sizes which aren't multiples of the segments, and a file of fewer records than streams
+        for size in (300001, 1000):
+            data = os.urandom(size)
+            with open('file.bin', 'wb') as fp:
+                fp.write(data)
+            ftp.upload_file_parallel('file.bin', streams=3)
+            os.remove('file.bin')
+            ftp.download_file_parallel('file.bin', streams=3)
+            with open('file.bin', 'rb') as fp:
+                self.assertEqual(data, fp.read())
+
+    def test_resume_download(self):
+        ftp = self.connect(login=True)
+        data = os.urandom(300000)
+        ftp.store_tagged('file.bin', io.BytesIO(data))
+        # interrupted off a record boundary
+        with open('file.bin', 'wb') as fp:
+            fp.write(data[:123457])
+        ftp.download_file('file.bin', resume=True)
+        with open('file.bin', 'rb') as fp:
+            self.assertEqual(data, fp.read())
+
+    def test_read_range(self):
+        ftp = self.connect(login=True)
+        data = os.urandom(100000)
+        ftp.store_tagged('file.bin', io.BytesIO(data))
+        self.assertEqual(data[40000:50000], ftp.read_range('file.bin', 40000, 10000))
+        # a range running past the end of the file is cut short
+        self.assertEqual(data[99000:], ftp.read_range('file.bin', 99000, 5000))
+        self.assertEqual(b'', ftp.read_range('file.bin', 1234, 0))
+
+    def test_retr(self):
+        ftp = self.connect(login=True)
+        data = os.urandom(200000)
+        ftp.store_tagged('file.bin', io.BytesIO(data))
+        with open(self.stored_files()[0], 'rb') as fp:
+            stored = fp.read()
+
+        ftp.voidcmd('TYPE I')
+        for use_sendfile in (True, False):
+            self.handler.use_sendfile = use_sendfile
+            # the tag follows the stored file
+            raw = self._retrieve_raw(ftp, 'file.bin')
+            self.assertEqual(stored, raw[:-TAG_SIZE])
+            self.assertEqual(len(stored) + TAG_SIZE, len(raw))
+            # REST positions are in the stored file followed by its tag
+            for rest in (1000, len(stored), len(stored) + 5):
+                self.assertEqual(raw[rest:], self._retrieve_raw(ftp, 'file.bin', rest))
+        ftp.download_file('file.bin')
+        with open('file.bin', 'rb') as fp:
+            self.assertEqual(data, fp.read())
+
+        # ASCII transfers aren't sent with sendfile(), the tag is sent as is
+        self.handler.use_sendfile = True
+        ftp.voidcmd('TYPE A')
+        self.assertEqual(re.sub(b'(?<!\r)\n', b'\r\n', stored) + raw[-TAG_SIZE:],
+                         self._retrieve_raw(ftp, 'file.bin'))
+
+    def test_mirror(self):
+        ftp = self.connect(login=True)
+        os.makedirs(os.path.join('local', 'sub'))
+        for path, data in (('a.txt', b'a'), ('sub/b.txt', b'b' * 5000)):
+            with open(os.path.join('local', path), 'wb') as fp:
+                fp.write(data)
+        self.assertEqual(['a.txt', 'sub/b.txt'], sorted(ftp.mirror('local', 'remote', workers=2)))
+        # unchanged files are skipped
+        self.assertEqual([], ftp.mirror('local', 'remote', workers=2))
+        with open(os.path.join('local', 'a.txt'), 'wb') as fp:
+            fp.write(b'changed')
+        self.assertEqual(['a.txt'], ftp.mirror('local', 'remote', workers=2))
+
+        self.assertEqual(['a.txt', 'sub/b.txt'], sorted(ftp.mirror_download('remote', 'copy', workers=2)))
+        for path in ('a.txt', 'sub/b.txt'):
+            with open(os.path.join('local', path), 'rb') as fp, open(os.path.join('copy', path), 'rb') as copy:
+                self.assertEqual(fp.read(), copy.read())
+        self.assertEqual([], ftp.mirror_download('remote', 'copy', workers=2))
+
+        # files whose verification failed are deleted
+        for path in self.stored_files():
+            with open(path, 'r+b') as fp:
+                fp.seek(os.path.getsize(path) // 2)
+                byte = fp.read(1)
+                fp.seek(-1, os.SEEK_CUR)
+                fp.write(bytes([byte[0] ^ 1]))
+        shutil.rmtree('copy')
+        self.assertEqual([], ftp.mirror_download('remote', 'copy', workers=2))
+        self.assertEqual([], [filenames for _, _, filenames in os.walk('copy') if filenames])
+
+    def test_legacy_tag(self):
+        ftp = self.connect(login=True)
+        with open('file.txt', 'wb') as fp:
+            fp.write(b'data')
+        ftp.upload_file('file.txt')
+        ftp.mkd('dir')
+        # as tagged by an older client: the db as a whole
+        with io.BytesIO() as buf:
+            FTP.retrbinary(ftp, 'LGMETA', buf.write)
+            legacy_tag = ftp._cipher.get_hmac_tag(buf.getvalue())
+        ftp.close()
+        mtag_path = os.path.join('1', 'mtag')
+        with open(mtag_path, 'wb') as fo:
+            fo.write(legacy_tag)
+
+        fetch_tree_snapshot = db.FileMetaHandler.fetch_tree_snapshot
+
+        def forged_snapshot(meta, _rows=False):
+            seq, updates, mtag, rows = fetch_tree_snapshot(meta, _rows)
+            for row in rows or ():
+                if row[4] is not None:
+                    row[4] += 1
+            return seq, updates, mtag, rows
+
+        # the entries sent with LGTREE must be those of the verified db
+        with mock.patch.object(db.FileMetaHandler, 'fetch_tree_snapshot', forged_snapshot), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.connect(login=True)
+        self.assertIn('SECURITY ALERT', stderr.getvalue())
+        with open(mtag_path, 'rb') as fo:
+            self.assertEqual(legacy_tag, fo.read())
+
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.connect(login=True)
+        self.assertEqual('', stderr.getvalue())
+        with open(mtag_path, 'rb') as fo:
+            self.assertTrue(fo.read().startswith(TREE_TAG_MAGIC))
+
+    def test_tree_commands_need_login(self):
+        ftp = self.connect()
+        for cmd in ('MTREE', 'LGTREE', 'TREETAG ' + '00' * 32):
+            self.assertRaisesRegex(error_perm, '^530', ftp.sendcmd, cmd)
+        ftp.voidcmd('NOOP')
+
+    def test_streamed_file_check(self):
+        self.handler.file_check_workers = 2
+        ftp = self.connect(login=True)
+        for name in ('a.txt', 'b.txt'):
+            with open(name, 'wb') as fp:
+                fp.write(b'data')
+            ftp.upload_file(name)
+        os.remove(self.stored_files()[0])
+        ticket = [session[1] for key, session in client._sessions.items() if key[1] == self.port][0]
+        check_files = server._check_files
+
+        def slow_check_files(*args):
+            time.sleep(0.2)
+            check_files(*args)
+
+        ftp = self.connect()
+        ftp._set_cipher(MyCipher('pass'))
+        ftp.sendcmd('USER ' + ftp._encrypt_filename('user'))
+        with mock.patch.object(server, '_check_files', slow_check_files):
+            ftp.putcmd('RSME ' + ticket)
+            # not read until the check is done, so its reply comes after the check's
+            ftp.putcmd('NOOP')
+            self.assertTrue(ftp.getresp().startswith('230'))
+            self.assertRaisesRegex(error_perm, '^556', ftp.getresp)
+            self.assertTrue(ftp.getresp().startswith('200'))
+
+    def test_ticket_not_logged(self):
+        with self.assertLogs('pyftpdlib', logging.DEBUG) as logs:
+            self.connect(login=True)
+            # logs in again with the ticket received
+            self.connect(login=True)
+        ticket = [session[1] for key, session in client._sessions.items() if key[1] == self.port][0]
+        self.assertIn('<- RSME ******', '\n'.join(logs.output))
+        self.assertNotIn(ticket, '\n'.join(logs.output))
+
+
+
+class TestFuturePoller(unittest.TestCase):
+    def test_shared_timer(self):
+        ioloop = IOLoop()
+        self.addCleanup(ioloop.close)
+        poller = server.FuturePoller.of(ioloop, 0.001)
+        self.assertIs(poller, server.FuturePoller.of(ioloop, 0.001))
+        done = []
+        futures = [Future() for _ in range(3)]
+        with mock.patch.object(ioloop, 'call_every', wraps=ioloop.call_every) as call_every:
+            for future in futures:
+                poller.add(future, done.append)
+            # one timer for all the pending futures
+            self.assertEqual(1, call_every.call_count)
+
+            futures[0].set_result(0)
+            time.sleep(0.01)
+            ioloop.loop(timeout=0.01, blocking=False)
+            self.assertEqual(futures[:1], done)
+            for future in futures[1:]:
+                future.set_result(0)
+            time.sleep(0.01)
+            ioloop.loop(timeout=0.01, blocking=False)
+            self.assertEqual(futures, done)
+            # stopped once nothing is pending, restarted by the next future
+            self.assertIsNone(poller._timer)
+            poller.add(Future(), done.append)
+            self.assertEqual(2, call_every.call_count)
+
+
+class TestAsyncFTPClient(ServerTestCase):
+    def test_pool_errors(self):
+        async def run():
+            async with aioclient.AsyncFTPClient('127.0.0.1', self.port, pool_size=2, timeout=10) as ftp:
+                await ftp.login('user', 'pass')
+                # sessions which got an error reply go back to the pool
+                for _ in range(ftp.pool_size + 1):
+                    with self.assertRaises(error_perm):
+                        await ftp.download_file('missing.txt')
+                with open('file.txt', 'wb') as fp:
+                    fp.write(b'data')
+                await ftp.upload_file('file.txt')
+                self.assertEqual(['file.txt'], await ftp.nlst())
+                self.assertLessEqual(len(ftp._sessions), ftp.pool_size)
+
+        asyncio.run(asyncio.wait_for(run(), 30))
+
+
+class TestServe(unittest.TestCase):
+    script = textwrap.dedent("""
+        import os, sys, db, server
+        db.users_db = os.path.realpath('users.db')
+        handler = server.MyFTPHandler
+        handler.authorizer = server.MySmartyAuthorizer(password_workers=0)
+        handler.abstracted_fs = server.MyDBFS
+        server.serve(('127.0.0.1', int(sys.argv[1])), handler, int(sys.argv[2]), int(sys.argv[3]))
+    """)
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def _serve(self, workers):
+        """
+        Run server.serve in a subprocess, log in over several connections, then interrupt it.
+        """
+        with socket.create_server(('127.0.0.1', 0)) as sock:
+            port = sock.getsockname()[1]
+        metrics_port = port + 1
+        process = subprocess.Popen(
+            [sys.executable, '-c', self.script, str(port), str(workers), str(metrics_port)], cwd=self.workdir,
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except ConnectionRefusedError:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+            cwd = os.getcwd()
+            os.chdir(self.workdir)
+            self.addCleanup(os.chdir, cwd)
+            ftp = client.MyFTPClient(timeout=10)
+            ftp.connect('127.0.0.1', port)
+            ftp.register('user', 'pass')
+            ftp.close()
+            for _ in range(2 * workers):
+                ftp = client.MyFTPClient(timeout=10)
+                ftp.connect('127.0.0.1', port)
+                self.assertTrue(ftp.login('user', 'pass').startswith('230'))
+                self.assertEqual('', ftp.nlst())
+                ftp.quit()
+            for task_id in range(workers):
+                with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % (metrics_port + task_id)) as resp:
+                    self.assertIn(b'ftp_command_seconds', resp.read())
+        finally:
+            os.killpg(process.pid, signal.SIGINT)
+            self.assertEqual(0, process.wait(10))
+
+    def test_serve(self):
+        self._serve(1)
+
+    def test_serve_workers(self):
+        self._serve(2)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_exposition(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('command',), buckets=(0.1, 1))
+        self.addCleanup(metrics.registry.remove, histogram)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, 'STOR')
+        lines = metrics.exposition().splitlines()
+        start = lines.index('# TYPE test_seconds histogram')
+        self.assertEqual(['test_seconds_bucket{command="STOR",le="0.1"} 1',
+                          'test_seconds_bucket{command="STOR",le="1"} 2',
+                          'test_seconds_bucket{command="STOR",le="+Inf"} 3',
+                          'test_seconds_sum{command="STOR"} 5.55',
+                          'test_seconds_count{command="STOR"} 3'], lines[start + 1:start + 6])
+
+    def test_instrument(self):
+        dbcon = sqlite3.connect(':memory:')
+        dbcon.set_trace_callback(metrics.count_query)
+        self.addCleanup(dbcon.close)
+
+        def rows(count):
+            for i in range(count):
+                yield dbcon.execute("""SELECT (?)""", (i,)).fetchone()
+
+        # statements are counted for the method running, and only then
+        self.assertEqual([(0,), (1,)], list(metrics._instrument('test_rows', rows)(2)))
+        self.assertEqual((0,), metrics._instrument('test_row', lambda: dbcon.execute("""SELECT 0""").fetchone())())
+        dbcon.execute("""SELECT 1""")
+        queries = {label_values: value for _, label_values, value in metrics.db_queries.samples()}
+        self.assertEqual((2, 1), (queries[('test_rows',)], queries[('test_row',)]))
+        calls = {label_values: value for suffix, label_values, value in metrics.db_seconds.samples()
+                 if suffix == '_count'}
+        self.assertEqual((1, 1), (calls[('test_rows',)], calls[('test_row',)]))
+
+
+class TestBench(unittest.TestCase):
+    def test_compare_load(self):
+        baseline = {'upload small': {'ops_per_s': 100.0}, 'list': {'ops_per_s': 10.0},
+                    'peak_rss': {'server': 100 << 20, 'client': None}, 'params': {'sessions': 4}}
+        results = {'upload small': {'ops_per_s': 85.0}, 'list': {'ops_per_s': 7.0}, 'rename': {'ops_per_s': 1.0},
+                   'peak_rss': {'server': 130 << 20, 'client': 50 << 20}, 'params': {'sessions': 4}}
+        self.assertEqual(['list: 7.0 ops/s (baseline 10.0)', 'server peak RSS: 130 MiB (baseline 100 MiB)'],
+                         bench.compare_load(results, baseline))
+        self.assertEqual([], bench.compare_load(results, baseline, tolerance=0.5))
+        baseline['params'] = {'sessions': 8}
+        self.assertRaises(ValueError, bench.compare_load, results, baseline)
 
 
 if __name__ == '__main__':